@@ -7,5 +7,6 @@
 """
 
 from imagesplit.utils.versioning import get_version
+from imagesplit.applications.dataset import open_dataset as open  # pylint: disable=redefined-builtin
 
 __version__ = get_version()
@@ -0,0 +1,118 @@
+# coding=utf-8
+"""
+Array-like access to an image which has been split into multiple files
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+import operator
+
+import numpy as np
+
+from imagesplit.file.data_type import DataType
+from imagesplit.file.file_factory import FileFactory
+from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.image.combined_image import CombinedImage, \
+    CoordinateTransformer, Axis
+from imagesplit.utils.file_descriptor import load_split_image
+
+
+def open_dataset(descriptor_filename, filename_override=None,
+                 file_handle_factory=None):
+    """Return a SplitDataset for the files listed in an ImageSplit descriptor
+    file. If filename_override is specified, the files are assumed to have
+    this base filename instead of the filenames in the descriptor. The
+    original source files are not needed"""
+
+    descriptors, global_descriptor = load_split_image(descriptor_filename,
+                                                      filename_override)
+    if not file_handle_factory:
+        file_handle_factory = FileHandleFactory()
+    return SplitDataset(descriptors, global_descriptor,
+                        FileFactory(file_handle_factory))
+
+
+class SplitDataset(object):
+    """Read-only numpy-like array for an image split into multiple files.
+
+    Data are only read when the dataset is indexed, e.g. ds[0:10, 5, :], and
+    only from the files which overlap the requested region. Indices are in
+    the global [x, y, z] ordering. Files remain open between reads until the
+    dataset is closed"""
+
+    def __init__(self, descriptors, global_descriptor, file_factory):
+        self.shape = tuple(global_descriptor.size)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(DataType(
+            global_descriptor.data_type,
+            global_descriptor.msb).get_numpy_format())
+        self._combined_image = CombinedImage(descriptors, file_factory)
+        self._transformer = CoordinateTransformer(
+            [0] * self.ndim, self.shape,
+            Axis(list(range(self.ndim)), [False] * self.ndim))
+
+    def __getitem__(self, key):
+        start, size, selector = self._parse_key(key)
+        if 0 in size:
+            return np.zeros(size, dtype=self.dtype)[selector]
+
+        image = self._combined_image.read_image(start, size,
+                                                self._transformer).image
+        if image is None:
+            raw = np.zeros(size, dtype=self.dtype)
+        else:
+            # Some formats, such as TIFF, may be decoded with a different
+            # type from the one stored in the descriptor
+            raw = np.transpose(image.get_raw()).astype(self.dtype, copy=False)
+        return raw[selector]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exit_type, value, traceback):
+        self.close()
+
+    def close(self):
+        """Close all open files"""
+        self._combined_image.close()
+
+    def _parse_key(self, key):
+        """Return the start and size of the region to read for this index,
+        and the selector which is applied to the region after reading"""
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            index = key.index(Ellipsis)
+            key = key[:index] + (slice(None),) * \
+                (self.ndim - len(key) + 1) + key[index + 1:]
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for a ' + str(self.ndim) +
+                             'D dataset')
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        start = []
+        size = []
+        selector = []
+        for index, length in zip(key, self.shape):
+            if isinstance(index, slice):
+                first, stop, step = index.indices(length)
+                count = len(range(first, stop, step))
+                last = first + (count - 1) * step
+                start.append(min(first, last))
+                size.append(abs(last - first) + 1 if count else 0)
+                selector.append(slice(first - start[-1], None, step))
+            else:
+                index = operator.index(index)
+                if index < 0:
+                    index += length
+                if not 0 <= index < length:
+                    raise IndexError('Index is out of range')
+                start.append(index)
+                size.append(1)
+                selector.append(0)
+        return start, size, tuple(selector)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Utility for extracting a region of an image from its split files
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import sys
+
+import six
+
+from imagesplit.applications.merge_files import merge_files, \
+    add_merge_arguments, DEFAULT_MERGE_BYTES
+
+
+def extract_roi(descriptor_filename, output_filename, roi_start, roi_size,
+                filename_override=None, output_type=None, dim_order=None,
+                file_handle_factory=None, max_bytes=DEFAULT_MERGE_BYTES,
+                num_threads=None):
+    """Write the region of the image with global start coordinates roi_start
+    and size roi_size to a single mhd output file. Only the split files
+    which overlap the region are opened, and each is closed once the part of
+    the region it holds has been written. The other arguments are as for
+    merge_files(). Returns the output filename"""
+
+    return merge_files(descriptor_filename=descriptor_filename,
+                       output_filename=output_filename,
+                       filename_override=filename_override,
+                       output_type=output_type,
+                       dim_order=dim_order,
+                       file_handle_factory=file_handle_factory,
+                       max_bytes=max_bytes,
+                       num_threads=num_threads,
+                       roi_start=roi_start,
+                       roi_size=roi_size)
+
+
+def parse_coordinates(coordinates_string):
+    """Convert a comma-separated list of integers such as 100,200,50 to a
+    list of coordinates"""
+    try:
+        coordinates = [int(value) for value in coordinates_string.split(',')]
+    except ValueError as exc:
+        six.raise_from(ValueError('Coordinates must be integers separated by '
+                                  'commas, for example 100,200,50'), exc)
+    return coordinates
+
+
+def main(args=None):
+    """Extract a region of an image from its split files"""
+
+    parser = argparse.ArgumentParser(
+        prog='imagesplit extract',
+        description='Extracts a region of the image formed by the split '
+                    'files listed in a descriptor file, reading only the '
+                    'files which overlap the region')
+    parser.add_argument("--start", required=True, type=parse_coordinates,
+                        help="Start coordinates of the region, separated by "
+                             "commas, eg --start 100,200,50")
+    parser.add_argument("--size", required=True, type=parse_coordinates,
+                        help="Size of the region, separated by commas, eg "
+                             "--size 64,64,32")
+    add_merge_arguments(parser)
+    args = parser.parse_args(args)
+
+    if len(args.start) != len(args.size):
+        parser.error('--start and --size must have the same number of '
+                     'dimensions')
+
+    output_filename = extract_roi(
+        descriptor_filename=args.descriptor,
+        output_filename=args.out,
+        roi_start=args.start,
+        roi_size=args.size,
+        filename_override=args.input,
+        output_type=args.type,
+        dim_order=args.axis,
+        max_bytes=args.max_bytes,
+        num_threads=args.threads)
+    six.print_("Written " + output_filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Utility for combining the partial descriptors written by sharded splits
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import sys
+
+import six
+
+from imagesplit.utils.file_descriptor import merge_descriptor_files
+from imagesplit.utils.versioning import get_version_string
+
+
+def main(args=None):
+    """Combine partial descriptor files into a single descriptor file"""
+
+    parser = argparse.ArgumentParser(
+        prog='imagesplit merge-descriptors',
+        description='Combines the partial descriptor files written by each '
+                    'shard of a split (--shard) into a single descriptor file')
+
+    parser.add_argument("descriptors", nargs='+',
+                        help="Partial descriptor files, one for each shard")
+    parser.add_argument("-o", "--out", required=False, default=None,
+                        help="Name of the combined descriptor file (default: "
+                             "derived from the partial descriptor names)")
+
+    version_string = get_version_string()
+    parser.add_argument(
+        "-v", "--version",
+        action='version',
+        version=version_string)
+
+    args = parser.parse_args(args)
+
+    descriptor_filename = merge_descriptor_files(args.descriptors, args.out)
+    six.print_("Written descriptor " + descriptor_filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Utility for reassembling split files into a single image file
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import six
+
+from imagesplit.file.data_type import DataType
+from imagesplit.file.file_factory import FileFactory
+from imagesplit.file.file_formats import FileFormats
+from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.file.format_factory import FormatFactory
+from imagesplit.image.combined_image import CombinedImage, \
+    CoordinateTransformer, LocalSource
+from imagesplit.utils.file_descriptor import load_split_image, \
+    generate_output_descriptors, SubImageRanges
+from imagesplit.utils.utilities import parse_byte_size
+from imagesplit.utils.versioning import get_version_string
+
+# Default maximum number of bytes of image data held in memory while merging
+DEFAULT_MERGE_BYTES = 2 ** 28
+
+
+def merge_files(descriptor_filename, output_filename, filename_override=None,
+                output_type=None, dim_order=None, file_handle_factory=None,
+                max_bytes=DEFAULT_MERGE_BYTES, num_threads=None,
+                roi_start=None, roi_size=None):
+    """Reassemble the split files listed in a descriptor file into a single
+    mhd output file. Returns the output filename.
+
+    If roi_start and roi_size are specified, only this region of the image
+    is written, and only the split files which overlap it are opened.
+
+    The output is written in its storage order, one chunk of consecutive
+    slices at a time, while the next chunk is being read. The parts of each
+    chunk held in different split files are read in parallel using
+    num_threads threads, and each split file is closed once the chunks
+    which use it have been written. Chunks are chosen so that the image data
+    held in memory are no more than about max_bytes. dim_order is the axis
+    ordering of the output file, as for split_file (default: the ordering of
+    the split files). If filename_override is specified, the split files are
+    assumed to have this base filename"""
+
+    # pylint: disable=too-many-locals
+
+    output_format = FormatFactory.extension_to_format(
+        os.path.splitext(output_filename)[1])
+    if output_format != FileFormats.METAIO_FORMAT:
+        raise ValueError('Merged files can only be written to mhd files')
+
+    if file_handle_factory is None:
+        file_handle_factory = FileHandleFactory()
+    file_factory = FileFactory(file_handle_factory)
+    descriptors_in, global_descriptor = load_split_image(descriptor_filename,
+                                                         filename_override)
+    if roi_start is None:
+        roi_start = [0] * global_descriptor.num_dims
+    if roi_size is None:
+        roi_size = global_descriptor.size
+    _check_roi(roi_start, roi_size, global_descriptor.size)
+
+    descriptor_out = generate_output_descriptors(
+        filename_out_base=os.path.splitext(output_filename)[0],
+        max_block_size_voxels=roi_size,
+        overlap_size_voxels=0,
+        dim_order=dim_order or global_descriptor.axis.to_condensed_format(),
+        header=None,
+        output_type=output_type or global_descriptor.data_type,
+        num_dims=global_descriptor.num_dims,
+        output_file_format=output_format,
+        image_size=roi_size,
+        msb=global_descriptor.msb,
+        compression=None,
+        voxel_size=global_descriptor.voxel_size)[0]
+    descriptor_out.ranges = SubImageRanges(
+        [[start, start + size - 1, 0, 0]
+         for start, size in zip(roi_start, roi_size)])
+
+    source = CombinedImage(descriptors_in, file_factory)
+    source.set_read_threads(num_threads)
+    transformer = CoordinateTransformer(descriptor_out.ranges.origin_start,
+                                        descriptor_out.ranges.image_size,
+                                        descriptor_out.axis)
+    local_source = LocalSource(source, transformer)
+
+    # Each chunk is held as it is read, assembled and converted, and the
+    # next chunk is read while it is written
+    local_size = descriptor_out.get_local_size()
+    out_dtype = np.dtype(DataType(descriptor_out.data_type,
+                                  descriptor_out.msb).get_numpy_format())
+    in_dtype = np.dtype(DataType(global_descriptor.data_type,
+                                 global_descriptor.msb).get_numpy_format())
+    slice_bytes = int(np.prod(local_size[:-1])) * \
+        (3 * in_dtype.itemsize + out_dtype.itemsize)
+    chunk_slices = max(1, max_bytes // slice_bytes)
+    chunks = [([0] * (len(local_size) - 1) + [start],
+               local_size[:-1] + [min(chunk_slices, local_size[-1] - start)])
+              for start in range(0, local_size[-1], chunk_slices)]
+
+    def read_chunk(chunk):
+        image = local_source.read_into(chunk[0], chunk[1]).image
+        if image is None:
+            # No split file overlaps this chunk
+            return np.zeros(list(reversed(chunk[1])), dtype=out_dtype), None
+        return image.get_raw(), image
+
+    out_file = file_factory.create_write_file(descriptor_out)
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            next_chunk = executor.submit(read_chunk, chunks[0])
+            for index, chunk in enumerate(chunks):
+                raw, image = next_chunk.result()
+                if index + 1 < len(chunks):
+                    next_chunk = executor.submit(read_chunk,
+                                                 chunks[index + 1])
+                out_file.write_lines(chunk[0], raw, None)
+                if image is not None:
+                    local_source.release(image)
+                if index + 1 < len(chunks):
+                    # Split files which are not needed for the remaining
+                    # chunks are closed, so the memory used stays bounded
+                    remaining_start = chunks[index + 1][0]
+                    remaining_size = local_size[:-1] + \
+                        [local_size[-1] - remaining_start[-1]]
+                    source.release_subimages(*transformer.to_global_region(
+                        remaining_start, remaining_size))
+        out_file.close_file()
+    finally:
+        source.close()
+
+    return descriptor_out.filename
+
+
+def _check_roi(roi_start, roi_size, image_size):
+    if len(roi_start) != len(image_size) or len(roi_size) != len(image_size):
+        raise ValueError('The region must have a start and size for each '
+                         'of the ' + str(len(image_size)) + ' dimensions')
+    for start, size, image in zip(roi_start, roi_size, image_size):
+        if size < 1 or start < 0 or start + size > image:
+            raise ValueError('The region must lie within the image, which '
+                             'has size ' + str(image_size))
+
+
+def add_merge_arguments(parser):
+    """Add the arguments for reading split files and writing the merged
+    output to an ArgumentParser"""
+
+    parser.add_argument("descriptor",
+                        help="Descriptor file (.imagesplit) written by the "
+                             "split")
+    parser.add_argument("-o", "--out", required=True,
+                        help="Name of the output mhd file")
+    parser.add_argument("-i", "--input", required=False, default=None,
+                        help="Filename prefix of the split files, if they "
+                             "have been moved or renamed since the "
+                             "descriptor was written")
+    parser.add_argument("-t", "--type", required=False, default=None,
+                        type=str,
+                        help="Output data type (default: same as the split "
+                             "files)")
+    parser.add_argument("-a", "--axis", required=False, default=None,
+                        type=int, nargs="+",
+                        help="Axis ordering of the output file, as for "
+                             "splitting (default: same as the split files)")
+    parser.add_argument("--max-bytes", required=False,
+                        default=DEFAULT_MERGE_BYTES, type=parse_byte_size,
+                        help="Approximate maximum memory used for image data, "
+                             "for example 512M (default 256M)")
+    parser.add_argument("-j", "--threads", required=False, default=None,
+                        type=int,
+                        help="Number of split files to read at once "
+                             "(default: a few more than the number of CPUs)")
+
+    version_string = get_version_string()
+    parser.add_argument(
+        "-v", "--version",
+        action='version',
+        version=version_string)
+
+
+def main(args=None):
+    """Reassemble split files into a single image file"""
+
+    parser = argparse.ArgumentParser(
+        prog='imagesplit merge',
+        description='Reassembles the split files listed in a descriptor '
+                    'file into a single image file')
+    add_merge_arguments(parser)
+    args = parser.parse_args(args)
+
+    output_filename = merge_files(
+        descriptor_filename=args.descriptor,
+        output_filename=args.out,
+        filename_override=args.input,
+        output_type=args.type,
+        dim_order=args.axis,
+        max_bytes=args.max_bytes,
+        num_threads=args.threads)
+    six.print_("Written " + output_filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,12 +15,25 @@ import argparse
 import os
 import sys
 
+import six
+
+from imagesplit.file.container import create_container, CONTAINER_EXTENSION
+from imagesplit.file.data_type import DataType
 from imagesplit.file.file_factory import FileFactory
-from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.file.file_wrapper import FileHandleFactory, CachePolicy, \
+    CACHE_DEFAULT, CACHE_POLICIES, DEFAULT_MAX_OPEN_FILES, get_handle_pool
+from imagesplit.image.combined_image import Percentiles
 from imagesplit.utils.file_descriptor import write_descriptor_file, \
     generate_output_descriptors, generate_input_descriptors, \
-    header_from_descriptor
-from imagesplit.applications.write_files import write_files
+    header_from_descriptor, select_shard, get_ranges_array, LAYOUT_FLAT, \
+    LAYOUTS
+from imagesplit.utils.block_planner import plan_block_size
+from imagesplit.utils.utilities import convert_to_array, \
+    get_max_block_size_for_bytes, parse_byte_size
+from imagesplit.applications import extract_files, merge_descriptors, \
+    merge_files, verify_files
+from imagesplit.applications.write_files import write_files, ENGINES, \
+    SYNC_ENGINE
 
 # pylint: disable=too-many-arguments
 from imagesplit.utils.versioning import get_version_string
@@ -29,8 +42,32 @@ from imagesplit.utils.versioning import get_version_string
 def split_file(input_file_base, filename_out_base, start_index, output_type,
                dim_order, file_handle_factory, output_format, slice_output,
                rescale, out_compression, max_block_size_voxels,
-               overlap_size_voxels, descriptor_filename=None, test=False):
-    """Saves the specified image file as a number of smaller files"""
+               overlap_size_voxels, descriptor_filename=None, test=False,
+               shard=None, native_endian=False, rescale_percentile=None,
+               max_bytes=None, num_blocks=None, engine=SYNC_ENGINE,
+               max_in_flight=4, layout=LAYOUT_FLAT, container=False,
+               compact_descriptor=False, cache_histogram=False):
+    """Saves the specified image file as a number of smaller files
+
+    If shard is specified as (shard_index, num_shards), only the subset of
+    output files belonging to this shard are written, together with a
+    partial descriptor file. If native_endian is True, output files use the
+    byte order of this machine instead of the byte order of the input.
+    rescale_percentile is an optional pair of low and high percentiles of the
+    input values which are used as the rescale limits. If max_bytes is
+    specified, blocks are chosen so that each output file holds no more than
+    this number of bytes of uncompressed image data. If num_blocks is
+    specified, the image is split into exactly this number of files, choosing
+    the block shape which is estimated to be quickest to read from the input.
+    engine selects how reads and writes are scheduled (see write_files).
+    layout selects how output files are arranged in folders (see
+    generate_output_descriptors). If container is True, the output files are
+    stored in a single tar file (see create_container). If
+    compact_descriptor is True, the descriptor file is written in the
+    compact version 1.1 format, which loads faster for very many files. If
+    cache_histogram is True, the histograms computed for rescale_percentile
+    are saved in files alongside the input files and reused by later runs
+    """
 
     if not filename_out_base:
         input_file_base = os.path.splitext(input_file_base)[0]
@@ -39,6 +76,12 @@ def split_file(input_file_base, filename_out_base, start_index, output_type,
     if rescale and rescale != "limits" and len(rescale) != 2:
         raise ValueError('Rescale must have no arguments, or a min and max')
 
+    if rescale_percentile:
+        if rescale:
+            raise ValueError('Cannot use rescale with rescale percentiles')
+        rescale = Percentiles(rescale_percentile[0], rescale_percentile[1],
+                              cache_histogram)
+
     descriptors_in, global_descriptor, header = specify_input_descriptors(
         descriptor_filename, input_file_base, start_index, input_file_base)
 
@@ -52,17 +95,33 @@ def split_file(input_file_base, filename_out_base, start_index, output_type,
         output_format,
         output_type,
         overlap_size_voxels,
-        slice_output
+        slice_output,
+        native_endian,
+        max_bytes,
+        num_blocks,
+        descriptors_in,
+        layout
     )
 
+    if shard:
+        if container:
+            raise ValueError('Cannot write a container in shards')
+        descriptors_out = select_shard(descriptors_out, shard[0], shard[1])
+
+    if container:
+        create_container(filename_out_base + CONTAINER_EXTENSION,
+                         descriptors_out, test)
+
     file_factory = FileFactory(file_handle_factory)
 
-    write_files(descriptors_in, descriptors_out, file_factory, rescale, test)
+    write_files(descriptors_in, descriptors_out, file_factory, rescale, test,
+                engine, max_in_flight)
 
     # Write out descriptor if one does not already exist
     if not descriptor_filename:
         write_descriptor_file(descriptors_in, descriptors_out,
-                              filename_out_base, test)
+                              filename_out_base, test, shard,
+                              compact_descriptor)
 
 
 def specify_input_descriptors(descriptor_filename, input_file_base,
@@ -81,7 +140,9 @@ def specify_input_descriptors(descriptor_filename, input_file_base,
 def specify_output_descriptors(dim_order, filename_out_base, global_descriptor,
                                header, max_block_size_voxels, out_compression,
                                output_format, output_type, overlap_size_voxels,
-                               slice_output):
+                               slice_output, native_endian=False,
+                               max_bytes=None, num_blocks=None,
+                               descriptors_in=None, layout=LAYOUT_FLAT):
     """Compute output parameters based on a set of parameters"""
     if output_format is None:
         output_format = global_descriptor.file_format
@@ -97,7 +158,18 @@ def specify_output_descriptors(dim_order, filename_out_base, global_descriptor,
         max_block_size_voxels = -1
     if overlap_size_voxels is None:
         overlap_size_voxels = 0
-    out_msb = global_descriptor.msb
+    if max_bytes:
+        max_block_size_voxels = limit_block_size_to_bytes(
+            max_block_size_voxels, overlap_size_voxels, max_bytes,
+            output_type, global_descriptor)
+    block_size = None
+    if num_blocks:
+        block_size = plan_blocks(num_blocks, overlap_size_voxels,
+                                 global_descriptor, descriptors_in)
+    if native_endian:
+        out_msb = sys.byteorder == 'big'
+    else:
+        out_msb = global_descriptor.msb
     voxel_size = global_descriptor.voxel_size
     descriptors_out = generate_output_descriptors(
         filename_out_base=filename_out_base,
@@ -111,10 +183,61 @@ def specify_output_descriptors(dim_order, filename_out_base, global_descriptor,
         image_size=global_descriptor.size,
         msb=out_msb,
         compression=out_compression,
-        voxel_size=voxel_size)
+        voxel_size=voxel_size,
+        block_size=block_size,
+        layout=layout)
     return descriptors_out
 
 
+def limit_block_size_to_bytes(max_block_size_voxels, overlap_size_voxels,
+                              max_bytes, output_type, global_descriptor):
+    """Reduce the maximum block size so that each output block holds no more
+    than max_bytes of data of the output type. Blocks are kept whole along the
+    axes which are fastest in the input file, so that each block is read from
+    as few contiguous runs of the input as possible"""
+    num_dims = global_descriptor.num_dims
+    max_block_size_voxels = convert_to_array(max_block_size_voxels,
+                                             "block size", num_dims)
+    overlap_size_voxels = convert_to_array(overlap_size_voxels,
+                                           "overlap size", num_dims)
+    data_type = DataType(output_type, global_descriptor.msb)
+    bytes_per_voxel = data_type.template.bytes_per_voxel
+    if data_type.get_is_rgb():
+        bytes_per_voxel *= 3
+    image_size = [min(size, max_size) if max_size > 0 else size
+                  for size, max_size in
+                  zip(global_descriptor.size, max_block_size_voxels)]
+    return get_max_block_size_for_bytes(
+        image_size=image_size,
+        bytes_per_voxel=bytes_per_voxel,
+        max_bytes=max_bytes,
+        axis_order=global_descriptor.axis.dim_order,
+        overlap_size=overlap_size_voxels)
+
+
+def plan_blocks(num_blocks, overlap_size_voxels, global_descriptor,
+                descriptors_in):
+    """Return the block size which splits the image into num_blocks blocks
+    at the lowest estimated cost of reading the input files"""
+    num_dims = global_descriptor.num_dims
+    overlap_size_voxels = convert_to_array(overlap_size_voxels,
+                                           "overlap size", num_dims)
+    data_type = DataType(global_descriptor.data_type, global_descriptor.msb)
+    file_boundaries = [[] for _ in range(num_dims)]
+    if descriptors_in:
+        ranges = get_ranges_array(descriptors_in)
+        starts = ranges[:, :, 0] + ranges[:, :, 2]
+        file_boundaries = [sorted(set(starts[:, dim].tolist()) - {0})
+                           for dim in range(num_dims)]
+    return plan_block_size(
+        image_size=global_descriptor.size,
+        num_blocks=num_blocks,
+        axis_order=global_descriptor.axis.dim_order,
+        overlap_size=overlap_size_voxels,
+        bytes_per_voxel=data_type.template.bytes_per_voxel,
+        file_boundaries=file_boundaries)
+
+
 def parse_slice_output(dim_order, max_block_size_voxels, overlap_size_voxels,
                        slice_output):
     """Get output parameters for splitting into slices along axis"""
@@ -153,9 +276,40 @@ def parse_slice_output(dim_order, max_block_size_voxels, overlap_size_voxels,
     return new_dim_order, max_block_size_voxels, overlap_size_voxels
 
 
+def parse_shard(shard_string):
+    """Convert a shard string of the form i/N to a (shard_index, num_shards)
+    tuple"""
+    if not shard_string:
+        return None
+    parts = shard_string.split('/')
+    if len(parts) != 2:
+        raise ValueError('Shard must be of the form i/N, for example 2/8')
+    shard_index = int(parts[0])
+    num_shards = int(parts[1])
+    if num_shards < 1 or shard_index < 1 or shard_index > num_shards:
+        raise ValueError('Shard must be of the form i/N where 1 <= i <= N')
+    return shard_index, num_shards
+
+
+# Commands which can be run using imagesplit <command> [args]
+COMMANDS = {
+    'extract': extract_files.main,
+    'merge': merge_files.main,
+    'merge-descriptors': merge_descriptors.main,
+    'verify': verify_files.main,
+}
+
+
 def main(args=None):
     """Utility for splitting images into subimages"""
 
+    if args is None:
+        args = sys.argv[1:]
+
+    if args and args[0] in COMMANDS:
+        COMMANDS[args[0]](args[1:])
+        return
+
     parser = argparse.ArgumentParser(
         description='Splits a large file into slices or blocks with overlap')
 
@@ -179,6 +333,20 @@ def main(args=None):
                              "will be optimally split such that each file "
                              "output dimension is less than or equal to this "
                              "maximum.")
+    parser.add_argument("--max-bytes", required=False, default=None,
+                        type=parse_byte_size,
+                        help="Maximum size of the image data in each output "
+                             "file, such as 64M or 1G. The block shape is "
+                             "chosen to keep each block contiguous along the "
+                             "fastest axes of the input file. The size is "
+                             "measured before compression. Can be combined "
+                             "with --max")
+    parser.add_argument("--blocks", required=False, default=None, type=int,
+                        help="Split the image into exactly this number of "
+                             "output files. The block shape is chosen to "
+                             "minimise the estimated number of seeks and "
+                             "bytes read from the input files. This cannot be "
+                             "used with --max or --max-bytes")
     parser.add_argument("-x", "--startindex", required=False, default=None,
                         type=int,
                         help="Start index for filename suffix when loading or "
@@ -197,6 +365,21 @@ def main(args=None):
                              "values. If no values are specified, use the "
                              "volume limits.")
 
+    parser.add_argument("--rescale-percentile", nargs=2, required=False,
+                        default=None, type=float, metavar=('LOW', 'HIGH'),
+                        help="Rescale image between the values at the LOW "
+                             "and HIGH percentiles (0 to 100) of the input "
+                             "image. This cannot be used with --rescale")
+
+    parser.add_argument("--cache-histogram", action="store_true",
+                        default=False,
+                        help="Save the histogram computed for "
+                             "--rescale-percentile in a file ending "
+                             ".histogram alongside each input file, and "
+                             "reuse it in later runs until the input file "
+                             "changes. This needs write access to the input "
+                             "folder (default: no cache files are written)")
+
     parser.add_argument("-z", "--compress", nargs='?', required=False,
                         const='default', default=None, type=str,
                         help="Enables compression (default no compression). "
@@ -212,8 +395,8 @@ def main(args=None):
                              "axis. Choose 1, 2, 3 etc to select an axis "
                              "relative to the current image orientation, or "
                              "c, s, a to select an absolute orientation."
-                             "This argument cannot be used with --axis, --max "
-                             "or --overlap.")
+                             "This argument cannot be used with --axis, --max, "
+                             "--max-bytes, --blocks or --overlap.")
     parser.add_argument("-a", "--axis", nargs='+', required=False,
                         default=None, type=int,
                         help="Axis ordering (default 1 2 3). Specifies the "
@@ -228,10 +411,87 @@ def main(args=None):
                         help="Name of descriptor file (.gift) which defines "
                              "the file splitting")
 
+    parser.add_argument("--shard", required=False, default=None, type=str,
+                        help="Only write the subset of output files for this "
+                             "shard, specified as i/N where N is the total "
+                             "number of shards and i is numbered from 1. A "
+                             "partial descriptor is written for each shard; "
+                             "combine these using imagesplit "
+                             "merge-descriptors")
+
+    parser.add_argument("--layout", required=False, default=LAYOUT_FLAT,
+                        choices=LAYOUTS,
+                        help="How output files are arranged. flat (default) "
+                             "writes them all to the same folder. nested "
+                             "writes them to subfolders named by block "
+                             "coordinates, so that no folder holds a very "
+                             "large number of files")
+
+    parser.add_argument("--container", required=False,
+                        action='store_true',
+                        help="Store the output files in a single "
+                             "uncompressed tar file instead of writing "
+                             "separate files. Only for mhd output")
+
+    parser.add_argument("--compact-descriptor", required=False,
+                        action='store_true',
+                        help="Write the descriptor file in a compact format "
+                             "which loads much faster when there are very "
+                             "many output files. Older versions of "
+                             "ImageSplit cannot read this format")
+
+    parser.add_argument("--native-endian", required=False,
+                        action='store_true',
+                        help="Write output files using the byte order of "
+                             "this machine (default: same byte order as "
+                             "the input file)")
+
+    parser.add_argument("--engine", required=False, default=SYNC_ENGINE,
+                        choices=ENGINES,
+                        help="How file reading and writing is scheduled. "
+                             "sync (default) writes one output file at a "
+                             "time. async writes several output files at "
+                             "once using a pool of threads, which is faster "
+                             "on storage with high latency")
+
+    parser.add_argument("--max-in-flight", required=False, default=4,
+                        type=int,
+                        help="With --engine async, the maximum number of "
+                             "output files being written at once (default 4)")
+
+    parser.add_argument("--direct-io", required=False,
+                        action='store_true',
+                        help="Read and write files using direct I/O, "
+                             "bypassing the operating system's page cache. "
+                             "This avoids filling memory with cached data "
+                             "when splitting very large images")
+
+    parser.add_argument("--cache-policy", required=False,
+                        default=CACHE_DEFAULT, choices=CACHE_POLICIES,
+                        help="How the operating system's page cache is used. "
+                             "default leaves caching to the operating "
+                             "system. stream reads ahead in the input files "
+                             "and removes output data from the cache once "
+                             "written, so that long splits do not fill the "
+                             "cache")
+
+    parser.add_argument("--max-open-files", required=False,
+                        default=DEFAULT_MAX_OPEN_FILES, type=int,
+                        help="The maximum number of files kept open at once "
+                             "(default " + str(DEFAULT_MAX_OPEN_FILES) +
+                             "). The least recently used files are closed "
+                             "and reopened when needed")
+
+    parser.add_argument("--verbose", required=False,
+                        action='store_true',
+                        help="Print statistics about how often files had "
+                             "to be reopened once the split is complete")
+
     parser.add_argument("--test", required=False,
                         action='store_true',
-                        help="If set, No writing will be performed to the "
-                             "output files")
+                        help="If set, no image data are read or written. "
+                             "Instead, a summary of the estimated cost of "
+                             "the split is printed")
 
     version_string = get_version_string()
     parser.add_argument(
@@ -251,19 +511,30 @@ def main(args=None):
     if rescale == []:  # rescale is set on command line but not given a range
         rescale = 'limits'
 
-    if args.slice and (args.axis or args.max or args.overlap):
-        raise ValueError('Cannot use --slice with --axis, --max or --overlap')
+    block_options = args.max or args.max_bytes or args.blocks
+    if args.slice and (args.axis or args.overlap or block_options):
+        raise ValueError('Cannot use --slice with --axis, --max, --max-bytes, '
+                         '--blocks or --overlap')
+
+    if args.blocks and (args.max or args.max_bytes):
+        raise ValueError('Cannot use --blocks with --max or --max-bytes')
+
+    if args.max_open_files < 1:
+        raise ValueError('--max-open-files must be at least 1')
 
     if args.input == '_no_filename_specified':
         raise ValueError('No filename was specified')
     else:
         assert sys.version_info >= (2, 7)
+        get_handle_pool().max_open = args.max_open_files
         split_file(input_file_base=args.input,
                    filename_out_base=args.out,
                    start_index=args.startindex,
                    output_type=args.type,
                    dim_order=args.axis,
-                   file_handle_factory=FileHandleFactory(),
+                   file_handle_factory=FileHandleFactory(
+                       direct_io=args.direct_io,
+                       cache_policy=CachePolicy.from_name(args.cache_policy)),
                    output_format=args.format,
                    slice_output=args.slice,
                    rescale=rescale,
@@ -271,7 +542,20 @@ def main(args=None):
                    max_block_size_voxels=args.max,
                    overlap_size_voxels=args.overlap,
                    descriptor_filename=args.descriptor,
-                   test=args.test)
+                   test=args.test,
+                   shard=parse_shard(args.shard),
+                   native_endian=args.native_endian,
+                   rescale_percentile=args.rescale_percentile,
+                   max_bytes=args.max_bytes,
+                   num_blocks=args.blocks,
+                   engine=args.engine,
+                   max_in_flight=args.max_in_flight,
+                   layout=args.layout,
+                   container=args.container,
+                   compact_descriptor=args.compact_descriptor,
+                   cache_histogram=args.cache_histogram)
+        if args.verbose:
+            six.print_(get_handle_pool().get_summary())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Utility for checking split files against the checksums stored in their
+descriptor file
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import sys
+
+import six
+
+from imagesplit.file.file_factory import FileFactory
+from imagesplit.file.file_wrapper import FileHandleFactory, CachePolicy, \
+    CACHE_STREAM
+from imagesplit.utils.file_descriptor import load_split_descriptors
+from imagesplit.utils.parallel import parallel_map
+from imagesplit.utils.versioning import get_version_string
+
+
+def verify_files(descriptor_filename, filename_override=None,
+                 num_threads=None, file_handle_factory=None):
+    """Check each split file listed in the descriptor file against the
+    checksum stored for it. Files are checked in parallel using num_threads
+    threads. Returns a list of (filename, reason) for each file which fails"""
+
+    if file_handle_factory is None:
+        # Each file is read once, from start to end
+        file_handle_factory = FileHandleFactory(
+            cache_policy=CachePolicy.from_name(CACHE_STREAM))
+    file_factory = FileFactory(file_handle_factory)
+    descriptors = load_split_descriptors(descriptor_filename,
+                                         filename_override)
+
+    results = parallel_map(lambda descriptor: _verify_file(
+        descriptor, file_factory), descriptors, num_threads)
+    return [(descriptor.filename, reason) for descriptor, reason
+            in zip(descriptors, results) if reason]
+
+
+def _verify_file(descriptor, file_factory):
+    """Return the reason this file failed verification, or None if the
+    data match the checksum"""
+
+    if not descriptor.checksum:
+        return 'No checksum in descriptor'
+    try:
+        read_file = file_factory.create_read_file(descriptor)
+        try:
+            checksum = read_file.compute_checksum()
+        finally:
+            read_file.close_file()
+    except (IOError, OSError, ValueError) as error:
+        return 'Cannot read file: ' + str(error)
+    if checksum != descriptor.checksum:
+        return 'Checksum ' + checksum + ' does not match ' + \
+            descriptor.checksum
+    return None
+
+
+def main(args=None):
+    """Check split files against the checksums in their descriptor file"""
+
+    parser = argparse.ArgumentParser(
+        prog='imagesplit verify',
+        description='Checks that the data in each split file match the '
+                    'checksum stored in the descriptor file')
+
+    parser.add_argument("descriptor",
+                        help="Descriptor file (.imagesplit) written by the "
+                             "split")
+    parser.add_argument("-i", "--input", required=False, default=None,
+                        help="Filename prefix of the split files, if they "
+                             "have been moved or renamed since the "
+                             "descriptor was written")
+    parser.add_argument("-j", "--threads", required=False, default=None,
+                        type=int,
+                        help="Number of files to check at once (default: "
+                             "a few more than the number of CPUs)")
+
+    version_string = get_version_string()
+    parser.add_argument(
+        "-v", "--version",
+        action='version',
+        version=version_string)
+
+    args = parser.parse_args(args)
+
+    failures = verify_files(args.descriptor, args.input, args.threads)
+    for filename, reason in failures:
+        six.print_(filename + ": " + reason)
+    if failures:
+        six.print_(str(len(failures)) + " files failed verification")
+        sys.exit(1)
+    six.print_("All files verified")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,16 +6,51 @@ Author: Tom Doel
 Copyright UCL 2017
 
 """
-from imagesplit.image.combined_image import CombinedImage
+import six
+
+from imagesplit.image.combined_image import CombinedImage, Percentiles, \
+    HALO_CACHE_BYTES
+from imagesplit.utils.async_engine import AsyncEngine
+from imagesplit.utils.split_plan import estimate_split_plan
+
+# Ways of scheduling the reading and writing of files
+SYNC_ENGINE = 'sync'
+ASYNC_ENGINE = 'async'
+ENGINES = [SYNC_ENGINE, ASYNC_ENGINE]
 
 
 def write_files(descriptors_in, descriptors_out, file_factory, rescale,
-                test=False):
-    """Creates a set of output files from the input files"""
+                test=False, engine=SYNC_ENGINE, max_in_flight=4):
+    """Creates a set of output files from the input files.
+
+    With the sync engine, one output file is written at a time. With the
+    async engine, up to max_in_flight output files are written at once, each
+    reading from its input files, so that slow storage is kept busy.
+
+    If test is True, no image data are read or written; instead a summary of
+    the estimated cost of writing the files is printed"""
+
+    if engine == SYNC_ENGINE:
+        write_engine = None
+    elif engine == ASYNC_ENGINE:
+        write_engine = AsyncEngine(max_in_flight=max_in_flight)
+    else:
+        raise ValueError('Unknown engine ' + str(engine))
+
+    if test:
+        plan = estimate_split_plan(
+            descriptors_in, descriptors_out,
+            rescale_pass=rescale == "limits" or
+            isinstance(rescale, Percentiles),
+            rescale=bool(rescale),
+            concurrency=max_in_flight if write_engine else 1,
+            halo_cache_bytes=0 if write_engine else HALO_CACHE_BYTES)
+        six.print_(plan.get_summary())
+        return
 
     input_combined = CombinedImage(descriptors_in, file_factory)
     output_combined = CombinedImage(descriptors_out, file_factory)
-    output_combined.write_image(input_combined, rescale, test)
+    output_combined.write_image(input_combined, rescale, False, write_engine)
 
     input_combined.close()
     output_combined.close()
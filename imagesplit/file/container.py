@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Store split image files in a single uncompressed tar container file, so that
+many small files can be written, archived and transferred as one file
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+import os
+import tarfile
+import time
+
+import numpy as np
+
+from imagesplit.file.file_formats import FileFormats
+from imagesplit.file.file_wrapper import call_in_folder
+from imagesplit.file.format_factory import FormatFactory
+from imagesplit.file.metaio_reader import MetaIoFile, get_mhd_header_text, \
+    get_raw_filename
+from imagesplit.utils.utilities import compute_bytes_per_voxel
+
+# Extension of container files
+CONTAINER_EXTENSION = '.tar'
+
+# The image data of each file start at a multiple of this number of bytes
+# within the container, which allows aligned and direct I/O
+DATA_ALIGNMENT = 4096
+
+_TAR_BLOCK = tarfile.BLOCKSIZE
+
+
+def create_container(container_filename, descriptors, test=False):
+    """Create a tar file containing, for each of the output descriptors, a
+    mhd header and space for its raw data, which is written later.
+
+    The container and the offset of the raw data within it are stored in
+    each descriptor. Member names are relative to the container's folder.
+    If test is True, the offsets are set but the file is not written"""
+
+    container_folder = os.path.dirname(container_filename)
+    offset = 0
+    parts = []
+    for descriptor in descriptors:
+        if FormatFactory.simplify_format(descriptor.file_format) != \
+                FileFormats.METAIO_FORMAT:
+            raise ValueError('Only mhd files can be stored in a container')
+
+        header = MetaIoFile.create_write_header(descriptor)
+        header['ElementDataFile'] = get_raw_filename(descriptor.filename)
+        header_text = get_mhd_header_text(header).encode('utf-8')
+        header_name = _member_name(descriptor.filename, container_folder)
+        raw_name = _member_name(os.path.join(
+            os.path.dirname(descriptor.filename), header['ElementDataFile']),
+                                container_folder)
+        raw_size = int(np.prod(descriptor.get_local_size())) * \
+            compute_bytes_per_voxel(header['ElementType'])
+
+        raw_info = _tar_header(raw_name, raw_size)
+        header_info = _tar_header(header_name, 0)
+
+        # Pad the header text with newlines so the raw data are aligned
+        data_start = offset + len(header_info) + \
+            _round_up(len(header_text), _TAR_BLOCK) + len(raw_info)
+        header_text += b'\n' * (_round_up(len(header_text), _TAR_BLOCK) -
+                                len(header_text) +
+                                (-data_start) % DATA_ALIGNMENT)
+        data_start = offset + len(header_info) + len(header_text) + \
+            len(raw_info)
+
+        parts.append((offset, _tar_header(header_name, len(header_text)) +
+                      header_text + raw_info))
+        descriptor.container = container_filename
+        descriptor.offset = data_start
+        offset = data_start + _round_up(raw_size, _TAR_BLOCK)
+
+    # A tar file ends with two empty blocks
+    end = offset + 2 * _TAR_BLOCK
+
+    if not test:
+        call_in_folder(container_filename,
+                       lambda: _write_parts(container_filename, parts, end))
+
+
+class ContainerMetaIoFile(MetaIoFile):
+    """A MetaIO image stored in a container created by create_container().
+    The header is formed from the descriptor, and the raw data are read and
+    written directly at their offset in the container"""
+
+    def __init__(self, subimage_descriptor, file_handle_factory,
+                 header_template):
+        self._descriptor = subimage_descriptor
+        super(ContainerMetaIoFile, self).__init__(
+            subimage_descriptor.get_local_size(), subimage_descriptor.filename,
+            file_handle_factory, header_template)
+        self._data_offset = subimage_descriptor.offset
+        if header_template:
+            # The container already exists, so must not be truncated
+            self._mode = 'r+b'
+
+    @classmethod
+    def create_read_file(cls, subimage_descriptor, file_handle_factory):
+        """Create a ContainerMetaIoFile for reading"""
+        return cls(subimage_descriptor, file_handle_factory, None)
+
+    @classmethod
+    def create_write_file(cls, subimage_descriptor, file_handle_factory):
+        """Create a ContainerMetaIoFile for writing"""
+        return cls(subimage_descriptor, file_handle_factory,
+                   cls.create_write_header(subimage_descriptor))
+
+    def _load_header(self, header_filename):
+        header = self.create_write_header(self._descriptor)
+        header['ElementDataFile'] = get_raw_filename(header_filename)
+        return header
+
+    def _save_header(self, header_filename, header):
+        # The header was written when the container was created
+        pass
+
+    def _get_raw_data_path(self):
+        return self._descriptor.container
+
+
+def _write_parts(container_filename, parts, size):
+    """Write the headers to the container. The space left for raw data is
+    not written, so on most file systems it takes no space until it is"""
+    with open(container_filename, 'wb') as container_file:
+        for offset, data in parts:
+            container_file.seek(offset)
+            container_file.write(data)
+        container_file.truncate(size)
+
+
+def _tar_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'strict')
+
+
+def _member_name(filename, container_folder):
+    return os.path.relpath(filename, container_folder or os.curdir).replace(
+        os.sep, '/')
+
+
+def _round_up(value, multiple):
+    return value + (-value) % multiple
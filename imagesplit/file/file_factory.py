@@ -1,5 +1,6 @@
 # coding=utf-8
 """Factory for creating file objects fod different file types"""
+from imagesplit.file.container import ContainerMetaIoFile
 from imagesplit.file.format_factory import FormatFactory
 
 
@@ -12,13 +13,17 @@ class FileFactory(object):
     def create_read_file(self, subimage_descriptor):
         """Create a class for reading"""
 
-        return FormatFactory.get_factory(
-            subimage_descriptor.file_format).create_read_file(
-                subimage_descriptor, self._file_handle_factory)
+        return self._get_factory(subimage_descriptor).create_read_file(
+            subimage_descriptor, self._file_handle_factory)
 
     def create_write_file(self, subimage_descriptor):
         """Create a class for writing"""
 
-        return FormatFactory.get_factory(
-            subimage_descriptor.file_format).create_write_file(
-                subimage_descriptor, self._file_handle_factory)
+        return self._get_factory(subimage_descriptor).create_write_file(
+            subimage_descriptor, self._file_handle_factory)
+
+    @staticmethod
+    def _get_factory(subimage_descriptor):
+        if subimage_descriptor.container:
+            return ContainerMetaIoFile
+        return FormatFactory.get_factory(subimage_descriptor.file_format)
@@ -9,36 +9,80 @@ Copyright UCL 2017
 
 """
 
+import errno
+import io
+import mmap
 import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import numpy as np
 
-from imagesplit.utils.utilities import file_linear_byte_offset, rescale_image
+from imagesplit.utils.checksum import RunningChecksum, compute_checksum
+from imagesplit.utils.utilities import file_linear_byte_offset, \
+    Rescaler, convert_data_type
+
+# Maximum number of bytes held in memory when copying without kernel support
+COPY_CHUNK_BYTES = 16 * 1024 * 1024
+
+# With direct I/O, file offsets and transfer sizes are multiples of this
+DIRECT_IO_BLOCK_BYTES = 4096
+
+# With direct I/O, the number of bytes read or written in each transfer
+DIRECT_IO_BUFFER_BYTES = 8 * 1024 * 1024
+
+# Page cache policies: default leaves caching to the operating system, while
+# stream reads ahead and drops written data from the cache
+CACHE_DEFAULT = 'default'
+CACHE_STREAM = 'stream'
+CACHE_POLICIES = [CACHE_DEFAULT, CACHE_STREAM]
+
+# Default maximum number of files kept open at once by a FileHandlePool
+DEFAULT_MAX_OPEN_FILES = 256
 
 
 class FileStreamer(object):
-    """Handle streaming of image data with arbitrarily large files"""
+    """Handle streaming of image data with arbitrarily large files. The image
+    data start data_offset bytes into the file.
+
+    A checksum of the image data is computed as they are written"""
+
+    # pylint: disable=too-many-instance-attributes
 
     def __init__(self, file_wrapper, image_size, bytes_per_voxel, numpy_format,
-                 dimension_ordering):
+                 dimension_ordering, data_offset=0):
         self._bytes_per_voxel = bytes_per_voxel
+        self._data_offset = data_offset
         self._image_size = image_size
         self._file_wrapper = file_wrapper
         self._numpy_format = numpy_format
         self._dimension_ordering = dimension_ordering
+        self._rescaler = None
+        self._rescale_limits = None
+        self._checksum = RunningChecksum()
+
+    def get_image_size(self):
+        """Return the size of the image stored in this file"""
+        return self._image_size
+
+    def get_numpy_format(self):
+        """Return the numpy data format of voxels stored in this file"""
+        return self._numpy_format
+
+    def get_byte_offset(self, coords):
+        """Return the byte offset in the file of the voxel at coords"""
+        return self._data_offset + file_linear_byte_offset(
+            self._image_size, self._bytes_per_voxel, coords)
 
     def read_line(self, start_coords, num_voxels):
         """Read a line of image data from a binary file at the specified
         image location """
 
-        offset = file_linear_byte_offset(self._image_size,
-                                         self._bytes_per_voxel,
-                                         start_coords)
-        self._file_wrapper.get_handle().seek(offset)
-
+        offset = self.get_byte_offset(start_coords)
         data_type = np.dtype(self._numpy_format)
-        bytes_array = self._file_wrapper.get_handle().read(
-            num_voxels * self._bytes_per_voxel)
+        bytes_array = self._file_wrapper.read(
+            offset, num_voxels * self._bytes_per_voxel)
 
         return np.frombuffer(bytes_array, dtype=data_type)
 
@@ -46,72 +90,796 @@ class FileStreamer(object):
         """Write a line of image data to a binary file at the specified image
         location """
 
-        offset = file_linear_byte_offset(self._image_size,
-                                         self._bytes_per_voxel,
-                                         start_coords)
-        self._file_wrapper.get_handle().seek(offset)
+        self._write(start_coords, image_line, rescale_limits, in_place=False)
 
+    def write_lines(self, start_coords, image_lines, rescale_limits):
+        """Write consecutive lines of image data to a binary file starting at
+        the specified image location. To avoid allocating a new array when
+        only the byte order must change, image_lines may be overwritten"""
+
+        self._write(start_coords, image_lines, rescale_limits, in_place=True)
+
+    def _write(self, start_coords, image, rescale_limits, in_place):
+        offset = self.get_byte_offset(start_coords)
         data_type = np.dtype(self._numpy_format)
 
         if rescale_limits:
-            image_line = rescale_image(data_type, image_line,
-                                       rescale_limits)
-
-        self._file_wrapper.get_handle().write(
-            image_line.astype(data_type).tobytes())
+            image = self._get_rescaler(rescale_limits).rescale(image)
+
+        data = convert_data_type(image, data_type, in_place=in_place)
+        self._file_wrapper.write(offset, data)
+        self._update_checksum(offset, data)
+
+    def _get_rescaler(self, rescale_limits):
+        # The rescale mapping is computed once for each file
+        if self._rescale_limits is not rescale_limits:
+            self._rescaler = Rescaler(self._numpy_format, rescale_limits)
+            self._rescale_limits = rescale_limits
+        return self._rescaler
+
+    def copy_from(self, source_streamer, source_coords, start_coords,
+                  num_voxels):
+        """Copy consecutive voxels from another file to the specified image
+        location without any conversion. Both files must use the same
+        numpy data format"""
+
+        num_bytes = num_voxels * self._bytes_per_voxel
+        source_wrapper = source_streamer.get_file_wrapper()
+        dest_offset = self.get_byte_offset(start_coords)
+
+        # While the data are being written in order, they are copied through
+        # this process so they can be added to the checksum. Otherwise the
+        # checksum is computed when the file is complete, so the kernel can
+        # copy the data directly
+        if self._checksum.is_next(dest_offset - self._data_offset):
+            on_copied = self._update_checksum
+        else:
+            self._checksum.invalidate()
+            on_copied = None
+
+        with source_wrapper.use_handle() as source_handle, \
+                self._file_wrapper.use_handle() as dest_handle:
+            copy_file_bytes(
+                source_handle=source_handle,
+                source_offset=source_streamer.get_byte_offset(source_coords),
+                dest_handle=dest_handle,
+                dest_offset=dest_offset,
+                num_bytes=num_bytes,
+                on_copied=on_copied)
+
+    def _update_checksum(self, offset, data):
+        """Add data written at this byte offset in the file to the
+        checksum"""
+        self._checksum.update(offset - self._data_offset, data)
+
+    def get_written_checksum(self):
+        """Return the checksum of the image data. This is computed from the
+        data as they were written if they were written in order, otherwise
+        the data are read back from the file"""
+        checksum = self._checksum.get_checksum(self._get_num_bytes())
+        if not checksum:
+            # A file opened for writing is reopened for update, which allows
+            # reading
+            self._file_wrapper.close()
+            checksum = self.compute_checksum()
+        return checksum
+
+    def compute_checksum(self):
+        """Read the image data from the file and return their checksum"""
+        return compute_checksum(
+            lambda offset, num_bytes: self._file_wrapper.read(
+                self._data_offset + offset, num_bytes),
+            self._get_num_bytes())
+
+    def _get_num_bytes(self):
+        return int(np.prod(self._image_size)) * self._bytes_per_voxel
+
+    def get_file_wrapper(self):
+        """Return the FileWrapper for the file being streamed"""
+        return self._file_wrapper
 
     def close(self):
         """Close any files that have been opened."""
         self._file_wrapper.close()
 
 
+def copy_file_bytes(source_handle, source_offset, dest_handle, dest_offset,
+                    num_bytes, on_copied=None):
+    """Copy a range of bytes from one file to another.
+
+    Where the operating system supports it, the data are copied between the
+    files by the kernel (copy_file_range or sendfile) without passing through
+    user memory. Otherwise the data are copied in chunks using read and write.
+    If on_copied is specified, the data are always copied in chunks, and
+    on_copied(dest_offset, data) is called for each chunk
+    """
+
+    source_fd = _get_os_file_descriptor(source_handle)
+    dest_fd = _get_os_file_descriptor(dest_handle)
+
+    if on_copied is None and source_fd is not None and dest_fd is not None:
+        # Any data buffered in the file object must reach the file first
+        dest_handle.flush()
+        copied = _copy_fd_range(source_fd, source_offset, dest_fd,
+                                dest_offset, num_bytes)
+        source_offset += copied
+        dest_offset += copied
+        num_bytes -= copied
+
+    while num_bytes > 0:
+        source_handle.seek(source_offset)
+        data = source_handle.read(min(num_bytes, COPY_CHUNK_BYTES))
+        if not data:
+            raise ValueError("Unexpected end of file when copying data")
+        dest_handle.seek(dest_offset)
+        dest_handle.write(data)
+        if on_copied:
+            on_copied(dest_offset, data)
+        source_offset += len(data)
+        dest_offset += len(data)
+        num_bytes -= len(data)
+
+
+def _get_os_file_descriptor(handle):
+    """Return the operating system file descriptor for a file object, or None
+    if it is not a regular file opened by the operating system"""
+
+    if not isinstance(handle, (io.FileIO, io.BufferedReader,
+                               io.BufferedWriter, io.BufferedRandom)):
+        return None
+    try:
+        return handle.fileno()
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _copy_fd_range(source_fd, source_offset, dest_fd, dest_offset, num_bytes):
+    """Copy bytes between file descriptors using the kernel, returning the
+    number of bytes copied, which will be less than num_bytes if the kernel
+    does not support the copy"""
+
+    copied = 0
+    for copy_method in (_copy_file_range, _sendfile):
+        try:
+            while copied < num_bytes:
+                count = copy_method(source_fd, source_offset + copied,
+                                    dest_fd, dest_offset + copied,
+                                    num_bytes - copied)
+                if count <= 0:
+                    return copied
+                copied += count
+            return copied
+        except (AttributeError, OSError):
+            # Not available, or not supported for these files (eg across
+            # file systems), so try the next method
+            pass
+    return copied
+
+
+def _copy_file_range(source_fd, source_offset, dest_fd, dest_offset,
+                     num_bytes):
+    return os.copy_file_range(source_fd, dest_fd, num_bytes,
+                              source_offset, dest_offset)
+
+
+def _sendfile(source_fd, source_offset, dest_fd, dest_offset, num_bytes):
+    os.lseek(dest_fd, dest_offset, os.SEEK_SET)
+    return os.sendfile(dest_fd, source_fd, source_offset, num_bytes)
+
+
 class FileWrapper(object):
-    """Read or write to arbitrarily large files."""
+    """Read or write to arbitrarily large files.
 
-    def __init__(self, name, file_handle_factory, mode):
+    The file is opened when first used, and is kept open by a FileHandlePool
+    (by default, the pool shared by the whole process), which may close it
+    when other files are opened. It is then reopened when next used. A file
+    opened for writing is reopened for update, so data already written are
+    kept.
+
+    If the file handle factory has a cache_policy, the operating system is
+    given hints about how the file's data should be cached"""
+
+    def __init__(self, name, file_handle_factory, mode, handle_pool=None):
         self._file_handle_factory = file_handle_factory
         self._filename = name
         self._mode = mode
         self._file_handle = None
+        self._handle_pool = handle_pool or get_handle_pool()
+        self._cache_policy = getattr(file_handle_factory, 'cache_policy',
+                                     None)
+        self._cache_hints = None
 
     def __del__(self):
-        self.close()
+        try:
+            self.close()
+        except Exception:  # pylint: disable=broad-except
+            # The file may belong to a file system which has since gone, for
+            # example at interpreter exit
+            pass
 
     def __enter__(self):
-        self.open()
-        return self._file_handle
+        return self._handle_pool.acquire(self)
 
     def __exit__(self, exit_type, value, traceback):
         self.close()
 
-    def get_handle(self):
-        """Returns the file handle, opening if necessary"""
-        if not self._file_handle:
-            self.open()
-        return self._file_handle
+    @contextmanager
+    def use_handle(self):
+        """Context manager giving the file handle, which is kept open until
+        the context exits. The handle must not be used after this, because
+        the pool may close it when other files are opened"""
+        handle = self._handle_pool.acquire(self)
+        try:
+            yield handle
+        finally:
+            self._handle_pool.release(self)
 
     def open(self):
-        """Opens the file"""
-        self._file_handle = self._file_handle_factory.create_file_handle(
-            self._filename, self._mode)
+        """Opens the file. The pool may close it again when other files are
+        opened, in which case it is reopened when next used"""
+        with self.use_handle():
+            pass
+
+    def read(self, offset, num_bytes):
+        """Read num_bytes bytes starting at the byte offset"""
+        with self.use_handle() as handle:
+            if self._cache_hints:
+                self._cache_hints.read(offset, num_bytes)
+            handle.seek(offset)
+            return handle.read(num_bytes)
+
+    def write(self, offset, data):
+        """Write the data starting at the byte offset"""
+        with self.use_handle() as handle:
+            handle.seek(offset)
+            handle.write(data)
+            if self._cache_hints:
+                self._cache_hints.written(offset,
+                                          getattr(data, 'nbytes', len(data)))
 
     def close(self):
         """Close the file"""
-        if self._file_handle and not self._file_handle.closed:
-            self._file_handle.close()
-            self._file_handle = None
+        if self._handle_pool:
+            self._handle_pool.discard(self)
+        self.close_handle()
+
+    def open_handle(self):
+        """Open the file handle. Called by the FileHandlePool"""
+        self._file_handle = self._file_handle_factory.create_file_handle(
+            self._filename, self._mode)
+        if self._cache_policy:
+            self._cache_hints = self._cache_policy.create_hints(
+                self._file_handle, self._mode)
+
+        # Reopening must not truncate the data written so far
+        self._mode = self._mode.replace('w', 'r+')
+        return self._file_handle
+
+    def close_handle(self):
+        """Close the file handle. Called by the FileHandlePool"""
+        file_handle = self._file_handle
+        self._file_handle = None
+        if file_handle and not file_handle.closed:
+            if self._cache_hints:
+                self._cache_hints.close()
+                self._cache_hints = None
+            file_handle.close()
+
+
+class FileHandlePool(object):
+    """Limits the number of files open at once. FileWrappers acquire their
+    file handles from the pool, which opens the file if necessary. Once
+    max_open files are open, the least recently used file which is not in
+    use is closed.
+
+    Files are opened and closed without holding the pool's lock, so that
+    threads using different files do not wait for each other. A thread
+    acquiring a file which another thread is opening or closing waits for
+    this to finish"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_FILES):
+        self.max_open = max_open
+        self._open_files = OrderedDict()
+        self._in_use = {}
+        self._pending = {}
+        self._num_opening = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def acquire(self, file_wrapper):
+        """Return the open handle for the FileWrapper, opening it if it is
+        not already open. The handle is kept open until release() is
+        called"""
+
+        while True:
+            with self._lock:
+                pending = self._pending.get(file_wrapper)
+                if pending is None:
+                    self._in_use[file_wrapper] = \
+                        self._in_use.get(file_wrapper, 0) + 1
+                    handle = self._open_files.pop(file_wrapper, None)
+                    if handle is not None and not handle.closed:
+                        self._hits += 1
+
+                        # The most recently used file is last
+                        self._open_files[file_wrapper] = handle
+                        return handle
+
+                    # Reserve a slot for this file, and choose which files
+                    # to close to make room for it
+                    self._misses += 1
+                    self._num_opening += 1
+                    unused = self._remove_unused(self.max_open)
+                    pending = threading.Event()
+                    for wrapper in [file_wrapper] + unused:
+                        self._pending[wrapper] = pending
+                    break
+
+            # Another thread is opening or closing this file
+            pending.wait()
+
+        handle = None
+        try:
+            for wrapper in unused:
+                wrapper.close_handle()
+            handle = file_wrapper.open_handle()
+        finally:
+            with self._lock:
+                self._num_opening -= 1
+                for wrapper in [file_wrapper] + unused:
+                    self._pending.pop(wrapper, None)
+                if handle is None:
+                    self._release(file_wrapper)
+                else:
+                    self._open_files[file_wrapper] = handle
+            pending.set()
+        return handle
+
+    def release(self, file_wrapper):
+        """Allow the file to be closed once it is the least recently used"""
+        with self._lock:
+            self._release(file_wrapper)
+
+    def discard(self, file_wrapper):
+        """Remove the FileWrapper from the pool, when it is closed"""
+        with self._lock:
+            self._open_files.pop(file_wrapper, None)
+            self._in_use.pop(file_wrapper, None)
+
+    def close_all(self):
+        """Close all the files which are open and not in use"""
+        with self._lock:
+            unused = [file_wrapper for file_wrapper in self._open_files
+                      if file_wrapper not in self._in_use]
+            for file_wrapper in unused:
+                del self._open_files[file_wrapper]
+        for file_wrapper in unused:
+            file_wrapper.close_handle()
+
+    def get_stats(self):
+        """Return a dictionary of the number of handle requests which found
+        the file already open (hits), which required the file to be opened
+        (misses), and the number of files closed to stay within max_open
+        (evictions)"""
+        with self._lock:
+            requests = self._hits + self._misses
+            return {'open': len(self._open_files),
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'hit_rate': float(self._hits) / requests if requests
+                                else 0.0}
+
+    def get_summary(self):
+        """Return a one line description of the pool's statistics"""
+        stats = self.get_stats()
+        return "File handles: {0} requests, hit rate {1:.1%}, {2} opened, " \
+               "{3} closed to keep within {4} open files".format(
+                   stats['hits'] + stats['misses'], stats['hit_rate'],
+                   stats['misses'], stats['evictions'], self.max_open)
+
+    def _release(self, file_wrapper):
+        count = self._in_use.pop(file_wrapper, 0) - 1
+        if count > 0:
+            self._in_use[file_wrapper] = count
+
+    def _remove_unused(self, max_open):
+        """Remove the least recently used files which are not in use from the
+        pool until no more than max_open files are open or being opened, and
+        return them so they can be closed"""
+        unused = []
+        for file_wrapper in list(self._open_files):
+            if len(self._open_files) + self._num_opening <= max(max_open, 1):
+                break
+            if file_wrapper not in self._in_use:
+                del self._open_files[file_wrapper]
+                unused.append(file_wrapper)
+                self._evictions += 1
+        return unused
+
+
+_HANDLE_POOL = FileHandlePool()
+
+# Folders which are known to exist
+_CREATED_FOLDERS = set()
+
+
+def get_handle_pool():
+    """Return the FileHandlePool shared by the whole process"""
+    return _HANDLE_POOL
+
+
+def create_folder(folder, recheck=False):
+    """Create the folder and its parents if they do not exist. Each folder is
+    only checked once, unless recheck is True"""
+    if not folder or (folder in _CREATED_FOLDERS and not recheck):
+        return
+    try:
+        os.makedirs(folder)
+    except OSError:
+        # The folder may already exist, or have been created by another
+        # thread
+        if not os.path.isdir(folder):
+            raise
+    _CREATED_FOLDERS.add(folder)
+
+
+def call_in_folder(filename, function):
+    """Create the folder for the file if necessary, and return the result of
+    function, which creates the file"""
+    folder = os.path.dirname(filename)
+    create_folder(folder)
+    try:
+        return function()
+    except (IOError, OSError) as error:
+        if error.errno != errno.ENOENT or not folder:
+            raise
+        # The folder has been removed since it was created
+        create_folder(folder, recheck=True)
+        return function()
 
 
 class FileHandleFactory(object):
-    """Creates file handles, allowing for abstraction to virtual files"""
-
-    def __init__(self):
-        pass
-
-    @staticmethod
-    def create_file_handle(filename, mode):
-        """Create and open a real file with this path and file access mode"""
-        folder = os.path.dirname(filename)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        return open(filename, mode)
+    """Creates file handles, allowing for abstraction to virtual files.
+
+    If direct_io is True, files are read and written using DirectFileHandle,
+    which bypasses the operating system's page cache. Otherwise cache_policy
+    optionally specifies a CachePolicy for the files"""
+
+    def __init__(self, direct_io=False, cache_policy=None):
+        self._direct_io = direct_io
+        self.cache_policy = cache_policy
+
+    def create_file_handle(self, filename, mode):
+        """Create and open a real file with this path and file access mode.
+        If the file is opened for writing, its folder is created if
+        necessary"""
+        if self._direct_io:
+            open_function = DirectFileHandle
+        else:
+            open_function = open
+        if 'r' in mode and '+' not in mode:
+            return open_function(filename, mode)
+        return call_in_folder(filename, lambda: open_function(filename, mode))
+
+
+class DirectFileHandle(object):
+    """Binary file object which reads and writes using direct I/O (O_DIRECT),
+    so that data pass between the disk and an aligned buffer without being
+    kept in the operating system's page cache.
+
+    All transfers start at a multiple of block_size bytes and are a multiple
+    of block_size long. Reads and writes of any size and position are
+    gathered in a buffer of buffer_size bytes. Where a write starts or ends
+    part way through a block, the rest of the block is first read from the
+    file, and the file is truncated after writing so its length is exact.
+    If the file system does not support direct I/O, the file is opened
+    normally but transfers are still aligned"""
+
+    def __init__(self, filename, mode, block_size=DIRECT_IO_BLOCK_BYTES,
+                 buffer_size=DIRECT_IO_BUFFER_BYTES):
+        if not hasattr(os, 'preadv'):
+            raise ValueError('Direct I/O requires Python 3.7 or later on '
+                             'Linux or BSD')
+        flags = {'rb': os.O_RDONLY,
+                 'wb': os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                 'r+b': os.O_RDWR}.get(mode)
+        if flags is None:
+            raise ValueError('Direct I/O does not support file mode ' + mode)
+        if buffer_size % block_size:
+            raise ValueError('The buffer size must be a multiple of the '
+                             'block size')
+
+        self._fd = _open_direct(filename, flags)
+        self._block_size = block_size
+
+        # mmap allocates memory aligned to a page boundary
+        self._buffer = mmap.mmap(-1, buffer_size)
+
+        self._size = os.fstat(self._fd).st_size
+        self._disk_size = self._size
+        self._position = 0
+
+        # The buffer holds the file from _window_start. Bytes before _loaded
+        # match the file, and the buffer range _dirty, if any, has been
+        # written but not yet transferred to the file
+        self._window_start = 0
+        self._loaded = 0
+        self._dirty = None
+        self.closed = False
+
+    def fileno(self):
+        """Return the operating system file descriptor"""
+        return self._fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move to a new file position"""
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        """Return the current file position"""
+        return self._position
+
+    def read(self, size=-1):
+        """Read up to size bytes from the current position, or to the end of
+        the file if size is negative"""
+
+        self.flush()
+        available = max(0, self._size - self._position)
+        size = available if size is None or size < 0 else \
+            min(size, available)
+        data = bytearray(size)
+        done = 0
+        while done < size:
+            offset = self._position + done - self._window_start
+            if not 0 <= offset < self._loaded:
+                self._load(self._position + done)
+                offset = self._position + done - self._window_start
+                if offset >= self._loaded:
+                    break
+            count = min(size - done, self._loaded - offset)
+            with memoryview(self._buffer) as view:
+                data[done:done + count] = view[offset:offset + count]
+            done += count
+        self._position += done
+        return bytes(data[:done])
+
+    def write(self, data):
+        """Write data at the current position"""
+
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+        data = memoryview(data).cast('B')
+        done = 0
+        while done < len(data):
+            offset = self._position + done - self._window_start
+            if not 0 <= offset < len(self._buffer):
+                self.flush()
+                self._window_start = self._align_down(self._position + done)
+                self._loaded = 0
+                offset = self._position + done - self._window_start
+            elif self._dirty and \
+                    not self._dirty[0] <= offset <= self._dirty[1]:
+                # Only one contiguous range is buffered at a time
+                self.flush()
+            count = min(len(data) - done, len(self._buffer) - offset)
+            self._buffer[offset:offset + count] = data[done:done + count]
+            if self._dirty:
+                self._dirty[1] = max(self._dirty[1], offset + count)
+            else:
+                self._dirty = [offset, offset + count]
+            done += count
+        self._position += done
+        self._size = max(self._size, self._position)
+        return done
+
+    def flush(self):
+        """Transfer any buffered writes to the file"""
+
+        if not self._dirty:
+            return
+        dirty_start, dirty_end = self._dirty
+        self._dirty = None
+
+        start = self._align_down(dirty_start)
+        end = self._align_up(dirty_end)
+
+        # Fill in the parts of the first and last blocks which are not being
+        # written, so that existing data in the file are preserved
+        if start < dirty_start and dirty_start > self._loaded:
+            self._fill_from_file(start, start, dirty_start)
+        if end > dirty_end and end > self._loaded:
+            self._fill_from_file(end - self._block_size, dirty_end, end)
+
+        with memoryview(self._buffer) as view:
+            os.pwritev(self._fd, [view[start:end]], self._window_start + start)
+        if start <= self._loaded:
+            self._loaded = max(self._loaded, end)
+
+        self._disk_size = max(self._disk_size,
+                              self._window_start + dirty_end)
+        if self._window_start + end > self._disk_size:
+            os.ftruncate(self._fd, self._disk_size)
+
+    def close(self):
+        """Write any buffered data and close the file"""
+
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            os.close(self._fd)
+            self._buffer.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exit_type, value, traceback):
+        self.close()
+
+    def _load(self, position):
+        """Read the buffer from the file, starting at the block containing
+        position"""
+
+        self._window_start = self._align_down(position)
+        self._loaded = os.preadv(self._fd, [self._buffer],
+                                 self._window_start)
+
+    def _fill_from_file(self, block_start, fill_start, fill_end):
+        """Copy bytes fill_start to fill_end of the buffer from the file,
+        reading the whole block which starts at block_start. Bytes beyond the
+        end of the file are set to zero"""
+
+        count = 0
+        block = mmap.mmap(-1, self._block_size)
+        if self._window_start + block_start < self._disk_size:
+            count = os.preadv(self._fd, [block],
+                              self._window_start + block_start)
+        copy_end = min(max(count + block_start, fill_start), fill_end)
+        self._buffer[fill_start:copy_end] = \
+            block[fill_start - block_start:copy_end - block_start]
+        self._buffer[copy_end:fill_end] = bytes(fill_end - copy_end)
+        block.close()
+
+    def _align_down(self, offset):
+        return offset - offset % self._block_size
+
+    def _align_up(self, offset):
+        return self._align_down(offset + self._block_size - 1)
+
+
+class CachePolicy(object):
+    """Hints to the operating system how the page cache should be used for
+    each file, using posix_fadvise.
+
+    If sequential is True, files being read are marked as read sequentially,
+    which increases the kernel's readahead. If readahead_bytes is not zero,
+    each read also asks the kernel to start loading the next readahead_bytes
+    of the file. If drop_behind_bytes is not zero, data written to a file are
+    removed from the page cache in chunks of this size once they have been
+    written to disk, and the rest are removed when the file is closed, so
+    that output files do not fill the page cache. On systems without
+    posix_fadvise, no hints are given"""
+
+    def __init__(self, sequential=True, readahead_bytes=8 * 1024 * 1024,
+                 drop_behind_bytes=64 * 1024 * 1024):
+        self.sequential = sequential
+        self.readahead_bytes = readahead_bytes
+        self.drop_behind_bytes = drop_behind_bytes
+
+    @classmethod
+    def from_name(cls, name):
+        """Return the policy for one of CACHE_POLICIES, or None for the
+        operating system default"""
+        if name in (None, CACHE_DEFAULT):
+            return None
+        if name == CACHE_STREAM:
+            return cls()
+        raise ValueError('Unknown cache policy ' + str(name))
+
+    def create_hints(self, handle, mode):
+        """Return a _CacheHints which gives hints for this open file handle,
+        or None if hints cannot be given"""
+
+        if not hasattr(os, 'posix_fadvise'):
+            return None
+        try:
+            file_descriptor = handle.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        return _CacheHints(self, handle, file_descriptor, mode)
+
+
+class _CacheHints(object):
+    """Gives posix_fadvise hints for one open file, following a CachePolicy"""
+
+    def __init__(self, policy, handle, file_descriptor, mode):
+        self._policy = policy
+        self._handle = handle
+        self._fd = file_descriptor
+        self._prefetched = [0, 0]
+        self._written = None
+        self._previous_written = None
+        if policy.sequential and mode == 'rb':
+            self._advise(0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def read(self, offset, num_bytes):
+        """Called before reading num_bytes bytes from offset"""
+
+        readahead = self._policy.readahead_bytes
+        end = offset + num_bytes
+        if not readahead or \
+                self._prefetched[0] <= offset and \
+                end + readahead // 2 <= self._prefetched[1]:
+            return
+
+        # Load the next readahead_bytes beyond the part already requested
+        start = end
+        if self._prefetched[0] <= offset <= self._prefetched[1]:
+            start = max(end, self._prefetched[1])
+        self._advise(start, end + readahead - start, os.POSIX_FADV_WILLNEED)
+        self._prefetched = [offset, end + readahead]
+
+    def written(self, offset, num_bytes):
+        """Called after writing num_bytes bytes at offset"""
+
+        if not self._policy.drop_behind_bytes:
+            return
+        if self._written:
+            self._written = [min(self._written[0], offset),
+                             max(self._written[1], offset + num_bytes)]
+        else:
+            self._written = [offset, offset + num_bytes]
+
+        if self._written[1] - self._written[0] >= \
+                self._policy.drop_behind_bytes:
+            # Dirty pages are not dropped, but the hint starts writing them
+            # to disk, so they can be dropped at the next hint
+            self._handle.flush()
+            self._drop(self._previous_written)
+            self._drop(self._written)
+            self._previous_written = self._written
+            self._written = None
+
+    def close(self):
+        """Called before the file is closed"""
+
+        if self._written or self._previous_written:
+            self._handle.flush()
+            self._drop([0, 0])
+
+    def _drop(self, written):
+        if written:
+            self._advise(written[0], written[1] - written[0],
+                         os.POSIX_FADV_DONTNEED)
+
+    def _advise(self, offset, length, advice):
+        try:
+            os.posix_fadvise(self._fd, offset, length, advice)
+        except OSError:
+            # Hints are optional, and not all file systems support them
+            pass
+
+
+def _open_direct(filename, flags):
+    """Open a file using direct I/O if this is supported"""
+
+    direct = getattr(os, 'O_DIRECT', 0)
+    try:
+        return os.open(filename, flags | direct, 0o666)
+    except OSError:
+        if not direct:
+            raise
+        # Some file systems, such as tmpfs, do not support direct I/O
+        return os.open(filename, flags, 0o666)
@@ -20,6 +20,25 @@ class ImageFileReader(object):
         """Create and write out this file, using data from this image source"""
         pass
 
+    def get_raw_streamer(self):
+        """Return a FileStreamer giving direct access to the raw voxel data in
+        this file, or None if the file format does not store raw voxels"""
+        return None
+
+    def get_checksum(self):
+        """Return the checksum of the data written to this file, once the
+        file has been written and closed, or None if it is not known"""
+        return None
+
+    def compute_checksum(self):
+        """Read the data stored in this file and return their checksum"""
+        raise ValueError('Checksums are not supported for this format')
+
+    def get_data_filenames(self):
+        """Return the names of the files which store the header and data of
+        this image"""
+        return []
+
 
 class LinearImageFileReader(ImageFileReader):
     """Base class for writing data from source to destination line by line"""
@@ -36,11 +55,28 @@ class LinearImageFileReader(ImageFileReader):
         """Reads a line of bytes from the file"""
         pass
 
+    def write_lines(self, start, image_lines, rescale_limits):
+        """Write consecutive lines of image data, each covering the whole of
+        the first dimension, starting at the specified coordinates. The
+        numpy array image_lines is in reversed dimension order and may be
+        overwritten"""
+
+        lines = np.reshape(image_lines, (-1, self.size[0]))
+        for index, image_line in enumerate(lines):
+            line_start = deepcopy(start)
+            if len(start) > 1:
+                line_start[1] = start[1] + index
+            self.write_line(line_start, image_line, rescale_limits)
+
     @abstractmethod
     def close_file(self):
         """Close the file"""
         pass
 
+    def compute_checksum(self):
+        """Read the raw data stored in this file and return their checksum"""
+        return self.get_raw_streamer().compute_checksum()
+
     def read_image(self, start_local, size_local):
         """Read the specified part of the image"""
 
@@ -80,6 +116,9 @@ class LinearImageFileReader(ImageFileReader):
         # Exclude first two coordinates and get others in reverse order
         ranges_to_iterate = ranges[:1:-1]
 
+        # Each slice is read into the same buffer
+        image_buffer = None
+
         # Iterate over each line (equivalent to multiple for loops)
         for main_dim_size in itertools.product(*ranges_to_iterate):
             start = [0] * min(2, len(self.size)) + \
@@ -89,18 +128,15 @@ class LinearImageFileReader(ImageFileReader):
             size = self.size[:2] + [1] * (len(self.size) - 2)
 
             # Read one image slice from the transformed source
-            image_slice = data_source.read_image(start, size)
-
-            # Write out the image data to the file
-            for line in range(0, size[1] if len(size) > 1 else 1):
-                out_start = deepcopy(start)
-                out_size = [self.size[0]] + [1] * (len(self.size) - 1)
-                if len(start) > 1:
-                    out_start[1] = line
-                image_line = image_slice.get_sub_image(out_start,
-                                                       out_size).image
-                self.write_line(out_start, image_line.get_raw(), rescale_limits)
+            image_slice = data_source.read_into(start, size, image_buffer)
+            image_buffer = image_slice.image
+
+            # The lines of the slice are consecutive in the file, so write
+            # them out together
+            self.write_lines(start, image_buffer.get_raw(), rescale_limits)
 
+        if image_buffer is not None:
+            data_source.release(image_buffer)
         self.close_file()
 
 
@@ -14,7 +14,8 @@ import numpy as np
 
 from imagesplit.file.data_type import DataType
 from imagesplit.file.file_image_descriptor import FileImageDescriptor
-from imagesplit.file.file_wrapper import FileWrapper, FileStreamer
+from imagesplit.file.file_wrapper import FileWrapper, FileStreamer, \
+    call_in_folder
 from imagesplit.file.image_file_reader import LinearImageFileReader
 from imagesplit.image.combined_image import Axis
 from imagesplit.utils.utilities import compute_bytes_per_voxel, \
@@ -35,22 +36,22 @@ class MetaIoFile(LinearImageFileReader):
         self._input_path = os.path.dirname(os.path.abspath(header_filename))
         self._file_wrapper = None
         self._file_streamer = None
+        self._data_offset = 0
+        self._checksum = None
         if header_template:
             # File is for writing
             self._mode = 'wb'
             # Force the raw filename to match the header filename
-            base_filename = os.path.splitext(
-                os.path.basename(header_filename))[0]
             header = copy.deepcopy(header_template)
-            header['ElementDataFile'] = base_filename + '.raw'
+            header['ElementDataFile'] = get_raw_filename(header_filename)
 
-            save_mhd_header(header_filename, header)
+            self._save_header(header_filename, header)
             self._header = header
 
         else:
             # File is for reading
             self._mode = 'rb'
-            self._header = load_mhd_header(header_filename)
+            self._header = self._load_header(header_filename)
 
         self._bytes_per_voxel = compute_bytes_per_voxel(
             self._header["ElementType"]) # ToDo: set this based on output format
@@ -79,6 +80,16 @@ class MetaIoFile(LinearImageFileReader):
     def create_write_file(cls, subimage_descriptor, file_handle_factory):
         """Create a MetaIoFile class for this filename and template"""
 
+        header_template = cls.create_write_header(subimage_descriptor)
+        local_file_size = subimage_descriptor.get_local_size()
+        filename = subimage_descriptor.filename
+        return cls(local_file_size, filename, file_handle_factory,
+                   header_template)
+
+    @classmethod
+    def create_write_header(cls, subimage_descriptor):
+        """Return the header template for writing this subimage"""
+
         header_template = cls._create_meta_header(subimage_descriptor)
         # header_template = copy.deepcopy(subimage_descriptor.template)
         local_file_size = subimage_descriptor.get_local_size()
@@ -89,20 +100,30 @@ class MetaIoFile(LinearImageFileReader):
                 DataType.metaio_from_name(subimage_descriptor.data_type)
         header_template["DimSize"] = local_file_size
         header_template["Origin"] = local_origin
-        filename = subimage_descriptor.filename
-        return cls(local_file_size, filename, file_handle_factory,
-                   header_template)
+        return header_template
 
     def close_file(self):
-        """Close file"""
+        """Close file once it has been written"""
+        if self._file_streamer and self._mode != 'rb':
+            self._checksum = self._file_streamer.get_written_checksum()
         self.close()
 
+    def get_checksum(self):
+        """Return the checksum of the raw data written to this file"""
+        return self._checksum
+
     def write_line(self, start_coords, image_line, rescale_limits):
         """Write consecutive voxels to the raw binary file."""
 
         return self._get_file_streamer().write_line(
             start_coords, image_line, rescale_limits)
 
+    def write_lines(self, start, image_lines, rescale_limits):
+        """Write consecutive lines of voxels to the raw binary file."""
+
+        return self._get_file_streamer().write_lines(
+            start, image_lines, rescale_limits)
+
     def read_line(self, start_coords, num_voxels_to_read):
         """Read consecutive voxels of image data from the raw binary file
         starting at the specified coordinates. """
@@ -110,6 +131,14 @@ class MetaIoFile(LinearImageFileReader):
         return self._get_file_streamer().read_line(start_coords,
                                                    num_voxels_to_read)
 
+    def get_raw_streamer(self):
+        """Return a FileStreamer giving direct access to the raw voxel data"""
+        return self._get_file_streamer()
+
+    def get_data_filenames(self):
+        """Return the names of the header and raw data files"""
+        return [self._header_filename, self._get_raw_data_path()]
+
     def get_bytes_per_voxel(self):
         """Return the number of bytes used to represent a single voxel in
         this image. """
@@ -159,18 +188,29 @@ class MetaIoFile(LinearImageFileReader):
         for this image. """
 
         if not self._header:
-            self._header = load_mhd_header(self._header_filename)
+            self._header = self._load_header(self._header_filename)
         return self._header
 
+    def _load_header(self, header_filename):
+        """Return the header of an image which is being read"""
+        return load_mhd_header(header_filename)
+
+    def _save_header(self, header_filename, header):
+        """Save the header of an image which is being written"""
+        call_in_folder(header_filename,
+                       lambda: save_mhd_header(header_filename, header))
+
+    def _get_raw_data_path(self):
+        """Return the path of the file holding the raw voxel data"""
+        return os.path.join(self._input_path,
+                            self._get_header()["ElementDataFile"])
+
     def _get_file_wrapper(self):
         """Return the FileWrapper representing this image, creating it if
         it does not already exist. """
 
         if not self._file_wrapper:
-            header = self._get_header()
-            filename_raw = os.path.join(self._input_path,
-                                        header["ElementDataFile"])
-            self._file_wrapper = FileWrapper(filename_raw,
+            self._file_wrapper = FileWrapper(self._get_raw_data_path(),
                                              self._file_handle_factory,
                                              self._mode)
         return self._file_wrapper
@@ -184,7 +224,8 @@ class MetaIoFile(LinearImageFileReader):
                                                self._subimage_size,
                                                self._bytes_per_voxel,
                                                self._numpy_format,
-                                               self._dimension_ordering)
+                                               self._dimension_ordering,
+                                               self._data_offset)
         return self._file_streamer
 
     def close(self):
@@ -232,6 +273,15 @@ def load_mhd_header(filename):
 def save_mhd_header(filename, metadata):
     """Saves a mhd header file to disk using the given metadata"""
 
+    header = get_mhd_header_text(metadata)
+    file_handle = open(filename, 'w')
+    file_handle.write(header)
+    file_handle.close()
+
+
+def get_mhd_header_text(metadata):
+    """Return the text of a mhd header file containing the given metadata"""
+
     # Add default metadata, replacing with custom specified values
     header = ''
     default_metadata = get_default_metadata()
@@ -252,9 +302,12 @@ def save_mhd_header(filename, metadata):
             value = value.replace("[", "").replace("]", "").replace(",", "")
             header += '%s = %s\n' % (key, value)
 
-    file_handle = open(filename, 'w')
-    file_handle.write(header)
-    file_handle.close()
+    return header
+
+
+def get_raw_filename(header_filename):
+    """Return the name of the raw data file written for this header"""
+    return os.path.splitext(os.path.basename(header_filename))[0] + '.raw'
 
 
 def get_default_metadata():
@@ -276,18 +329,23 @@ def get_default_metadata():
 
 def get_condensed_dim_order(header):
     """Return the condensed dimension order and flip string for this header"""
+    num_dims = int(header["NDims"]) if header.get("NDims") else 3
     if "TransformMatrix" in header and header["TransformMatrix"]:
         transform = header["TransformMatrix"]
-        new_dimension_order, flip_orientation = \
-            mhd_cosines_to_permutation(
-                transform[0:3], transform[3:6], transform[6:9])
+        if num_dims == 3:
+            new_dimension_order, flip_orientation = \
+                mhd_cosines_to_permutation(
+                    transform[0:3], transform[3:6], transform[6:9])
+        else:
+            new_dimension_order, flip_orientation = \
+                transform_to_permutation(transform, num_dims)
     elif "AnatomicalOrientation" in header and header["AnatomicalOrientation"]:
         new_dimension_order, flip_orientation = \
             anatomical_to_permutation(
                 header["AnatomicalOrientation"])
     else:
-        new_dimension_order = [0, 1, 2]
-        flip_orientation = [False, False, False]
+        new_dimension_order = list(range(num_dims))
+        flip_orientation = [False] * num_dims
 
     return Axis(new_dimension_order, flip_orientation).to_condensed_format()
 
@@ -331,14 +389,32 @@ def anatomical_to_cosine(anatomical_orientation_char):
 def permutation_to_cosine(permutation, flip):
     """Get mhd direction cosine for this dimension permutation"""
 
-    dir_cosine = [0, 0, 0, 0, 0, 0, 0, 0, 0]
-    dir_cosine[permutation[0]*3] = -1 if flip[0] else 1
-    dir_cosine[permutation[1]*3 + 1] = -1 if flip[1] else 1
-    dir_cosine[permutation[2]*3 + 2] = -1 if flip[2] else 1
+    num_dims = len(permutation)
+    dir_cosine = [0] * (num_dims * num_dims)
+    for dim, (permuted_dim, dim_flip) in enumerate(zip(permutation, flip)):
+        dir_cosine[permuted_dim * num_dims + dim] = -1 if dim_flip else 1
 
     return dir_cosine
 
 
+def transform_to_permutation(transform, num_dims):
+    """Get dimension permutation and flip vectors for an mhd TransformMatrix
+    with any number of dimensions"""
+
+    permutation_vector = [None] * num_dims
+    flip_orientation = [False] * num_dims
+    remaining_dimensions = list(range(num_dims))
+    for index in range(num_dims):
+        orientation = transform[index * num_dims:(index + 1) * num_dims]
+        dimension = max(remaining_dimensions,
+                        key=lambda dim, o=orientation: abs(o[dim]))
+        remaining_dimensions.remove(dimension)
+        permutation_vector[dimension] = index
+        flip_orientation[dimension] = orientation[dimension] < 0
+
+    return permutation_vector, flip_orientation
+
+
 def condensed_to_cosine(condensed_format):
     """Get mhd direction cosine for this condensed format axis"""
 
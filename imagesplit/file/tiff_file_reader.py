@@ -1,30 +1,51 @@
 # coding=utf-8
 
 """Read and write data to TIFF files"""
+import io
 import os
+import zlib
+
 import numpy as np
 from PIL import Image, TiffImagePlugin
 
 from imagesplit.file.data_type import DataType
+from imagesplit.file.file_wrapper import FileWrapper, FileHandleFactory
 from imagesplit.file.image_file_reader import BlockImageFileReader
+from imagesplit.utils.checksum import compute_file_checksum, format_checksum
 
 
 class TiffFileReader(BlockImageFileReader):
     """Read and write to TIFF files"""
 
-    def __init__(self, filename, image_size, data_type):
+    def __init__(self, filename, image_size, data_type,
+                 file_handle_factory=None):
         super(TiffFileReader, self).__init__(image_size, data_type)
         self.cached_image = None
         self.filename = filename
+        self.checksum = None
+        self._file_handle_factory = file_handle_factory or \
+            FileHandleFactory()
 
     def close_file(self):
         """Closes file if required"""
+        self.close()
+
+    def close(self):
+        """Release the cached image data"""
+        self.cached_image = None
 
     def load(self):
         """Load image data from TIFF file"""
-        if not self.cached_image:
+        if self.cached_image is None:
             img = Image.open(self.filename)
-            self.cached_image = np.array(img)
+            image = np.array(img)
+
+            # PIL may widen some types, such as 16-bit signed integers, so
+            # convert back to the data type of the file
+            if not self.data_type.get_is_rgb():
+                image = image.astype(self.data_type.get_numpy_format(),
+                                     copy=False)
+            self.cached_image = image
         return self.cached_image
 
     def save(self, image):
@@ -45,22 +66,54 @@ class TiffFileReader(BlockImageFileReader):
 
         img = Image.fromarray(image)
 
+        # The file is encoded in memory so its checksum can be computed before
+        # it is written
+        buffer = io.BytesIO()
         if compression:
             # Set WRITE_LIBTIFF to true for compression, but restore previous
             # value afterwards in case user has deliberately set a value
             write_libtiff_previous_value = TiffImagePlugin.WRITE_LIBTIFF
             try:
                 TiffImagePlugin.WRITE_LIBTIFF = True
-                img.save(self.filename, compression=compression)
+                img.save(buffer, format='TIFF', compression=compression)
 
             finally:
                 TiffImagePlugin.WRITE_LIBTIFF = write_libtiff_previous_value
 
         else:
-            img.save(self.filename)
+            img.save(buffer, format='TIFF')
+
+        data = buffer.getvalue()
+        self.checksum = format_checksum(zlib.crc32(data))
+
+        # The file is written in the same way as other formats, so the file
+        # handle pool, direct I/O and cache policy apply to it
+        tiff_file = FileWrapper(self.filename, self._file_handle_factory,
+                                'wb')
+        try:
+            tiff_file.write(0, data)
+        finally:
+            tiff_file.close()
+
+    def get_checksum(self):
+        """Return the checksum of the TIFF file which was written"""
+        return self.checksum
+
+    def compute_checksum(self):
+        """Read the TIFF file and return its checksum"""
+        return compute_file_checksum(self.filename)
+
+    def get_data_filenames(self):
+        """Return the name of the TIFF file"""
+        return [self.filename]
+
+    @staticmethod
+    def create_read_file(subimage_descriptor, file_handle_factory):
+        """Create a TiffFileReader class for reading this file"""
+        return TiffFileReader.create_write_file(subimage_descriptor,
+                                                file_handle_factory)
 
     @staticmethod
-    # pylint: disable=unused-argument
     def create_write_file(subimage_descriptor, file_handle_factory):
         """Create a TiffFileReader class for this filename and template"""
         filename = subimage_descriptor.filename
@@ -70,7 +123,8 @@ class TiffFileReader(BlockImageFileReader):
         data_type = DataType(subimage_descriptor.data_type,
                              byte_order_msb=byte_order_msb,
                              compression=compression)
-        return TiffFileReader(filename, local_file_size, data_type)
+        return TiffFileReader(filename, local_file_size, data_type,
+                              file_handle_factory)
 
     @staticmethod
     def add_filename_suffix(filename, suffix):
@@ -69,6 +69,14 @@ class VolFile(LinearImageFileReader):
         return self._get_file_streamer().read_line(start_coords,
                                                    num_voxels_to_read)
 
+    def get_raw_streamer(self):
+        """Return a FileStreamer giving direct access to the raw voxel data"""
+        return self._get_file_streamer()
+
+    def get_data_filenames(self):
+        """Return the names of the header and raw data files"""
+        return [self._header_filename, self._get_raw_data_path()]
+
     def get_bytes_per_voxel(self):
         """Return the number of bytes used to represent a single voxel in
         this image. """
@@ -102,18 +110,20 @@ class VolFile(LinearImageFileReader):
         it does not already exist. """
 
         if not self._file_wrapper:
-            header = self._get_header()
-            file_section = header["VolumeSection0\\_FileSection0"]
-            vol_name = file_section["filename"]
-            # pylint: disable=unused-variable
-            vol_path, vol_raw = os.path.split(vol_name)
-            filename_raw = os.path.realpath(
-                os.path.join(self._input_path, '..', vol_raw))
-            self._file_wrapper = FileWrapper(filename_raw,
+            self._file_wrapper = FileWrapper(self._get_raw_data_path(),
                                              self._file_handle_factory,
                                              self._mode)
         return self._file_wrapper
 
+    def _get_raw_data_path(self):
+        """Return the path of the file holding the raw voxel data"""
+        header = self._get_header()
+        file_section = header["VolumeSection0\\_FileSection0"]
+        vol_name = file_section["filename"]
+        # pylint: disable=unused-variable
+        vol_path, vol_raw = os.path.split(vol_name)
+        return os.path.realpath(os.path.join(self._input_path, '..', vol_raw))
+
     def _get_file_streamer(self):
         """Return the FileStreamer representing this image, creating it
         if it does not already exist. """
@@ -1,11 +1,23 @@
 # coding=utf-8
 
 """Classes for aggregating images from multiple files into a single image"""
+import itertools
+import threading
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from functools import partial
 
 import numpy as np
 import six
-from imagesplit.image.image_wrapper import SmartImage
+from imagesplit.image.histogram import Histogram, get_histogram_cache_key, \
+    load_cached_histogram, save_cached_histogram
+from imagesplit.image.image_wrapper import SmartImage, ImageWrapper, \
+    BufferPool
+from imagesplit.utils.parallel import parallel_map
+from imagesplit.utils.utilities import get_contiguous_runs
+
+# Default maximum memory used by a HaloCache
+HALO_CACHE_BYTES = 2 ** 28
 
 
 class Source(object):
@@ -22,50 +34,173 @@ class Source(object):
         """Read image from specified starting coordinates and size"""
         raise NotImplementedError
 
+    def read_into(self, start, size, out=None):
+        """Read image from specified starting coordinates and size into the
+        ImageStorage out. If out is None, a new buffer is used. The image
+        data of the result can be reused as out for later reads"""
+
+        image = self.read_image(start, size)
+        if out is None:
+            return ImageWrapper(origin=start, image=image.image.copy())
+        out.set(tuple(slice(0, sz) for sz in size), image.image)
+        return ImageWrapper(origin=start, image=out)
+
+    def release(self, image):
+        """Indicates that an ImageStorage returned by read_into is no longer
+        needed, so that its memory can be reused"""
+
 
 class CombinedImage(object):
     """A kind of virtual file for writing where the data are distributed
         across multiple real files. """
 
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self, descriptors, file_factory):
-        """Create for the given set of descriptors"""
+        """Create for the given sequence of descriptors. SubImages are only
+        created when they are needed. If descriptors has a get_ranges()
+        method, this is used to index the subimages without creating each
+        descriptor"""
 
         self.limits = None
-        self._subimages = []
-        for subimage_descriptor in descriptors:
-            self._subimages.append(SubImage(subimage_descriptor, file_factory))
+        self._histogram = None
+        self._buffers = BufferPool()
+        self._descriptors = descriptors
+        self._file_factory = file_factory
+        self._subimages = {}
+        self._subimages_lock = threading.Lock()
+        self._halo_cache = None
+        self._read_threads = 1
+        if hasattr(descriptors, 'get_ranges'):
+            ranges = descriptors.get_ranges()
+        else:
+            ranges = [descriptor.ranges.ranges for descriptor in descriptors]
+        self._ranges = ranges
+        self._roi_index = RoiIndex(ranges)
 
     def read_image(self, start_local, size_local, transformer):
         """Assembles an image range from subimages"""
 
+        return self.read_into(start_local, size_local, transformer)
+
+    def read_into(self, start_local, size_local, transformer, out=None):
+        """Assembles an image range from subimages into the ImageStorage out.
+        If out is None, a buffer from the pool is used. The buffer is only
+        zero-filled if the subimages do not cover the whole range"""
+
+        if out is not None and out.get_size() != list(size_local):
+            raise ValueError('The output image is not the requested size')
+
+        # Compute global coordinates to match with subimage descriptors
+        start, size = transformer.to_global_region(start_local, size_local)
+
+        # Part of the region may already have been read for a previous block
+        cached = None
+        read_start, read_size = start, size
+        num_voxels_covered = 0
+        if self._halo_cache:
+            cached, read_start, read_size = self._halo_cache.find(start, size)
+            if cached:
+                num_voxels_covered += int(np.prod(cached.size))
+
+        # Find the parts of the image which overlap each subimage's ROI
+        parts = []
+        if np.all(np.greater(read_size, 0)):
+            for subimage in self._find_subimages(read_start, read_size):
+                part_start, part_size = subimage.bind_by_roi(read_start,
+                                                             read_size)
+                if np.all(np.greater(part_size, 0)):
+                    parts.append((subimage, part_start, part_size))
+                    num_voxels_covered += int(np.prod(part_size))
+        covered = num_voxels_covered == int(np.prod(size))
+
         # Create the output image wrapper
         combined_image = SmartImage(start=start_local,
                                     size=size_local,
-                                    image=None,
+                                    image=out,
                                     transformer=transformer)
+        if out is not None and not covered:
+            out.get_raw().fill(0)
 
-        # Compute global coordinates to match with subimage descriptors
-        start, size = transformer.to_global(start_local, size_local)
+        for part_image in _read_parts(cached, parts, self._read_threads):
 
-        # Check each subimage for overlaps
-        for subimage in self._subimages:
+            # The data type is only known once the first part has been read
+            if combined_image.image is None:
+                combined_image.image = self._buffers.get(
+                    size_local, part_image.image.get_type())
+                if not covered:
+                    combined_image.image.get_raw().fill(0)
 
-            # Fetch any part of the image which overlaps this subimage's ROI
-            part_image = subimage.read_image_bound_by_roi(start, size)
+            combined_image.set_sub_image(part_image)
 
-            # If any part overlapped, copy this into the combined image
-            if part_image:
-                combined_image.set_sub_image(part_image)
+        if self._halo_cache and combined_image.image is not None:
+            self._halo_cache.add(start, size, combined_image, transformer)
 
         return combined_image
 
+    def release(self, image):
+        """Return an ImageStorage from read_into to the buffer pool"""
+        self._buffers.release(image)
+
     def close(self):
         """Closes all streams and files"""
-        for subimage in self._subimages:
+        for subimage in self._subimages.values():
+            subimage.close()
+
+    def release_subimages(self, start, size):
+        """Close and forget the SubImages whose ROIs do not overlap the
+        global region with this start and size, freeing any image data they
+        hold, such as decoded TIFF files. They are created again if they are
+        used later"""
+
+        keep = set(self._roi_index.find_overlapping(start, size))
+        with self._subimages_lock:
+            released = [self._subimages.pop(position)
+                        for position in list(self._subimages)
+                        if position not in keep]
+        for subimage in released:
             subimage.close()
 
-    def write_image(self, source, rescale, test=False):
-        """Write out all the subimages with data from supplied source"""
+    def copy_raw_to(self, target, out_file):
+        """Copy the data for the target SubImage directly from the files
+        underlying this image into out_file, without converting the data.
+
+        This is only possible if every file involved stores raw voxels with
+        the same data type, byte order and axis ordering as out_file, and the
+        target is completely covered by this image. Returns False without
+        writing any data if the raw copy is not possible."""
+
+        out_streamer = out_file.get_raw_streamer()
+        if not out_streamer:
+            return False
+
+        start, size = target.get_range()
+
+        # Find the parts of each subimage which contribute to the target
+        parts = []
+        num_voxels_covered = 0
+        for subimage in self._find_subimages(start, size):
+            part_start, part_size = subimage.bind_by_roi(start, size)
+            if np.all(np.greater(part_size, 0)):
+                if not subimage.can_copy_raw(
+                        target.get_transformer().axis, out_streamer):
+                    return False
+                parts.append((subimage, part_start, part_size))
+                num_voxels_covered += int(np.prod(part_size))
+
+        if num_voxels_covered != int(np.prod(size)):
+            return False
+
+        for subimage, part_start, part_size in parts:
+            subimage.copy_raw(part_start, part_size, target, out_streamer)
+
+        out_file.close_file()
+        return True
+
+    def write_image(self, source, rescale, test=False, engine=None):
+        """Write out all the subimages with data from supplied source. If an
+        engine such as AsyncEngine is specified, it is used to run the task of
+        writing each subimage, otherwise they are written one at a time"""
 
         # If rescaling is required, get the global limits
         if not rescale:
@@ -74,14 +209,59 @@ class CombinedImage(object):
         elif rescale == "limits":
             limits = source.get_limits()
             six.print_("Limits: " + str(limits.min) + ":" + str(limits.max))
+        elif isinstance(rescale, Percentiles):
+            limits = source.get_percentile_limits(rescale)
+            six.print_("Limits: " + str(limits.min) + ":" + str(limits.max))
         else:
             limits = Limits(rescale[0], rescale[1])
             six.print_("Limits: " + str(limits.min) + ":" + str(limits.max))
 
-        # Get each subimage to write itself
-        if not test:
-            for next_image in self._subimages:
-                next_image.write_image(source, limits)
+        if test:
+            return
+
+        if engine:
+            engine.run(partial(self._write_subimage, position, source, limits)
+                       for position in range(len(self._descriptors)))
+            return
+
+        # Where output images overlap, write them in an order which visits
+        # neighbouring images one after another, so the input data they
+        # share can be kept in memory and read only once
+        order = range(len(self._descriptors))
+        halo_regions = None
+        halo_cache = None
+        if isinstance(source, CombinedImage) and len(self._descriptors) > 1:
+            halo_order, halo_regions = plan_halo_traversal(
+                self._ranges, self._descriptors[0].axis.dim_order)
+            if any(halo_regions):
+                order = halo_order
+                halo_cache = HaloCache()
+                source.set_halo_cache(halo_cache)
+
+        # Get each subimage to write itself. These SubImages are only used
+        # once, so they are not kept
+        for step, position in enumerate(order):
+            if halo_cache:
+                halo_cache.begin_block(step, halo_regions[step])
+            self._write_subimage(position, source, limits)
+
+        if halo_cache:
+            source.set_halo_cache(None)
+
+    def _write_subimage(self, position, source, limits):
+        SubImage(self._descriptors[position],
+                 self._file_factory).write_image(source, limits)
+
+    def set_read_threads(self, num_threads):
+        """Set the number of threads used to read the parts of a region which
+        are stored in different files. If None, a few more threads than CPUs
+        are used"""
+        self._read_threads = num_threads
+
+    def set_halo_cache(self, halo_cache):
+        """Use a HaloCache to keep data read for one block which will be
+        read again for a later block. Use None to stop caching"""
+        self._halo_cache = halo_cache
 
     def get_limits(self):
         """Return minimum and maximum values across all subimages"""
@@ -89,7 +269,7 @@ class CombinedImage(object):
         if not self.limits:
             minv = None
             maxv = None
-            for next_image in self._subimages:
+            for next_image in self._get_all_subimages():
                 next_min, next_max = next_image.get_limits()
                 if minv is None or next_min < minv:
                     minv = next_min
@@ -99,6 +279,258 @@ class CombinedImage(object):
 
         return self.limits
 
+    def get_histogram(self, use_cache=False):
+        """Return a Histogram of values across all subimages. If use_cache is
+        True, the histogram of each input file is cached in a file alongside
+        it"""
+
+        if not self._histogram:
+            histogram = Histogram()
+            for next_histogram in parallel_map(
+                    lambda subimage: subimage.get_histogram(use_cache),
+                    self._get_all_subimages()):
+                histogram.merge(next_histogram)
+            self._histogram = histogram
+
+        return self._histogram
+
+    def get_percentile_limits(self, percentiles):
+        """Return Limits at the specified Percentiles of all values"""
+
+        histogram = self.get_histogram(percentiles.cache_histogram)
+        return Limits(histogram.percentile(percentiles.low),
+                      histogram.percentile(percentiles.high))
+
+    def _get_subimage(self, position):
+        subimage = self._subimages.get(position)
+        if subimage is None:
+            with self._subimages_lock:
+                subimage = self._subimages.get(position)
+                if subimage is None:
+                    subimage = SubImage(self._descriptors[position],
+                                        self._file_factory)
+                    self._subimages[position] = subimage
+        return subimage
+
+    def _get_all_subimages(self):
+        return [self._get_subimage(position) for position in
+                range(len(self._descriptors))]
+
+    def _find_subimages(self, start, size):
+        """Return the SubImages whose ROIs overlap the global region"""
+        return [self._get_subimage(position) for position in
+                self._roi_index.find_overlapping(start, size)]
+
+
+def _read_parts(cached, parts, num_threads=1):
+    """Returns an iterator over the cached image, if any, then each part. If
+    num_threads is 1, each part is read as it is needed, otherwise the parts
+    are read in parallel"""
+    if num_threads == 1:
+        part_images = (subimage.read_image(part_start, part_size)
+                       for subimage, part_start, part_size in parts)
+    else:
+        part_images = parallel_map(
+            lambda part: part[0].read_image(part[1], part[2]), parts,
+            num_threads)
+    return itertools.chain([cached] if cached else [], part_images)
+
+
+def plan_halo_traversal(ranges, dim_order):
+    """Return an order in which to process a grid of overlapping blocks, and
+    the regions shared with later blocks for each step of that order.
+
+    Blocks are visited in a serpentine order, so each block is followed by a
+    neighbour. The slowest dimension of the output files (the last entry in
+    dim_order) changes fastest, since images are written in slices along this
+    dimension. For each step, the returned list contains (start, size,
+    last_step) for each global region which is read again at last_step"""
+
+    ranges = np.asarray(ranges, dtype=np.int64)
+    num_blocks = ranges.shape[0]
+    no_halo = list(range(num_blocks)), [[] for _ in range(num_blocks)]
+    if num_blocks < 2 or not np.any(ranges[:, :, 2:]):
+        return no_halo
+
+    # Find the position of each block in the grid
+    roi_start = ranges[:, :, 0] + ranges[:, :, 2]
+    grid = np.zeros_like(roi_start)
+    grid_sizes = []
+    for dim in range(roi_start.shape[1]):
+        starts, grid[:, dim] = np.unique(roi_start[:, dim],
+                                         return_inverse=True)
+        grid_sizes.append(len(starts))
+    positions = dict((tuple(index), position) for position, index in
+                     enumerate(grid.tolist()))
+    if len(positions) != num_blocks:
+        return no_halo
+
+    # Serpentine order: each dimension runs backwards when the sum of the
+    # indices along the slower dimensions is odd
+    slow_to_fast = [dim for dim in dim_order if dim != dim_order[-1]] + \
+        [dim_order[-1]]
+    keys = []
+    index_sum = np.zeros(num_blocks, dtype=np.int64)
+    for dim in slow_to_fast:
+        keys.append(np.where(index_sum % 2, grid_sizes[dim] - 1 - grid[:, dim],
+                             grid[:, dim]))
+        index_sum += grid[:, dim]
+    order = np.lexsort(keys[::-1]).tolist()
+    step_of = dict((position, step) for step, position in enumerate(order))
+
+    # Regions read by both of a pair of neighbouring blocks
+    regions = [[] for _ in range(num_blocks)]
+    starts = ranges[:, :, 0].tolist()
+    ends = ranges[:, :, 1].tolist()
+    for index, position in positions.items():
+        for dim, grid_index in enumerate(index):
+            neighbour = positions.get(
+                index[:dim] + (grid_index + 1,) + index[dim + 1:])
+            if neighbour is None:
+                continue
+            start = [max(a, b) for a, b in zip(starts[position],
+                                                starts[neighbour])]
+            end = [min(a, b) for a, b in zip(ends[position], ends[neighbour])]
+            if all(e >= s for s, e in zip(start, end)):
+                first, last = sorted([step_of[position], step_of[neighbour]])
+                regions[first].append((start, [e - s + 1 for s, e in
+                                               zip(start, end)], last))
+    return order, regions
+
+
+class HaloCache(object):
+    """Copies of the parts of an image read for one block which are read
+    again for a later block, so the overlap between neighbouring blocks is
+    only read from the files once. Memory use is limited to max_bytes"""
+
+    def __init__(self, max_bytes=HALO_CACHE_BYTES):
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        self._entries = {}
+        self._regions = []
+        self._transformer = None
+
+    def begin_block(self, step, regions):
+        """Start reading the block at this step of the traversal. regions
+        lists (start, size, last_step) for each global region which will be
+        read again at last_step. Data no longer needed are discarded"""
+
+        self._regions = regions
+        for key, (image, last_step) in list(self._entries.items()):
+            if last_step < step:
+                del self._entries[key]
+                self._num_bytes -= image.get_raw().nbytes
+
+    def find(self, start, size):
+        """Return a SmartImage of the largest cached part of the global
+        region which leaves a single box to be read, and the start and size
+        of that box. The image is None if no part of the region is cached"""
+
+        best = None
+        best_voxels = 0
+        end = np.add(start, size)
+        for (entry_start, entry_size), (image, _) in self._entries.items():
+            part_start = np.maximum(start, entry_start)
+            part_end = np.minimum(end, np.add(entry_start, entry_size))
+            part_size = part_end - part_start
+            num_voxels = int(np.prod(part_size))
+            if np.all(part_size > 0) and num_voxels > best_voxels:
+                remainder = _remaining_box(start, end, part_start, part_end)
+                if remainder:
+                    best = (image, entry_start, part_start, part_size,
+                            remainder)
+                    best_voxels = num_voxels
+        if not best:
+            return None, start, size
+
+        image, entry_start, part_start, part_size, remainder = best
+        selector = tuple(slice(s - e, s - e + sz) for s, e, sz in
+                         zip(part_start, entry_start, part_size))
+        cached = SmartImage(start=tuple(part_start.tolist()),
+                            size=tuple(part_size.tolist()),
+                            image=image.get(selector),
+                            transformer=self._get_transformer(len(start)))
+        return cached, remainder[0], remainder[1]
+
+    def add(self, start, size, image, transformer):
+        """Keep copies of the parts of this image, read from the global
+        region start and size, which will be read again later"""
+
+        end = np.add(start, size)
+        for region_start, region_size, last_step in self._regions:
+            part_start = np.maximum(start, region_start)
+            part_end = np.minimum(end, np.add(region_start, region_size))
+            part_size = part_end - part_start
+            if not np.all(part_size > 0):
+                continue
+            key = (tuple(part_start.tolist()), tuple(part_size.tolist()))
+            entry = self._entries.get(key)
+            if entry:
+                self._entries[key] = (entry[0], max(entry[1], last_step))
+                continue
+            num_bytes = int(np.prod(part_size)) * image.image.get_type(
+            ).itemsize
+            if self._num_bytes + num_bytes > self._max_bytes:
+                continue
+            local_start, local_size = transformer.to_local_region(
+                part_start, part_size)
+            part = image.get_sub_image(local_start, local_size).image
+            self._entries[key] = (transformer.image_to_global(part).copy(),
+                                  last_step)
+            self._num_bytes += num_bytes
+
+    def _get_transformer(self, num_dims):
+        if not self._transformer:
+            self._transformer = CoordinateTransformer(
+                [0] * num_dims, [1] * num_dims,
+                Axis(list(range(num_dims)), [False] * num_dims))
+        return self._transformer
+
+
+def _remaining_box(start, end, part_start, part_end):
+    """If the region from start to end, less the part from part_start to
+    part_end, is a single box, return the (start, size) of that box, which
+    may be empty. Otherwise return None"""
+
+    partial_dims = [dim for dim in range(len(start)) if
+                    part_start[dim] != start[dim] or part_end[dim] != end[dim]]
+    if not partial_dims:
+        return start, [0] * len(start)
+    if len(partial_dims) > 1:
+        return None
+    dim = partial_dims[0]
+    box_start = list(start)
+    box_end = list(end)
+    if part_start[dim] == start[dim]:
+        box_start[dim] = part_end[dim]
+    elif part_end[dim] == end[dim]:
+        box_end[dim] = part_start[dim]
+    else:
+        return None
+    return box_start, np.subtract(box_end, box_start).tolist()
+
+
+class RoiIndex(object):
+    """Finds which of a set of subimage ROIs overlap a region"""
+
+    def __init__(self, ranges):
+        ranges = np.asarray(ranges, dtype=np.int64)
+        if ranges.size == 0:
+            ranges = np.zeros((0, 0, 4), dtype=np.int64)
+        self._roi_start = ranges[:, :, 0] + ranges[:, :, 2]
+        self._roi_end = ranges[:, :, 1] - ranges[:, :, 3] + 1
+
+    def find_overlapping(self, start, size):
+        """Return the positions, in ascending order, of the ROIs which
+        overlap the region with this start and size"""
+
+        if self._roi_start.shape[0] == 0:
+            return []
+        end = np.add(start, size)
+        overlaps = np.all(self._roi_start < end, axis=1) & \
+            np.all(self._roi_end > start, axis=1)
+        return np.flatnonzero(overlaps).tolist()
+
 
 class Limits(object):
     """Image range values across all subimages"""
@@ -108,13 +540,32 @@ class Limits(object):
         self.max = rmax
 
 
+class Percentiles(object):
+    """Rescale limits specified as percentiles of the image values. If
+    cache_histogram is True, the histogram of each input file is saved in a
+    file alongside it and reused until the input file changes"""
+
+    def __init__(self, low, high, cache_histogram=False):
+        if not 0 <= low < high <= 100:
+            raise ValueError('Percentiles must satisfy 0 <= low < high <= 100')
+        self.low = low
+        self.high = high
+        self.cache_histogram = cache_histogram
+
+
 class SubImage(Source):
     """An image which forms part of a larger image"""
 
     def __init__(self, descriptor, file_factory):
         self._file_factory = file_factory
         self._descriptor = descriptor
-        self._read_file = None
+        self._histogram = None
+
+        # Each read moves the file position, so threads reading at the same
+        # time each use a different read file
+        self._read_files = []
+        self._free_read_files = []
+        self._read_lock = threading.Lock()
 
         self._roi_start = self._descriptor.ranges.roi_start
         self._roi_size = self._descriptor.ranges.roi_size
@@ -130,11 +581,12 @@ class SubImage(Source):
         """Returns a subimage containing any overlap from the image"""
 
         # Convert to local coordinates for the data source
-        start_local, size_local = self._transformer.to_local(start, size)
+        start_local, size_local = self._transformer.to_local_region(start,
+                                                                     size)
 
         # Get the image data from the data source
-        local_source = self._get_read_file()
-        image_local = local_source.read_image(start_local, size_local)
+        with self._use_read_file() as local_source:
+            image_local = local_source.read_image(start_local, size_local)
 
         return SmartImage(start=start_local,
                           size=size_local,
@@ -157,16 +609,63 @@ class SubImage(Source):
     def close(self):
         """Close all streams and files"""
 
-        if self._read_file:
-            self._read_file.close()
-            self._read_file = None
+        with self._read_lock:
+            for read_file in self._read_files:
+                read_file.close()
+            self._read_files = []
+            self._free_read_files = []
 
     def write_image(self, global_source, rescale_limits):
-        """Write out SubImage using data from the specified source"""
+        """Write out SubImage using data from the specified source. The
+        checksum of the file is stored in the descriptor"""
 
         out_file = self._file_factory.create_write_file(self._descriptor)
-        local_source = LocalSource(global_source, self._transformer)
-        out_file.write_image(local_source, rescale_limits)
+
+        # If no conversion is required, try copying the bytes directly
+        if not (not rescale_limits and
+                isinstance(global_source, CombinedImage) and
+                global_source.copy_raw_to(self, out_file)):
+            local_source = LocalSource(global_source, self._transformer)
+            out_file.write_image(local_source, rescale_limits)
+
+        self._descriptor.checksum = out_file.get_checksum()
+
+    def get_range(self):
+        """Return the global start and size of the whole image file"""
+        return self._descriptor.ranges.origin_start, \
+            self._descriptor.ranges.image_size
+
+    def can_copy_raw(self, axis, out_streamer):
+        """True if raw voxels can be copied without conversion from this
+        image into a file with this axis ordering and FileStreamer"""
+
+        with self._use_read_file() as read_file:
+            in_streamer = read_file.get_raw_streamer()
+        if not in_streamer:
+            return False
+        if self._axis.to_condensed_format() != axis.to_condensed_format():
+            return False
+        return np.dtype(in_streamer.get_numpy_format()) == \
+            np.dtype(out_streamer.get_numpy_format())
+
+    def copy_raw(self, start, size, target, out_streamer):
+        """Copy the global region specified by start and size from this image
+        to the file for the target SubImage, without conversion"""
+
+        in_start, local_size = self._transformer.to_local_region(start, size)
+        out_start, _ = target.get_transformer().to_local_region(start, size)
+
+        with self._use_read_file() as read_file:
+            in_streamer = read_file.get_raw_streamer()
+            for in_coords, out_coords, num_voxels in get_contiguous_runs(
+                    local_size, in_streamer.get_image_size(), in_start,
+                    out_streamer.get_image_size(), out_start):
+                out_streamer.copy_from(in_streamer, in_coords, out_coords,
+                                       num_voxels)
+
+    def get_transformer(self):
+        """Return the CoordinateTransformer for this image"""
+        return self._transformer
 
     def bind_by_roi(self, start_global, size_global):
         """Find the part of the specified region that fits within the ROI"""
@@ -187,11 +686,65 @@ class SubImage(Source):
         maxv = np.max(image.image.get_raw())
         return minv, maxv
 
-    def _get_read_file(self):
-        if not self._read_file:
-            self._read_file = self._file_factory.create_read_file(
-                self._descriptor)
-        return self._read_file
+    def get_histogram(self, use_cache=False):
+        """Return a Histogram of values in the ROI, reading one slice at a
+        time to limit memory usage. If use_cache is True, the histogram is
+        cached in a file next to the input file, so later runs do not need
+        to read the file again unless it has been modified"""
+
+        if not self._histogram:
+            if not use_cache:
+                self._histogram = self._compute_histogram()
+                return self._histogram
+
+            with self._use_read_file() as read_file:
+                filenames = read_file.get_data_filenames()
+            cache_key = get_histogram_cache_key(
+                filenames,
+                self._transformer.to_local_region(self._roi_start,
+                                                  self._roi_size))
+            histogram = load_cached_histogram(self._descriptor.filename,
+                                              cache_key)
+            if not histogram:
+                histogram = self._compute_histogram()
+                save_cached_histogram(self._descriptor.filename, cache_key,
+                                      histogram)
+            self._histogram = histogram
+
+        return self._histogram
+
+    def _compute_histogram(self):
+        """Read the ROI one slice at a time and return its Histogram"""
+
+        histogram = Histogram()
+
+        # Read slices along the slowest-changing dimension of the file
+        slice_dim = self._axis.dim_order[-1]
+        size = list(self._roi_size)
+        size[slice_dim] = 1
+        for index in range(self._roi_size[slice_dim]):
+            start = list(self._roi_start)
+            start[slice_dim] += index
+            histogram.add(self.read_image(start, size).image.get_raw())
+        return histogram
+
+    @contextmanager
+    def _use_read_file(self):
+        """Provides a read file which is not in use by any other thread"""
+
+        with self._read_lock:
+            read_file = self._free_read_files.pop() \
+                if self._free_read_files else None
+        if not read_file:
+            read_file = self._file_factory.create_read_file(self._descriptor)
+            with self._read_lock:
+                self._read_files.append(read_file)
+        try:
+            yield read_file
+        finally:
+            with self._read_lock:
+                if read_file in self._read_files:
+                    self._free_read_files.append(read_file)
 
 
 class LocalSource(Source):
@@ -207,6 +760,17 @@ class LocalSource(Source):
         return self._source.read_image(
             start, size, self._transformer)
 
+    def read_into(self, start, size, out=None):
+        """Reads a partial image using the specified local coordinates into
+        the ImageStorage out"""
+
+        return self._source.read_into(start, size, self._transformer, out)
+
+    def release(self, image):
+        """Indicates that an ImageStorage returned by read_into is no longer
+        needed"""
+        self._source.release(image)
+
     def close(self):
         """Close all streams and files"""
         self._source.close()
@@ -223,102 +787,136 @@ class CoordinateTransformer(object):
         :param dim_ordering: ordering of local dimensions
         :param dim_flip: whether local axes should be flipped
         """
-        self._origin = origin
+        self._origin = tuple(origin)
         self._size = size
         self.axis = axis
 
-        size_t = np.array(self._size)[self.axis.dim_order]
-
-        self._flip_offset = np.zeros_like(self.axis.dim_flip)
-        self._flip_multiple = np.subtract(1, np.multiply(2, self.axis.dim_flip))
-
-        for index, flip in enumerate(self.axis.dim_flip):
-            if flip:
-                self._flip_offset[index] = size_t[index] - 1
+        # Coordinates are transformed using tuples, which are much faster
+        # than numpy for the small arrays used here
+        self._dim_order = tuple(axis.dim_order)
+        self._reverse_dim_order = tuple(axis.reverse_dim_order)
+        self._flip_multiple = tuple(-1 if flip else 1
+                                    for flip in axis.dim_flip)
+        self._flip_offset = tuple(size[dim] - 1 if flip else 0 for dim, flip
+                                  in zip(self._dim_order, axis.dim_flip))
 
     def to_local(self, global_start, global_size):
         """Convert global coordinates to local coordinates"""
 
-        # Translate coordinates to the local origin
-        start = np.subtract(global_start, self._origin)
-        size = np.array(global_size)  # Make sure global_size is a numpy array
-
-        # Permute dimensions of local coordinates
-        start = start[self.axis.dim_order]
-        size = size[self.axis.dim_order]
+        start = tuple(multiple * (global_start[dim] - self._origin[dim]) +
+                      offset for dim, multiple, offset in
+                      zip(self._dim_order, self._flip_multiple,
+                          self._flip_offset))
+        size = tuple(global_size[dim] for dim in self._dim_order)
+        return start, size
 
-        # Flip dimensions where necessary
-        start = np.add(np.multiply(start, self._flip_multiple),
-                       self._flip_offset)
+    def to_local_region(self, global_start, global_size):
+        """Convert a global region to local coordinates, where the returned
+        start is the lowest local coordinate of the region along each
+        dimension, including flipped dimensions"""
 
+        start, size = self.to_local(global_start, global_size)
+        start = tuple(st - (sz - 1) if flip else st for st, sz, flip in
+                      zip(start, size, self.axis.dim_flip))
         return start, size
 
     def to_other(self, local_start, local_size, other_transformer):
         """Convert local coordinates to a different local system"""
 
-        global_start, global_size = self.to_global(local_start, local_size)
-        return other_transformer.to_local(global_start, global_size)
+        dim_order, multiples, offsets = self._get_other_plan(other_transformer)
+        start = tuple(multiple * local_start[dim] + offset for
+                      dim, multiple, offset in
+                      zip(dim_order, multiples, offsets))
+        size = tuple(local_size[dim] for dim in dim_order)
+        return start, size
+
+    def to_other_region(self, local_start, local_size, other_transformer):
+        """Convert a local region to a different local system, where the
+        starts of both regions are their lowest coordinates along each
+        dimension"""
+
+        dim_order, multiples, offsets = self._get_other_plan(other_transformer)
+        start = tuple(offset + local_start[dim] if multiple > 0 else
+                      offset - local_start[dim] - local_size[dim] + 1 for
+                      dim, multiple, offset in
+                      zip(dim_order, multiples, offsets))
+        size = tuple(local_size[dim] for dim in dim_order)
+        return start, size
 
     def to_global(self, local_start, local_size):
         """Convert local coordinates to global coordinates"""
 
-        start = np.array(local_start)
-        size = np.array(local_size)
-
-        # Flip dimensions where necessary
-        start = np.add(np.multiply(start, self._flip_multiple),
-                       self._flip_offset)
-
-        # Reverse permute dimensions of local coordinates
-        start = start[self.axis.reverse_dim_order]
-        size = size[self.axis.reverse_dim_order]
+        # Undo flips, then reverse permute dimensions and translate to the
+        # global origin
+        start = [multiple * st + offset for st, multiple, offset in
+                 zip(local_start, self._flip_multiple, self._flip_offset)]
+        start = tuple(start[dim] + origin for dim, origin in
+                      zip(self._reverse_dim_order, self._origin))
+        size = tuple(local_size[dim] for dim in self._reverse_dim_order)
+        return start, size
 
-        # Translate coordinates to the global origin
-        start = np.add(start, self._origin)
-        size = np.array(size)  # Make sure global_size is a numpy array
+    def to_global_region(self, local_start, local_size):
+        """Convert a local region to global coordinates, where the starts of
+        both regions are their lowest coordinates along each dimension"""
 
-        return start, size
+        local_start = tuple(st + sz - 1 if flip else st for st, sz, flip in
+                            zip(local_start, local_size, self.axis.dim_flip))
+        return self.to_global(local_start, local_size)
 
     def image_to_local(self, global_image):
         """Transform global image to local coordinate system"""
 
-        local_image = global_image.transpose(self.axis.dim_order)
-
-        # Flip dimensions where necessary
-        local_image = local_image.flip(self.axis.dim_flip)
-
-        return local_image
+        return global_image.transform(self.axis.dim_order, self.axis.dim_flip)
 
     def image_to_other(self, local_image, other_transformer):
         """Transform image to a different local coordinate system"""
 
-        # Flip dimensions where necessary
-        local_image = local_image.flip(self.axis.dim_flip)
+        dim_order, dim_flip = get_axis_plan(self.axis, other_transformer.axis)
+        return local_image.transform(dim_order, dim_flip)
 
-        # Reverse permute dimensions of local coordinates
-        global_dim_order = np.array(self.axis.reverse_dim_order)
-        global_flip = np.array(self.axis.dim_flip)[global_dim_order]
-        local_dim_order = global_dim_order[other_transformer.axis.dim_order]
-        local_image = local_image.transpose(local_dim_order)
-        local_flip = global_flip[other_transformer.axis.dim_order]
-        local_flip = np.logical_xor(local_flip,
-                                    other_transformer.axis.dim_flip)
+    def image_to_global(self, local_image):
+        """Convert local coordinates to global coordinates"""
 
-        # Flip dimensions where necessary
-        local_image = local_image.flip(local_flip)
+        # Undo the flips, then reverse permute dimensions
+        dim_order = self.axis.reverse_dim_order
+        dim_flip = [self.axis.dim_flip[dim] for dim in dim_order]
+        return local_image.transform(dim_order, dim_flip)
 
-        return local_image
+    def _get_other_plan(self, other_transformer):
+        """Return (dim_order, multiples, offsets) for converting local
+        coordinates to the other local system. Only the axis plan is cached,
+        because the offsets depend on the origins and are cheap to compute"""
 
-    def image_to_global(self, local_image):
-        """Convert local coordinates to global coordinates"""
+        dim_order, dim_flip = get_axis_plan(self.axis, other_transformer.axis)
+        multiples = tuple(-1 if flip else 1 for flip in dim_flip)
+
+        # The other coordinates of this local origin
+        num_dims = len(self._dim_order)
+        global_start, _ = self.to_global((0,) * num_dims, (1,) * num_dims)
+        offsets, _ = other_transformer.to_local(global_start, (1,) * num_dims)
+        return dim_order, multiples, offsets
+
+
+# Transforms between pairs of Axis objects, indexed by their condensed format
+_AXIS_PLANS = {}
 
-        # Flip dimensions where necessary
-        local_image = local_image.flip(self.axis.dim_flip)
 
-        # Reverse permute dimensions of local coordinates
-        global_image = local_image.transpose(self.axis.reverse_dim_order)
+def get_axis_plan(axis, other_axis):
+    """Return (dim_order, dim_flip) for converting from the dimensions of axis
+    to the dimensions of other_axis. Dimension i of the other system is
+    dimension dim_order[i] of this system, reversed where dim_flip[i] is True.
+    Plans are computed once for each pair of axes"""
 
-        return global_image
+    key = (axis.key, other_axis.key)
+    plan = _AXIS_PLANS.get(key)
+    if plan is None:
+        dim_order = tuple(axis.reverse_dim_order[dim]
+                          for dim in other_axis.dim_order)
+        dim_flip = tuple(bool(axis.dim_flip[dim]) != bool(flip) for dim, flip
+                         in zip(dim_order, other_axis.dim_flip))
+        plan = (dim_order, dim_flip)
+        _AXIS_PLANS[key] = plan
+    return plan
 
 
 class Axis(object):
@@ -328,6 +926,7 @@ class Axis(object):
         self.dim_order = dim_order
         self.dim_flip = dim_flip
         self.reverse_dim_order = np.argsort(dim_order).tolist()
+        self.key = tuple(self.to_condensed_format())
 
     def to_condensed_format(self):
         """Creates a condensed Axis array for this Axis"""
@@ -0,0 +1,255 @@
+# coding=utf-8
+"""
+Histogram of image values which can be accumulated in a single pass
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+import io
+import json
+import math
+import os
+
+import numpy as np
+import six
+
+# Suffix added to the filename of an input file to give the file which caches
+# its histogram
+HISTOGRAM_CACHE_SUFFIX = '.histogram'
+
+
+class Histogram(object):
+    """Histogram of image values using a fixed number of bins.
+
+    Values are accumulated one block of data at a time. Bins have a width
+    which is a power of two and start at a multiple of the width. Whenever
+    new values do not fit in the current bins, the bin width is doubled, so
+    the memory used is bounded and histograms can always be merged. Integer
+    values are counted exactly until their range exceeds the number of bins
+    """
+
+    NUM_BINS = 65536
+
+    def __init__(self, num_bins=NUM_BINS):
+        self._num_bins = num_bins
+        self._counts = np.zeros(num_bins, dtype=np.int64)
+        self._exponent = None
+        self._first_bin = 0
+        self._is_integer = True
+
+    def add(self, image):
+        """Add the values in this image array to the histogram"""
+
+        values = np.asarray(image).ravel()
+        if values.dtype.kind == 'f':
+            self._is_integer = False
+            values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+
+        min_value = values.min()
+        max_value = values.max()
+        if self._exponent is None:
+            self._exponent = self._initial_exponent(values.dtype, min_value,
+                                                    max_value)
+        self._fit(self._to_bin(min_value), self._to_bin(max_value))
+
+        if self._exponent == 0 and values.dtype.kind in 'iu':
+            bins = values.astype(np.int64)
+        else:
+            bins = np.floor(np.ldexp(values.astype(np.float64),
+                                     -self._exponent)).astype(np.int64)
+        bins -= self._first_bin
+        self._counts += np.bincount(bins, minlength=self._num_bins)
+
+    def merge(self, other):
+        """Add the counts from another Histogram to this histogram"""
+
+        if other.get_count() == 0:
+            return
+        self._is_integer = self._is_integer and other.is_integer()
+        if self._exponent is None:
+            self._exponent = other.get_exponent()
+
+        while other.get_exponent() > self._exponent:
+            self._counts, self._first_bin = _double_bin_width(self._counts,
+                                                              self._first_bin)
+            self._exponent += 1
+
+        # Fitting the other bins may increase the bin width, in which case the
+        # other counts must be rebinned again
+        other_counts, other_first_bin, other_exponent = \
+            other.get_counts(), other.get_first_bin(), other.get_exponent()
+        while True:
+            while other_exponent < self._exponent:
+                other_counts, other_first_bin = _double_bin_width(
+                    other_counts, other_first_bin)
+                other_exponent += 1
+            used = np.flatnonzero(other_counts)
+            self._fit(other_first_bin + used[0], other_first_bin + used[-1])
+            if other_exponent == self._exponent:
+                break
+
+        offset = other_first_bin - self._first_bin
+        self._counts[offset + used] += other_counts[used]
+
+    def percentile(self, percent):
+        """Return the value at this percentile (0 to 100) of all values"""
+
+        total = self.get_count()
+        if total == 0:
+            raise ValueError('Cannot compute the percentile of an empty '
+                             'histogram')
+        rank = (total - 1) * float(percent) / 100.0
+        index = int(np.searchsorted(np.cumsum(self._counts), rank,
+                                    side='right'))
+        bin_start = math.ldexp(self._first_bin + index, self._exponent)
+        if self._is_integer and self._exponent == 0:
+            return int(bin_start)
+        return bin_start + math.ldexp(0.5, self._exponent)
+
+    def get_count(self):
+        """Return the total number of values in the histogram"""
+        return int(np.sum(self._counts))
+
+    def get_counts(self):
+        """Return the array of counts for each bin"""
+        return self._counts
+
+    def get_first_bin(self):
+        """Return the index of the first bin, in units of the bin width"""
+        return self._first_bin
+
+    def get_exponent(self):
+        """Return the bin width as a power of two"""
+        return self._exponent
+
+    def is_integer(self):
+        """True if only integer values have been added"""
+        return self._is_integer
+
+    def to_dict(self):
+        """Return the histogram as a dict which can be saved as JSON"""
+        used = np.flatnonzero(self._counts)
+        return {"num_bins": self._num_bins,
+                "exponent": self._exponent,
+                "first_bin": int(self._first_bin),
+                "is_integer": self._is_integer,
+                "bins": used.tolist(),
+                "counts": self._counts[used].tolist()}
+
+    @classmethod
+    def from_dict(cls, values):
+        """Return a Histogram from a dict created by to_dict()"""
+        histogram = cls(values["num_bins"])
+        histogram._exponent = values["exponent"]
+        histogram._first_bin = values["first_bin"]
+        histogram._is_integer = values["is_integer"]
+        histogram._counts[values["bins"]] = values["counts"]
+        return histogram
+
+    def _initial_exponent(self, dtype, min_value, max_value):
+        value_range = float(max_value) - float(min_value)
+        if dtype.kind in 'iu' and value_range < self._num_bins:
+            return 0
+        bin_width = value_range / (self._num_bins - 2)
+        if bin_width <= 0:
+            return 0
+        return int(math.ceil(math.log(bin_width, 2)))
+
+    def _to_bin(self, value):
+        return int(math.floor(math.ldexp(float(value), -self._exponent)))
+
+    def _fit(self, min_bin, max_bin):
+        """Adjust the bins so they include the bins min_bin to max_bin, which
+        are specified in units of the current bin width"""
+
+        used = np.flatnonzero(self._counts)
+        if used.size:
+            min_bin = min(min_bin, self._first_bin + used[0])
+            max_bin = max(max_bin, self._first_bin + used[-1])
+
+        # Double the bin width until the values fit in the histogram
+        while max_bin - min_bin >= self._num_bins:
+            self._counts, self._first_bin = _double_bin_width(self._counts,
+                                                              self._first_bin)
+            self._exponent += 1
+            min_bin = min_bin // 2
+            max_bin = max_bin // 2
+
+        # Move the bins so that the first bin is min_bin
+        if min_bin < self._first_bin or \
+                max_bin >= self._first_bin + self._num_bins:
+            used = np.flatnonzero(self._counts)
+            counts = np.zeros_like(self._counts)
+            offset = self._first_bin - min_bin
+            counts[offset + used] = self._counts[used]
+            self._counts = counts
+            self._first_bin = min_bin
+
+
+def _double_bin_width(counts, first_bin):
+    """Return counts and first bin index after doubling the bin width"""
+
+    new_first_bin = first_bin // 2
+    used = np.flatnonzero(counts)
+    new_counts = np.zeros_like(counts)
+    np.add.at(new_counts, (first_bin + used) // 2 - new_first_bin,
+              counts[used])
+    return new_counts, new_first_bin
+
+
+def get_histogram_cache_key(filenames, region):
+    """Return a key identifying the contents of the files storing an image
+    and the region of the image covered by a histogram. The key changes if
+    any of the files is modified"""
+
+    files = []
+    for filename in filenames:
+        filename = os.path.abspath(filename)
+        try:
+            stat = os.stat(filename)
+            files.append([filename, stat.st_size, stat.st_mtime])
+        except OSError:
+            files.append([filename, None, None])
+    return {"files": files, "region": [[int(value) for value in values]
+                                       for values in region]}
+
+
+def load_cached_histogram(filename, key):
+    """Return the Histogram cached for the input file filename, or None if
+    there is no cached histogram with this key"""
+
+    try:
+        with io.open(filename + HISTOGRAM_CACHE_SUFFIX,
+                     encoding='utf-8') as cache_file:
+            cache = json.loads(cache_file.read())
+    except (IOError, OSError, ValueError):
+        return None
+    if cache.get("key") != key:
+        return None
+    return Histogram.from_dict(cache["histogram"])
+
+
+def save_cached_histogram(filename, key, histogram):
+    """Cache the histogram of the input file filename in a file alongside
+    it. The histogram is not cached if the file cannot be written, for
+    example if the input folder is read-only"""
+
+    cache_filename = filename + HISTOGRAM_CACHE_SUFFIX
+    temp_filename = cache_filename + '.' + str(os.getpid())
+    try:
+        text = json.dumps({"key": key, "histogram": histogram.to_dict()},
+                          ensure_ascii=True)
+        with io.open(temp_filename, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(six.text_type(text))
+
+        # Renaming means processes reading the cache at the same time never
+        # see a partly written file
+        if os.path.exists(cache_filename):
+            os.remove(cache_filename)
+        os.rename(temp_filename, cache_filename)
+    except (IOError, OSError):
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
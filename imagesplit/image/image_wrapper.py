@@ -1,5 +1,6 @@
 # coding=utf-8
 """A wrapper for a multi-dimensional image with an origin offset"""
+import threading
 from abc import abstractmethod
 
 from PIL import Image
@@ -102,7 +103,8 @@ class SmartImage(ImageWrapper):
     def coords_to_other(self, transformer):
         """Converts coordinates to another system"""
 
-        return self._transformer.to_other(self.origin, self.size, transformer)
+        return self._transformer.to_other_region(self.origin, self.size,
+                                                 transformer)
 
     def transform_coords(self, sub_image):
         return sub_image.coords_to_other(self._transformer)
@@ -126,12 +128,15 @@ class ImageStorage(object):
     def set(self, selector, image):
         """Replaces part of the image data using the specified selectors"""
 
-        self._numpy_image[list(reversed(selector))] = image.get_raw()
+        # Basic slicing gives a view, so data are copied directly from the
+        # (possibly transposed and flipped) source view into this image
+        np.copyto(self._numpy_image[tuple(reversed(selector))],
+                  image.get_raw(), casting='unsafe')
 
     def get(self, selector):
         """Returns part of the image data using the specified selectors"""
 
-        return ImageStorage(self._numpy_image[list(reversed(selector))])
+        return ImageStorage(self._numpy_image[tuple(reversed(selector))])
 
     def get_size(self):
         """Returns the image size in the global dimension ordering scheme"""
@@ -169,13 +174,17 @@ class ImageStorage(object):
                                          list(reversed(order))))
 
     def flip(self, do_flip):
-        """Return a copy of image data flipped using global ordering"""
+        """Return a view of image data flipped using global ordering"""
 
-        image = self._numpy_image
-        for index, flip in enumerate(do_flip):
-            if flip:
-                image = np.flip(image, len(do_flip) - 1 - index)
-        return ImageStorage(image)
+        return ImageStorage(self._numpy_image[_flip_selector(do_flip)])
+
+    def transform(self, order, do_flip):
+        """Return a view of the image data transposed and then flipped using
+        global ordering, equivalent to transpose(order).flip(do_flip)"""
+
+        order = [len(order) - 1 - dim for dim in reversed(order)]
+        return ImageStorage(np.transpose(self._numpy_image,
+                                         order)[_flip_selector(do_flip)])
 
     def reshape(self, new_shape):
         """Return a reshaping of the image data using global ordering"""
@@ -205,6 +214,14 @@ class ImageStorage(object):
         raw = np.zeros(shape=list(reversed(size)), dtype=dtype)
         return cls(numpy_image=raw)
 
+    @classmethod
+    def create_uninitialised(cls, size, dtype):
+        """Create object of the specified global size and data type without
+        initialising the data"""
+
+        raw = np.empty(shape=list(reversed(size)), dtype=dtype)
+        return cls(numpy_image=raw)
+
     @classmethod
     def from_raw_image(cls, raw, size=None):
         """Create ImageStorage object from this image data array"""
@@ -217,3 +234,47 @@ class ImageStorage(object):
         if size:
             raw = np.reshape(raw, size)
         return cls(np.transpose(raw))
+
+
+class BufferPool(object):
+    """Reusable image buffers, so that repeatedly reading images of the same
+    size does not allocate and page fault new memory for every read. Buffers
+    can be taken and returned from multiple threads"""
+
+    def __init__(self, max_buffers=4):
+        self._max_buffers = max_buffers
+        self._num_buffers = 0
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def get(self, size, dtype):
+        """Return an ImageStorage of the specified global size and data type.
+        The contents of the image are undefined"""
+
+        with self._lock:
+            free = self._free.get((tuple(size), np.dtype(dtype)))
+            if free:
+                self._num_buffers -= 1
+                return ImageStorage(free.pop())
+        return ImageStorage.create_uninitialised(size, dtype)
+
+    def release(self, image):
+        """Return an ImageStorage to the pool so its memory can be reused.
+        The image must not be used after it has been released"""
+
+        raw = image.get_raw()
+        if raw.base is not None or not raw.flags.c_contiguous:
+            return
+        key = (tuple(reversed(raw.shape)), raw.dtype)
+        with self._lock:
+            if self._num_buffers < self._max_buffers:
+                self._free.setdefault(key, []).append(raw)
+                self._num_buffers += 1
+
+
+def _flip_selector(do_flip):
+    """Return a tuple of slices which flips a raw image along the dimensions
+    selected by do_flip, which is in global ordering"""
+
+    return tuple(slice(None, None, -1) if flip else slice(None)
+                 for flip in reversed(do_flip))
@@ -0,0 +1,87 @@
+# coding=utf-8
+"""
+Run file reading and writing tasks concurrently, using asyncio to schedule the
+tasks and a pool of threads to carry out the blocking file operations
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+class AsyncEngine(object):
+    """Runs tasks with up to max_in_flight tasks in progress at once.
+
+    Each task is a function with no arguments which carries out blocking
+    file operations. The tasks run in a pool of num_threads threads, so while
+    one task waits for the file system, others can read or write different
+    files. Tasks must be safe to run at the same time as each other"""
+
+    def __init__(self, max_in_flight=4, num_threads=None):
+        if asyncio is None:
+            raise ValueError('The async engine requires Python 3')
+        if max_in_flight < 1:
+            raise ValueError('At least one task must be allowed in flight')
+        self._max_in_flight = max_in_flight
+        self._num_threads = num_threads or max_in_flight
+
+    def run(self, tasks):
+        """Run each of the tasks, returning when all have completed. If a task
+        raises an exception, no further tasks are started and the exception
+        is raised once the tasks in progress have finished"""
+
+        loop = asyncio.new_event_loop()
+        try:
+            with ThreadPoolExecutor(self._num_threads) as executor:
+                scheduler = _Scheduler(loop, executor, tasks,
+                                       self._max_in_flight)
+                loop.run_until_complete(scheduler.start())
+        finally:
+            loop.close()
+
+
+class _Scheduler(object):
+    """Starts tasks on an executor from the event loop, replacing each task
+    as it finishes so that a fixed number are in flight"""
+
+    def __init__(self, loop, executor, tasks, max_in_flight):
+        self._loop = loop
+        self._executor = executor
+        self._tasks = iter(tasks)
+        self._max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._error = None
+        self._finished = loop.create_future()
+
+    def start(self):
+        """Start the first tasks and return a future which completes when all
+        the tasks have finished"""
+        self._loop.call_soon(self._submit)
+        return self._finished
+
+    def _submit(self):
+        while self._error is None and self._in_flight < self._max_in_flight:
+            task = next(self._tasks, None)
+            if task is None:
+                break
+            self._in_flight += 1
+            future = self._loop.run_in_executor(self._executor, task)
+            future.add_done_callback(self._task_done)
+
+        if self._in_flight == 0 and not self._finished.done():
+            if self._error is None:
+                self._finished.set_result(None)
+            else:
+                self._finished.set_exception(self._error)
+
+    def _task_done(self, future):
+        self._in_flight -= 1
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+        self._submit()
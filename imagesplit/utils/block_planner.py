@@ -0,0 +1,207 @@
+# coding=utf-8
+"""
+Choose how to divide an image into a given number of blocks, based on an
+estimate of the cost of reading each block from the input files
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+import itertools
+from math import ceil
+
+import numpy as np
+
+from imagesplit.utils.utilities import get_block_coordinate_range
+
+# Estimated cost of one seek or file open, as the equivalent number of bytes
+# that could have been read sequentially in the same time
+SEEK_COST_BYTES = 2 ** 20
+
+# Typical file system block size
+FILESYSTEM_BLOCK_BYTES = 4096
+
+
+def plan_block_size(image_size, num_blocks, axis_order, overlap_size,
+                    bytes_per_voxel, file_boundaries=None,
+                    seek_cost=SEEK_COST_BYTES,
+                    fs_block_bytes=FILESYSTEM_BLOCK_BYTES):
+    """Returns the block size in each dimension which splits the image into
+    exactly num_blocks blocks at the lowest estimated cost of reading them.
+
+    axis_order lists the global dimensions in the order they are stored in
+    the input file, fastest first. file_boundaries optionally lists, for each
+    dimension, the coordinates at which a new input file begins. Block
+    boundaries are aligned to input file and file system block boundaries
+    where this lowers the cost"""
+
+    if file_boundaries is None:
+        file_boundaries = [[] for _ in image_size]
+
+    best_cost = None
+    best_block_size = None
+    for number_of_blocks in _factorisations(num_blocks, len(image_size)):
+        for block_size in _candidate_block_sizes(
+                image_size, number_of_blocks, axis_order, bytes_per_voxel,
+                file_boundaries, fs_block_bytes):
+            cost = estimate_read_cost(
+                image_size, block_size, axis_order, overlap_size,
+                bytes_per_voxel, file_boundaries, seek_cost, fs_block_bytes)
+            if best_cost is None or cost < best_cost:
+                best_cost = cost
+                best_block_size = block_size
+
+    if best_block_size is None:
+        raise ValueError('The image cannot be split into exactly ' +
+                         str(num_blocks) + ' blocks')
+    return best_block_size
+
+
+def estimate_read_cost(image_size, block_size, axis_order, overlap_size,
+                       bytes_per_voxel, file_boundaries, seek_cost,
+                       fs_block_bytes):
+    """Returns the estimated cost, in bytes, of reading every block of the
+    specified size. The cost is the number of bytes read, plus seek_cost for
+    each seek or file open, plus the partial file system blocks read at the
+    ends of each contiguous run"""
+
+    # The extents of the blocks along each dimension, including overlap
+    extents = [_block_extents(size, block, overlap) for size, block, overlap
+               in zip(image_size, block_size, overlap_size)]
+    num_blocks = int(np.prod([len(extent) for extent in extents]))
+
+    # The blocks form a grid, so totals over all blocks are products of the
+    # totals along each dimension
+    voxels_read = np.prod([float(sum(extent[1] - extent[0] + 1
+                                     for extent in dim_extents))
+                           for dim_extents in extents])
+
+    # Each additional input file within a block requires a further seek
+    file_opens = np.prod([float(sum(_count_segments(extent, boundaries)
+                                    for extent in dim_extents))
+                          for dim_extents, boundaries in
+                          zip(extents, file_boundaries)])
+
+    # Contiguous runs continue along the fastest axes until an axis is
+    # reached which is not read in full. A run which starts or ends part way
+    # through a file system block reads the whole of that block
+    num_runs = float(num_blocks)
+    wasted_bytes = 0.0
+    inner_bytes = bytes_per_voxel
+    for position, dim in enumerate(axis_order):
+        if len(extents[dim]) > 1 or extents[dim][0][1] < image_size[dim] - 1:
+            misaligned = sum(
+                1 for first, last in extents[dim]
+                if (first * inner_bytes) % fs_block_bytes or
+                (last + 1 < image_size[dim] and
+                 ((last + 1) * inner_bytes) % fs_block_bytes))
+            outer_runs = np.prod([float(sum(last - first + 1
+                                            for first, last in extents[outer]))
+                                  for outer in axis_order[position + 1:]])
+            num_runs = len(extents[dim]) * outer_runs
+            wasted_bytes = misaligned * outer_runs * fs_block_bytes
+            break
+        inner_bytes *= image_size[dim]
+
+    seeks = num_runs + file_opens - num_blocks
+    return voxels_read * bytes_per_voxel + wasted_bytes + seeks * seek_cost
+
+
+def _factorisations(number, num_dims):
+    """Yields each way of writing number as an ordered product of num_dims
+    positive integers"""
+
+    if num_dims == 1:
+        yield [number]
+        return
+    for factor in range(1, number + 1):
+        if number % factor == 0:
+            for rest in _factorisations(number // factor, num_dims - 1):
+                yield [factor] + rest
+
+
+def _candidate_block_sizes(image_size, number_of_blocks, axis_order,
+                           bytes_per_voxel, file_boundaries, fs_block_bytes):
+    """Yields block sizes which give exactly the specified number of blocks
+    in each dimension. Along each dimension, the candidates are an even
+    split and, where possible, splits aligned to input file boundaries and
+    file system block boundaries"""
+
+    candidates = []
+    inner_bytes = bytes_per_voxel
+    for dim in axis_order:
+        size = image_size[dim]
+        num = number_of_blocks[dim]
+        if num > size:
+            return
+        units = [_file_unit(file_boundaries[dim])]
+        if inner_bytes % fs_block_bytes:
+            units.append(fs_block_bytes // _gcd(inner_bytes, fs_block_bytes))
+        sizes = set(_aligned_sizes(size, num, units))
+        even = int(ceil(float(size) / num))
+        if _num_blocks(size, even) == num:
+            sizes.add(even)
+        if not sizes:
+            return
+        candidates.append((dim, sorted(sizes)))
+        inner_bytes *= size
+
+    block_size = [0] * len(image_size)
+    for choice in itertools.product(*[sizes for _, sizes in candidates]):
+        for (dim, _), size in zip(candidates, choice):
+            block_size[dim] = size
+        yield list(block_size)
+
+
+def _aligned_sizes(size, num, units):
+    """Returns block sizes which are multiples or divisors of the alignment
+    units and which split size into exactly num blocks"""
+
+    aligned = []
+    for unit in units:
+        if not unit or unit <= 1:
+            continue
+        multiple = unit * int(ceil(float(size) / (num * unit)))
+        if _num_blocks(size, multiple) == num:
+            aligned.append(multiple)
+        for divisor in range(int(ceil(float(size) / num)), unit):
+            if unit % divisor == 0:
+                if _num_blocks(size, divisor) == num:
+                    aligned.append(divisor)
+                break
+    return aligned
+
+
+def _block_extents(size, block_size, overlap):
+    """Returns the first and last coordinates read for each block along one
+    dimension"""
+
+    return [get_block_coordinate_range(index, block_size, overlap, size)[0:2]
+            for index in range(_num_blocks(size, block_size))]
+
+
+def _count_segments(extent, boundaries):
+    """Returns the number of input files which overlap this extent"""
+
+    return 1 + sum(1 for boundary in boundaries
+                   if extent[0] < boundary <= extent[1])
+
+
+def _file_unit(boundaries):
+    """Returns the spacing of the input file boundaries if they are evenly
+    spaced, otherwise None"""
+
+    if not boundaries:
+        return None
+    spacings = set(np.diff([0] + sorted(boundaries)).tolist())
+    return spacings.pop() if len(spacings) == 1 else None
+
+
+def _num_blocks(size, block_size):
+    return int(ceil(float(size) / block_size))
+
+
+def _gcd(value_a, value_b):
+    while value_b:
+        value_a, value_b = value_b, value_a % value_b
+    return value_a
@@ -0,0 +1,88 @@
+# coding=utf-8
+"""
+Checksums of the data stored in split files, which are computed as the data
+are written and stored in the descriptor file so that the files can be
+verified later
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+import zlib
+
+# Checksums are stored as strings of the form "crc32:0123abcd"
+CHECKSUM_ALGORITHM = 'crc32'
+
+# Maximum number of bytes held in memory when computing a checksum of a file
+CHECKSUM_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+class RunningChecksum(object):
+    """Checksum of data which are written in order from the start of a
+    region. If any data are written out of order, or written without
+    passing through update(), the checksum is marked as invalid"""
+
+    def __init__(self):
+        self._value = 0
+        self._next_offset = 0
+        self._valid = True
+
+    def update(self, offset, data):
+        """Add data written at this byte offset from the start of the region"""
+        if self._valid and offset == self._next_offset:
+            self._value = zlib.crc32(data, self._value)
+            self._next_offset += getattr(data, 'nbytes', len(data))
+        else:
+            self._valid = False
+
+    def is_next(self, offset):
+        """True if data written at this offset would be added to the
+        checksum, because the checksum is valid and all the data before this
+        offset have been written"""
+        return self._valid and offset == self._next_offset
+
+    def invalidate(self):
+        """Mark the checksum invalid, because data have been written which
+        were not passed to update()"""
+        self._valid = False
+
+    def get_checksum(self, num_bytes):
+        """Return the checksum if exactly num_bytes have been written in
+        order, otherwise None"""
+        if self._valid and self._next_offset == num_bytes:
+            return format_checksum(self._value)
+        return None
+
+
+def format_checksum(value):
+    """Return the string representation of a crc32 checksum value"""
+    return '{0}:{1:08x}'.format(CHECKSUM_ALGORITHM, value & 0xffffffff)
+
+
+def compute_checksum(read_function, num_bytes,
+                     chunk_bytes=CHECKSUM_CHUNK_BYTES):
+    """Return the checksum of num_bytes bytes, read in chunks by calling
+    read_function(offset, num_bytes) with offsets from the start of the
+    data"""
+
+    value = 0
+    offset = 0
+    while offset < num_bytes:
+        data = read_function(offset, min(chunk_bytes, num_bytes - offset))
+        if not data:
+            raise ValueError('File is shorter than expected')
+        value = zlib.crc32(data, value)
+        offset += len(data)
+    return format_checksum(value)
+
+
+def compute_file_checksum(filename, chunk_bytes=CHECKSUM_CHUNK_BYTES):
+    """Return the checksum of the whole of this file"""
+
+    with open(filename, 'rb') as data_file:
+        value = 0
+        while True:
+            data = data_file.read(chunk_bytes)
+            if not data:
+                return format_checksum(value)
+            value = zlib.crc32(data, value)
@@ -7,8 +7,11 @@ Copyright UCL 2017
 
 """
 
+import base64
 import copy
+import itertools
 import os
+import re
 
 import numpy as np
 
@@ -16,8 +19,30 @@ from imagesplit.file.format_factory import FormatFactory
 from imagesplit.file.metaio_reader import load_mhd_header
 from imagesplit.image.combined_image import Axis
 from imagesplit.utils.json_reader import write_json, read_json
-from imagesplit.utils.utilities import ranges_for_max_block_size, \
-    convert_to_array
+from imagesplit.utils.parallel import parallel_map
+from imagesplit.utils.utilities import convert_to_array, \
+    get_number_of_blocks, iter_block_ranges
+
+
+# Version 1.0 descriptors store a list with an entry for each split file.
+# Version 1.1 descriptors store the split files as columns, where values shared
+# by all files are stored once and integer columns are stored as binary arrays.
+# This is much faster to load for very many files, but cannot be read by older
+# versions of ImageSplit, so is only written on request
+DESCRIPTOR_VERSION = "1.0"
+COMPACT_DESCRIPTOR_VERSION = "1.1"
+_READABLE_VERSIONS = [DESCRIPTOR_VERSION, COMPACT_DESCRIPTOR_VERSION]
+_ARRAY_COLUMNS = ["index", "ranges"]
+
+# Output layouts: flat writes every output file to the same folder, while
+# nested writes them to subfolders named by the block coordinates
+LAYOUT_FLAT = "flat"
+LAYOUT_NESTED = "nested"
+LAYOUTS = [LAYOUT_FLAT, LAYOUT_NESTED]
+
+# In the nested layout, the maximum number of blocks along the last divided
+# dimension which share a folder
+NESTED_FOLDER_SIZE = 1000
 
 
 class SubImageRanges(object):
@@ -75,7 +100,8 @@ class SubImageDescriptor(object):
 
     def __init__(self, filename, file_format, data_type,
                  template, ranges, dim_order_condensed, suffix, index, msb,
-                 compression, voxel_size):
+                 compression, voxel_size, container=None, offset=None,
+                 checksum=None):
         self.suffix = suffix
         self.index = index
         self.filename = filename
@@ -88,6 +114,15 @@ class SubImageDescriptor(object):
         self.compression = compression
         self.voxel_size = voxel_size
 
+        # If the file is stored in a container file, the container filename
+        # and the byte offset of the image data within it
+        self.container = container
+        self.offset = offset
+
+        # Checksum of the stored data (see imagesplit.utils.checksum), which
+        # is set once the file has been written
+        self.checksum = checksum
+
     def get_local_size(self):
         """Transpose the subimage size to the local coordinate system"""
         return np.take(self.ranges.image_size, self.axis.dim_order).tolist()
@@ -115,22 +150,31 @@ class SubImageDescriptor(object):
             msb=descriptor_dict["msb"],
             compression=descriptor_dict["compression"],
             voxel_size=descriptor_dict["voxel_size"],
+            container=descriptor_dict.get("container"),
+            offset=descriptor_dict.get("offset"),
+            checksum=descriptor_dict.get("checksum"),
         )
 
     def to_dict(self):
         """Get a dictionary for the metadata for this subimage"""
 
-        return {"index": self.index,
-                "suffix": self.suffix,
-                "filename": self.filename,
-                "data_type": self.data_type,
-                "file_format": self.file_format,
-                "template": self.template,
-                "dim_order": self.axis.to_condensed_format(),
-                "compression": self.compression,
-                "msb": self.msb,
-                "voxel_size": self.voxel_size,
-                "ranges": self.ranges.ranges}
+        descriptor_dict = {"index": self.index,
+                           "suffix": self.suffix,
+                           "filename": self.filename,
+                           "data_type": self.data_type,
+                           "file_format": self.file_format,
+                           "template": self.template,
+                           "dim_order": self.axis.to_condensed_format(),
+                           "compression": self.compression,
+                           "msb": self.msb,
+                           "voxel_size": self.voxel_size,
+                           "ranges": self.ranges.ranges}
+        if self.container:
+            descriptor_dict["container"] = self.container
+            descriptor_dict["offset"] = self.offset
+        if self.checksum:
+            descriptor_dict["checksum"] = self.checksum
+        return descriptor_dict
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -142,18 +186,111 @@ class SubImageDescriptor(object):
 
 
 def write_descriptor_file(descriptors_in, descriptors_out, filename_out_base,
-                          test=False):
-    """Saves descriptor files"""
+                          test=False, shard=None, compact=False):
+    """Saves descriptor files
+
+    If shard is specified as (shard_index, num_shards) then a partial
+    descriptor is written, which can be combined with the other partial
+    descriptors using merge_descriptor_files(). If compact is True, the
+    version 1.1 column format is written (see encode_split_files)
+    """
     dict_in = convert_to_dict(descriptors_in)
-    dict_out = convert_to_dict(descriptors_out)
-    descriptor = {"appname": "ImageSplit data", "version": "1.0",
-                  "split_files": dict_out,
-                  "source_files": dict_in}
-    descriptor_output_filename = filename_out_base + "_info.imagesplit"
+    descriptor = _create_descriptor(convert_to_dict(descriptors_out),
+                                    dict_in, compact)
+    if shard:
+        descriptor["shard"] = list(shard)
+    descriptor_output_filename = get_descriptor_filename(filename_out_base,
+                                                         shard)
     if not test:
         write_json(descriptor_output_filename, descriptor)
 
 
+def get_descriptor_filename(filename_out_base, shard=None):
+    """Returns the descriptor filename for this output, or the partial
+    descriptor filename if a shard (shard_index, num_shards) is specified"""
+    if shard:
+        return filename_out_base + "_info_shard_{0}_of_{1}.imagesplit".format(
+            shard[0], shard[1])
+    return filename_out_base + "_info.imagesplit"
+
+
+def select_shard(descriptors, shard_index, num_shards):
+    """Returns the deterministic subset of descriptors to be processed by
+    shard number shard_index (numbered from 1) out of num_shards"""
+    if num_shards < 1 or shard_index < 1 or shard_index > num_shards:
+        raise ValueError('Shard must be of the form i/N where 1 <= i <= N')
+
+    # Interleave descriptors between shards so that each shard gets a similar
+    # mix of block sizes
+    return descriptors[shard_index - 1::num_shards]
+
+
+def merge_descriptor_files(partial_filenames, descriptor_output_filename=None):
+    """Combines partial descriptors written by each shard of a split into a
+    single descriptor file. Returns the name of the combined descriptor"""
+
+    if not partial_filenames:
+        raise ValueError('No partial descriptor files were specified')
+
+    source_files = None
+    num_shards = None
+    compact = False
+    shards_found = set()
+    split_files = []
+    for partial_filename in partial_filenames:
+        partial = load_descriptor(partial_filename)
+        if "shard" not in partial:
+            raise ValueError(partial_filename + ' is not a partial descriptor')
+        shard_index, shard_count = partial["shard"]
+        if num_shards is None:
+            num_shards = shard_count
+            source_files = partial["source_files"]
+        elif shard_count != num_shards:
+            raise ValueError('Partial descriptors come from splits with '
+                             'different numbers of shards')
+        elif partial["source_files"] != source_files:
+            raise ValueError('Partial descriptors come from different source '
+                             'files')
+        if shard_index in shards_found:
+            raise ValueError('Shard ' + str(shard_index) + ' was specified '
+                             'more than once')
+        shards_found.add(shard_index)
+        split_files.extend(partial["split_files"])
+        compact = compact or partial["version"] == COMPACT_DESCRIPTOR_VERSION
+
+    missing = sorted(set(range(1, num_shards + 1)) - shards_found)
+    if missing:
+        raise ValueError('Missing partial descriptors for shards ' +
+                         ', '.join(str(m) for m in missing))
+
+    if not descriptor_output_filename:
+        descriptor_output_filename = re.sub(
+            r'_info_shard_\d+_of_\d+\.imagesplit$', '_info.imagesplit',
+            partial_filenames[0])
+        if descriptor_output_filename == partial_filenames[0]:
+            raise ValueError('Cannot determine the output descriptor name '
+                             'from ' + partial_filenames[0])
+
+    descriptor = _create_descriptor(
+        sorted(split_files, key=lambda k: k['index']), source_files, compact)
+    write_json(descriptor_output_filename, descriptor)
+    return descriptor_output_filename
+
+
+def _create_descriptor(split_files, source_files, compact):
+    """Return the contents of a descriptor file for these lists of split
+    file and source file dictionaries"""
+    if compact:
+        return {"appname": "ImageSplit data",
+                "version": COMPACT_DESCRIPTOR_VERSION,
+                "split_files": encode_split_files(split_files),
+                "source_files": source_files}
+    return {"appname": "ImageSplit data",
+            "version": DESCRIPTOR_VERSION,
+            "split_files": split_files,
+            "source_files": source_files}
+
+
 # pylint: disable=too-many-arguments
 def generate_output_descriptors(filename_out_base,
                                 max_block_size_voxels,
@@ -166,22 +303,43 @@ def generate_output_descriptors(filename_out_base,
                                 image_size,
                                 msb,
                                 compression,
-                                voxel_size):
-    """Creates descriptors representing file output"""
+                                voxel_size,
+                                block_size=None,
+                                layout=LAYOUT_FLAT):
+    """Creates descriptors representing file output. If block_size is
+    specified, the image is divided into blocks of exactly this size (except
+    at the end of each dimension) instead of being evenly divided into blocks
+    no larger than max_block_size_voxels. layout is one of LAYOUTS"""
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown output layout ' + str(layout))
+    if block_size:
+        max_block_size_voxels = block_size
     max_block_size_voxels_array = convert_to_array(max_block_size_voxels,
                                                    "block size", num_dims)
     overlap_voxels_size_array = convert_to_array(overlap_size_voxels,
                                                  "overlap size", num_dims)
-    ranges = ranges_for_max_block_size(image_size, max_block_size_voxels_array,
-                                       overlap_voxels_size_array)
+    number_of_blocks = get_number_of_blocks(image_size,
+                                            max_block_size_voxels_array)
+    num_files = int(np.prod(number_of_blocks))
+    ranges = iter_block_ranges(image_size, number_of_blocks,
+                               overlap_voxels_size_array, block_size)
+
+    block_numbers = itertools.product(
+        *[range(num_blocks) for num_blocks in number_of_blocks])
 
     extension = FormatFactory.get_extension_for_format(output_file_format)
+    out_folder, out_name = os.path.split(filename_out_base)
     descriptors_out = []
     index = 0
-    for subimage_range in ranges:
-        suffix = "" if len(ranges) <= 1 else \
+    for subimage_range, block_number in zip(ranges, block_numbers):
+        suffix = "" if num_files <= 1 else \
             "_" + '{0:04d}'.format(index)
         output_filename_header = filename_out_base + suffix + extension
+        if layout == LAYOUT_NESTED:
+            output_filename_header = os.path.join(
+                out_folder,
+                *(get_nested_subfolders(block_number, number_of_blocks) +
+                  [out_name + suffix + extension]))
         file_descriptor_out = SubImageDescriptor(
             filename=output_filename_header,
             file_format=output_file_format,
@@ -200,19 +358,67 @@ def generate_output_descriptors(filename_out_base,
     return descriptors_out
 
 
+def get_nested_subfolders(block_number, number_of_blocks,
+                          folder_size=NESTED_FOLDER_SIZE):
+    """Returns the list of subfolders for a block in the nested layout.
+
+    Of the dimensions which are divided into more than one block, each but
+    the last gives a subfolder named by the block's number along it. Blocks
+    which differ only along the last divided dimension share a folder,
+    unless there are more than folder_size of them, in which case they are
+    grouped into subfolders of folder_size blocks"""
+
+    divided = [(number, num_blocks) for number, num_blocks in
+               zip(block_number, number_of_blocks) if num_blocks > 1]
+    if not divided:
+        return []
+    subfolders = ['{0:04d}'.format(number) for number, _ in divided[:-1]]
+    last_number, last_num_blocks = divided[-1]
+    if last_num_blocks > folder_size:
+        subfolders.append('{0:04d}'.format(last_number // folder_size))
+    return subfolders
+
+
 def load_descriptor(descriptor_filename):
-    """Loads and parses a file descriptor from disk"""
+    """Loads and parses a file descriptor from disk. The split files are
+    returned as a list of dictionaries, whatever the file version"""
+    data = _load_descriptor_data(descriptor_filename)
+    if isinstance(data["split_files"], dict):
+        data["split_files"] = DescriptorTable(data["split_files"]).to_dicts()
+    return data
+
+
+def load_split_descriptors(descriptor_filename, filename_override=None):
+    """Returns a DescriptorTable of the split files listed in a descriptor
+    file. If filename_override is specified, the filenames are changed as
+    described in DescriptorTable"""
+    data = _load_descriptor_data(descriptor_filename)
+    return DescriptorTable(data["split_files"], filename_override)
+
+
+def load_split_image(descriptor_filename, filename_override=None):
+    """Returns a DescriptorTable of the split files listed in a descriptor
+    file, and a GlobalImageDescriptor of the image they form. Unlike
+    header_from_descriptor(), the original source file is not needed"""
+    descriptors = load_split_descriptors(descriptor_filename,
+                                         filename_override)
+    return descriptors, _aggregate_global_descriptor(descriptors)
+
+
+def _load_descriptor_data(descriptor_filename):
     data = read_json(descriptor_filename)
     if data["appname"] != "ImageSplit data":
         raise ValueError('Not an ImageSplit file')
-    if data["version"] != "1.0":
+    if data["version"] not in _READABLE_VERSIONS:
         raise ValueError('Cannot read this file version')
     return data
 
 
 def header_from_descriptor(descriptor_filename, filename_override):
-    """Create a file header based on descriptor information"""
-    descriptor = load_descriptor(descriptor_filename)
+    """Create a file header based on descriptor information. The descriptors
+    are returned as a DescriptorTable, so that each SubImageDescriptor is
+    only created when it is used"""
+    descriptor = _load_descriptor_data(descriptor_filename)
     original_file_list = descriptor["source_files"]
     if len(original_file_list) != 1:
         raise ValueError(
@@ -224,16 +430,8 @@ def header_from_descriptor(descriptor_filename, filename_override):
         original_header = load_mhd_header(original_file_descriptor["filename"])
     else:
         original_header = None  # ToDo
-    input_file_list = descriptor["split_files"]
-
-    if filename_override:
-        input_file_base, extension = os.path.splitext(filename_override)
-        for input_file in input_file_list:
-            # old_filename = input_file["filename"]
-            filename = input_file_base + input_file["suffix"] + extension
-            input_file["filename"] = filename
-
-    descriptors = convert_to_descriptors(input_file_list)
+    descriptors = DescriptorTable(descriptor["split_files"],
+                                  filename_override)
 
     global_descriptor = _aggregate_global_descriptor(descriptors)
 
@@ -253,24 +451,31 @@ def generate_input_descriptors(input_file, start_index):
 
     if start_index is None:
         # If no start index is specified, load a single header file
-        file_index = 0
-        format_str = ""
+        first_index = 0
+        suffixes = [""] if os.path.isfile(input_file) else []
     else:
         # Load a series of files starting with the specified prefix
-        file_index = start_index
-        format_str = _get_format_string(extension, input_file_base, start_index)
-
-    suffix = format_str.format(start_index)
-    header_filename = input_file_base + suffix + extension
+        first_index = start_index
+        suffixes = _find_series_suffixes(input_file_base, extension,
+                                         start_index)
 
-    if not os.path.isfile(header_filename):
+    if not suffixes:
         raise ValueError(
-            'No file series found starting with ' + header_filename)
+            'No file series found starting with ' + input_file_base +
+            ('' if start_index is None else str(start_index)) + extension)
+
+    # Parse the headers in parallel, since this is slow on network drives
+    header_filenames = [input_file_base + suffix + extension
+                        for suffix in suffixes]
+    headers = parallel_map(
+        lambda filename: parse_header(filename, format_factory),
+        header_filenames)
 
     # Loop through all the input files
-    while True:
-        file_descriptor, current_header = parse_header(header_filename,
-                                                       format_factory)
+    for offset, header_filename in enumerate(header_filenames):
+        file_index = first_index + offset
+        suffix = suffixes[offset]
+        file_descriptor, current_header = headers[offset]
         data_type = file_descriptor.data_type
         dim_order = file_descriptor.dim_order
         file_format = file_descriptor.file_format
@@ -288,25 +493,19 @@ def generate_input_descriptors(input_file, start_index):
         if not current_ranges:
             full_image_size = copy.deepcopy(current_image_size)
             combined_header = copy.deepcopy(current_header)
-            current_ranges = [[0, current_image_size[0] - 1, 0, 0],
-                              [0, current_image_size[1] - 1, 0, 0],
-                              [0, current_image_size[2] - 1, 0, 0]]
+            current_ranges = [[0, size - 1, 0, 0]
+                              for size in current_image_size]
         else:
-            # For multiple input files, concatenate volumes
-            if current_image_size[0] != full_image_size[0]:
+            # For multiple input files, concatenate volumes along the last
+            # dimension
+            if current_image_size[:-1] != full_image_size[:-1]:
                 raise ValueError(
-                    'When loading without a descriptor file, the first '
-                    'dimension of each file must '
-                    'match')
-            if current_image_size[1] != full_image_size[1]:
-                raise ValueError(
-                    'When loading without a descriptor file, the second '
-                    'dimension of each file must '
-                    'match')
-            full_image_size[2] = full_image_size[2] + current_image_size[2]
-            current_ranges[2][0] = current_ranges[2][1] + 1
-            current_ranges[2][1] = current_ranges[2][1] + \
-                current_image_size[2]
+                    'When loading without a descriptor file, all dimensions '
+                    'of each file except the last must match')
+            full_image_size[-1] = full_image_size[-1] + current_image_size[-1]
+            current_ranges[-1][0] = current_ranges[-1][1] + 1
+            current_ranges[-1][1] = current_ranges[-1][1] + \
+                current_image_size[-1]
 
         # Create a descriptor for this subimage
         ranges_to_write = copy.deepcopy(current_ranges)
@@ -324,16 +523,6 @@ def generate_input_descriptors(input_file, start_index):
             voxel_size=voxel_size
         ))
 
-        if start_index is None:
-            # Single file already loaded, so terminate the while True loop
-            break
-        else:
-            # Search for next file, and if not found terminate the loop
-            file_index += 1
-            suffix = format_str.format(file_index)
-            header_filename = input_file_base + suffix + extension
-            if not os.path.isfile(header_filename):
-                break
 
     full_image_size = np.array(full_image_size).tolist()
 
@@ -349,52 +538,213 @@ def generate_input_descriptors(input_file, start_index):
 
 
 def _aggregate_global_descriptor(descriptors):
-    global_ranges = None
-    combined_dim_order = None
-    combined_file_format = None
-    data_type = None
-    msb = None
-    voxel_size = None
-
-    for descriptor in descriptors:
-        current_ranges = descriptor.ranges.ranges
-        if not global_ranges:
-            global_ranges = copy.deepcopy(current_ranges)
-        else:
-            global_ranges[0][0] = min(global_ranges[0][0], current_ranges[0][0])
-            global_ranges[0][1] = max(global_ranges[0][1], current_ranges[0][1])
-            global_ranges[1][0] = min(global_ranges[1][0], current_ranges[1][0])
-            global_ranges[1][1] = max(global_ranges[1][1], current_ranges[1][1])
-            global_ranges[2][0] = min(global_ranges[2][0], current_ranges[2][0])
-            global_ranges[2][1] = max(global_ranges[2][1], current_ranges[2][1])
-
-        if not combined_file_format:
-            combined_file_format = descriptor.file_format
-        if not combined_dim_order:
-            combined_dim_order = descriptor.axis.to_condensed_format()
-        if not data_type:
-            data_type = descriptor.data_type
-        if not msb:
-            msb = descriptor.msb
-        if not voxel_size:
-            voxel_size = copy.deepcopy(descriptor.voxel_size)
-
-    full_image_size = [global_ranges[0][1] - global_ranges[0][0] + 1,
-                       global_ranges[1][1] - global_ranges[1][0] + 1,
-                       global_ranges[2][1] - global_ranges[2][0] + 1]
-    full_image_size = np.array(full_image_size).tolist()
+    ranges = get_ranges_array(descriptors)
+    global_start = np.min(ranges[:, :, 0], axis=0)
+    global_end = np.max(ranges[:, :, 1], axis=0)
+    full_image_size = (global_end - global_start + 1).tolist()
 
     global_descriptor = GlobalImageDescriptor(
         size=full_image_size,
-        file_format=combined_file_format,
-        dim_order_condensed=combined_dim_order,
-        data_type=data_type,
-        msb=msb,
-        voxel_size=voxel_size)
+        file_format=_first_set(_get_values(descriptors, "file_format")),
+        dim_order_condensed=_first_set(_get_values(descriptors, "dim_order")),
+        data_type=_first_set(_get_values(descriptors, "data_type")),
+        msb=_first_set(_get_values(descriptors, "msb")),
+        voxel_size=copy.deepcopy(
+            _first_set(_get_values(descriptors, "voxel_size"))))
 
     return global_descriptor
 
 
+def get_ranges_array(descriptors):
+    """Return an array of the ranges of each descriptor, with shape
+    (number of descriptors, number of dimensions, 4)"""
+
+    if isinstance(descriptors, DescriptorTable):
+        return descriptors.get_ranges()
+    return np.array([d.ranges.ranges for d in descriptors], dtype=np.int64)
+
+
+def _get_values(descriptors, key):
+    if isinstance(descriptors, DescriptorTable):
+        return descriptors.get_values(key)
+    if key == "dim_order":
+        return [d.axis.to_condensed_format() for d in descriptors]
+    return [getattr(d, key) for d in descriptors]
+
+
+def _first_set(values):
+    """Return the first value which is set, or the last value if none are"""
+    value = None
+    for value in values:
+        if value:
+            break
+    return value
+
+
+class DescriptorTable(object):
+    """A sequence of SubImageDescriptors which are only created when they are
+    accessed, so that descriptors for very many files can be opened quickly.
+
+    split_files is either a list of descriptor dictionaries, or the column
+    format produced by encode_split_files(). Descriptors are sorted by index.
+    If filename_override is specified, filenames are formed from this
+    filename and the suffix of each file, keeping any subfolders of the
+    folder which contains all the files (see LAYOUT_NESTED). Container files
+    are moved to the folder of filename_override in the same way"""
+
+    def __init__(self, split_files, filename_override=None):
+        if not isinstance(split_files, dict):
+            split_files = encode_split_files(split_files)
+        self._count = split_files["count"]
+        self._common = split_files["common"]
+        self._missing = {key: set(rows) for key, rows in
+                         split_files.get("missing", {}).items()}
+        self._columns = {}
+        for key, column in split_files["columns"].items():
+            if key in _ARRAY_COLUMNS:
+                column = _decode_array(column)
+            self._columns[key] = column
+
+        if "index" in self._columns:
+            self._rows = np.argsort(self._columns["index"], kind='mergesort')
+        else:
+            self._rows = np.arange(self._count)
+
+        self._filename_override = os.path.splitext(filename_override) \
+            if filename_override else None
+        self._base_folder = _common_folder(self.get_values("filename")) \
+            if filename_override else None
+        self._ranges = None
+        self._descriptors = {}
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[p] for p in range(*position.indices(self._count))]
+        if position < 0:
+            position += self._count
+        if not 0 <= position < self._count:
+            raise IndexError('Descriptor index out of range')
+        descriptor = self._descriptors.get(position)
+        if descriptor is None:
+            descriptor = SubImageDescriptor.from_dict(
+                self._get_entry(position))
+            self._descriptors[position] = descriptor
+        return descriptor
+
+    def __iter__(self):
+        for position in range(self._count):
+            yield self[position]
+
+    def get_ranges(self):
+        """Return an array of the ranges of each descriptor, with shape
+        (number of descriptors, number of dimensions, 4)"""
+
+        if self._ranges is None:
+            if not self._count:
+                self._ranges = np.zeros((0, 0, 4), dtype=np.int64)
+            elif "ranges" in self._columns:
+                self._ranges = self._columns["ranges"][self._rows]
+            else:
+                self._ranges = np.array(
+                    [self._common["ranges"]] * self._count, dtype=np.int64)
+        return self._ranges
+
+    def get_values(self, key):
+        """Return the values of this key for each descriptor, or a single
+        value if this key has the same value for every descriptor"""
+
+        if key in self._common:
+            return [self._common[key]]
+        missing = self._missing.get(key, ())
+        return [None if row in missing else
+                _to_json_value(self._columns[key][row]) for row in self._rows]
+
+    def to_dicts(self):
+        """Return a list containing a dictionary for each descriptor"""
+        return [self._get_entry(position) for position in range(self._count)]
+
+    def _get_entry(self, position):
+        row = self._rows[position]
+        entry = copy.deepcopy(self._common)
+        for key, column in self._columns.items():
+            if row not in self._missing.get(key, ()):
+                entry[key] = _to_json_value(column[row])
+        if self._filename_override:
+            subfolder = os.path.relpath(os.path.dirname(entry["filename"]),
+                                        self._base_folder)
+            entry["filename"] = self._filename_override[0] + \
+                entry["suffix"] + self._filename_override[1]
+            if subfolder != os.curdir:
+                folder, name = os.path.split(entry["filename"])
+                entry["filename"] = os.path.join(folder, subfolder, name)
+            if entry.get("container"):
+                entry["container"] = os.path.join(
+                    os.path.dirname(self._filename_override[0]),
+                    os.path.relpath(entry["container"], self._base_folder))
+        return entry
+
+
+def _common_folder(filenames):
+    """Return the deepest folder which contains all the files"""
+    prefix = os.path.commonprefix([
+        os.path.join(os.path.dirname(filename) or os.curdir, '')
+        for filename in filenames])
+    return prefix[:prefix.rfind(os.sep) + 1] or os.curdir
+
+
+def encode_split_files(split_files):
+    """Convert a list of descriptor dictionaries to the column format used by
+    version 1.1 descriptor files. Keys which are missing from some of the
+    dictionaries are listed in "missing" with the rows which do not have
+    them, so that the dictionaries are restored without these keys"""
+
+    common = {}
+    columns = {}
+    missing = {}
+    keys = sorted(set(key for entry in split_files for key in entry))
+    for key in keys:
+        values = [entry.get(key) for entry in split_files]
+        missing_rows = [row for row, entry in enumerate(split_files)
+                        if key not in entry]
+        if key in _ARRAY_COLUMNS:
+            if missing_rows:
+                raise ValueError('Every split file must have a value for ' +
+                                 key)
+            columns[key] = _encode_array(np.array(values, dtype=np.int64))
+        elif not missing_rows and all(value == values[0] for value in values):
+            common[key] = values[0]
+        else:
+            columns[key] = values
+            if missing_rows:
+                missing[key] = missing_rows
+    encoded = {"count": len(split_files), "common": common, "columns": columns}
+    if missing:
+        encoded["missing"] = missing
+    return encoded
+
+
+def _encode_array(array):
+    return {"dtype": "<i8", "shape": list(array.shape),
+            "data": base64.b64encode(
+                array.astype("<i8").tobytes()).decode("ascii")}
+
+
+def _decode_array(column):
+    return np.frombuffer(base64.b64decode(column["data"]),
+                         dtype=column["dtype"]).reshape(column["shape"])
+
+
+def _to_json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.integer):
+        return int(value)
+    return copy.deepcopy(value)
+
+
 def convert_to_descriptors(descriptors_dict):
     """Convert descriptor dictionary to list of SubImageDescriptor objects"""
     descriptors_sorted = sorted(descriptors_dict, key=lambda k: k['index'])
@@ -418,11 +768,40 @@ def parse_header(filename, factory):
     return factory.get_factory(format_string).load_and_parse_header(filename)
 
 
-def _get_format_string(extension, input_file_base, start_index):
+def _find_series_suffixes(input_file_base, extension, start_index):
+    """Return the numeric suffixes of a series of files named
+    input_file_base + suffix + extension, with consecutive numbers starting
+    at start_index. The folder is listed once instead of testing for each
+    possible filename"""
+
+    folder, prefix = os.path.split(input_file_base)
+    pattern = re.compile(re.escape(prefix) + r'(\d+)' + re.escape(extension) +
+                         '$')
+    found = set()
+    for name in _list_files(folder or os.curdir):
+        match = pattern.match(name)
+        if match:
+            found.add(match.group(1))
+
+    # Choose the amount of zero-padding which matches the first file
     for num_zeros in range(10, -1, -1):
         format_str = '{0:0' + str(num_zeros) + 'd}'
-        suffix_test = format_str.format(start_index)
-        header_filename = input_file_base + suffix_test + extension
-        if os.path.isfile(header_filename):
+        if format_str.format(start_index) in found:
             break
-    return format_str
+    else:
+        return []
+
+    suffixes = []
+    for file_index in itertools.count(start_index):
+        suffix = format_str.format(file_index)
+        if suffix not in found:
+            return suffixes
+        suffixes.append(suffix)
+
+
+def _list_files(folder):
+    """Return the names of the files in this folder"""
+    if hasattr(os, 'scandir'):
+        return [entry.name for entry in os.scandir(folder) if entry.is_file()]
+    return [name for name in os.listdir(folder)
+            if os.path.isfile(os.path.join(folder, name))]
@@ -0,0 +1,26 @@
+# coding=utf-8
+"""
+Utilities for running tasks in parallel
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+
+def parallel_map(function, items, num_threads=None):
+    """Returns the results of calling function on each item, using a pool of
+    threads. Most of the work is file reading and numpy operations, which
+    release the global interpreter lock or wait for the file system. If
+    num_threads is None, a few more threads than CPUs are used"""
+
+    items = list(items)
+    if num_threads == 1 or len(items) < 2:
+        return [function(item) for item in items]
+
+    if num_threads is None:
+        num_threads = min(32, len(items), cpu_count() + 4)
+    with ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(function, items))
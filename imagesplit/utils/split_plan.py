@@ -0,0 +1,283 @@
+# coding=utf-8
+"""
+Estimate the cost of writing a set of output files from the descriptors
+alone, without reading or writing any image data, so that the parameters of
+a long split can be checked before it is run
+
+Author: Tom Doel
+Copyright UCL 2017
+
+"""
+import numpy as np
+
+from imagesplit.file.data_type import DataType
+from imagesplit.file.file_wrapper import COPY_CHUNK_BYTES
+from imagesplit.file.format_factory import FormatFactory
+from imagesplit.file.image_file_reader import BlockImageFileReader
+from imagesplit.utils.block_planner import FILESYSTEM_BLOCK_BYTES
+from imagesplit.utils.file_descriptor import get_ranges_array
+
+
+class SplitPlan(object):
+    """Estimated cost of writing a set of output files"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self):
+        self.num_outputs = 0
+        self.num_inputs = 0
+        self.input_bytes = 0
+        self.write_bytes = 0
+        self.read_bytes = 0
+        self.block_read_bytes = 0
+        self.num_reads = 0
+        self.rescale_read_bytes = 0
+        self.peak_memory_bytes = 0
+
+    def get_overlap_amplification(self):
+        """Bytes requested from the input files, relative to the input size"""
+        return _ratio(self.read_bytes, self.input_bytes)
+
+    def get_access_amplification(self):
+        """Bytes read from storage in whole file system blocks, relative to
+        the bytes requested. This is large when the output axis ordering
+        means the input is read in short runs"""
+        return _ratio(self.block_read_bytes, self.read_bytes)
+
+    def get_summary(self):
+        """Return a description of the plan, one line per item"""
+
+        lines = [
+            "Plan summary (no image data have been read or written)",
+            "  Output files:          {0}".format(self.num_outputs),
+            "  Input files:           {0} ({1})".format(
+                self.num_inputs, format_bytes(self.input_bytes)),
+            "  Bytes to write:        " + format_bytes(self.write_bytes),
+            "  Bytes to read:         {0} in {1} contiguous reads".format(
+                format_bytes(self.read_bytes), self.num_reads),
+            "  Read amplification:    {0:.2f} (overlap {1:.2f}, access "
+            "pattern {2:.2f})".format(
+                _ratio(self.block_read_bytes, self.input_bytes),
+                self.get_overlap_amplification(),
+                self.get_access_amplification()),
+            "  Estimated peak memory: " + format_bytes(self.peak_memory_bytes),
+        ]
+        if self.rescale_read_bytes:
+            lines.append("  Rescale limits:        computed from an extra "
+                         "read of " + format_bytes(self.rescale_read_bytes))
+        return "\n".join(lines)
+
+
+def estimate_split_plan(descriptors_in, descriptors_out, rescale_pass=False,
+                        concurrency=1, halo_cache_bytes=0,
+                        fs_block_bytes=FILESYSTEM_BLOCK_BYTES,
+                        rescale=False):
+    """Returns a SplitPlan estimating the cost of writing the output files
+    from the input files.
+
+    Each output file of a linear format such as mhd is written in slices of
+    its two fastest axes, and each slice reads lines from the input files
+    along their fastest axes. Where no conversion is needed, the data are
+    copied in the longest contiguous runs instead. rescale is True if the
+    values are rescaled, so they are always converted, and rescale_pass is
+    True if the input is also read once beforehand to find the rescale
+    limits. concurrency is the number of output files written at once, and
+    halo_cache_bytes the memory used to avoid re-reading overlap"""
+
+    plan = SplitPlan()
+    inputs = _InputFiles(descriptors_in)
+    plan.num_outputs = len(descriptors_out)
+    plan.num_inputs = inputs.num_files
+    plan.input_bytes = int(np.sum(inputs.roi_bytes))
+    if rescale_pass:
+        plan.rescale_read_bytes = int(np.sum(inputs.file_bytes))
+
+    block_inputs_read = np.zeros(inputs.num_files, dtype=bool)
+    max_output_memory = 0
+    any_overlap = False
+    any_converted = False
+    for descriptor, ranges in zip(descriptors_out,
+                                  get_ranges_array(descriptors_out)):
+        out_size = ranges[:, 1] - ranges[:, 0] + 1
+        any_overlap = any_overlap or bool(np.any(ranges[:, 2:]))
+        out_bytes_per_voxel = _get_bytes_per_voxel(descriptor.data_type)
+        out_voxels = int(np.prod(out_size))
+        plan.write_bytes += out_voxels * out_bytes_per_voxel
+
+        # The part of each input file which is read for this output
+        size = np.maximum(np.minimum(inputs.roi_end, ranges[:, 1]) -
+                          np.maximum(inputs.roi_start, ranges[:, 0]) + 1, 0)
+        voxels = np.prod(size, axis=1)
+        overlapping = voxels > 0
+        if not np.any(overlapping):
+            continue
+
+        # Block formats such as TIFF are read whole, once
+        new_block = overlapping & ~inputs.linear & ~block_inputs_read
+        block_inputs_read |= new_block
+        block_bytes = int(np.sum(inputs.file_bytes[new_block]))
+        plan.read_bytes += block_bytes
+        plan.block_read_bytes += block_bytes
+        plan.num_reads += int(np.sum(new_block))
+
+        dim_order = descriptor.axis.dim_order
+        is_block_output = issubclass(
+            FormatFactory.get_factory(descriptor.file_format),
+            BlockImageFileReader)
+
+        # Rescaling, or a change of data type, byte order or axis ordering,
+        # means the values must be converted
+        converted = rescale or rescale_pass or any(
+            inputs.copy_keys[index] !=
+            _copy_key(descriptor, out_bytes_per_voxel)
+            for index in np.flatnonzero(overlapping))
+        copy_raw = not is_block_output and not converted
+        any_converted = any_converted or not copy_raw
+
+        # The region of each input file read at once
+        read_size = np.array(size)
+        if not is_block_output and not copy_raw:
+            read_size[:, dim_order[2:]] = 1
+        _add_linear_reads(plan, inputs, overlapping & inputs.linear, voxels,
+                          read_size, fs_block_bytes)
+
+        if copy_raw:
+            # Raw data are copied in chunks when they cannot be copied by the
+            # kernel, or when they are added to the checksum as they are
+            # copied
+            output_memory = min(COPY_CHUNK_BYTES,
+                                out_voxels * out_bytes_per_voxel)
+        else:
+            # Block formats hold the whole image, converted and encoded, in
+            # memory. Linear formats hold one slice
+            in_bytes_per_voxel = int(np.max(
+                inputs.bytes_per_voxel[overlapping]))
+            if is_block_output:
+                output_memory = out_voxels * (in_bytes_per_voxel +
+                                              2 * out_bytes_per_voxel)
+            else:
+                output_memory = int(np.prod(np.take(
+                    out_size, dim_order[:2]))) * (in_bytes_per_voxel +
+                                                  out_bytes_per_voxel)
+        max_output_memory = max(max_output_memory, output_memory)
+
+    # The halo cache holds at most the data which are read more than once.
+    # Raw copies do not use it
+    plan.peak_memory_bytes = max_output_memory * concurrency
+    if any_overlap and any_converted and plan.num_outputs > 1:
+        plan.peak_memory_bytes += min(
+            halo_cache_bytes, max(plan.read_bytes - plan.input_bytes, 0))
+    return plan
+
+
+def _add_linear_reads(plan, inputs, linear, voxels, read_size,
+                      fs_block_bytes):
+    """Add the cost of reading regions of size read_size from the linear
+    input files selected by linear, with voxels in total from each file"""
+
+    read_size_local = np.take_along_axis(read_size, inputs.dim_order,
+                                         axis=1)[linear]
+    file_size = inputs.local_size[linear]
+    bytes_per_voxel = inputs.bytes_per_voxel[linear]
+    run_voxels = _get_run_voxels(read_size_local, file_size)
+    num_reads = voxels[linear] // np.prod(read_size_local, axis=1)
+    runs_per_read = np.prod(read_size_local, axis=1) // run_voxels
+
+    plan.read_bytes += int(np.sum(voxels[linear] * bytes_per_voxel))
+    plan.num_reads += int(np.sum(num_reads * runs_per_read))
+
+    # A run of bytes starting at an arbitrary voxel spans on average this
+    # many bytes of whole file system blocks. Runs which share a block during
+    # one read only read it once
+    run_cost = runs_per_read * (
+        run_voxels * bytes_per_voxel + fs_block_bytes - bytes_per_voxel)
+    span_cost = _get_span_voxels(read_size_local, file_size) * \
+        bytes_per_voxel + fs_block_bytes - bytes_per_voxel
+    plan.block_read_bytes += int(np.sum(
+        num_reads * np.minimum(run_cost, span_cost)))
+
+
+def format_bytes(num_bytes):
+    """Return a short human readable form of a number of bytes"""
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if num_bytes < 1024 or unit == 'TB':
+            break
+        num_bytes /= 1024.0
+    if unit == 'B':
+        return '{0} B'.format(int(num_bytes))
+    return '{0:.1f} {1}'.format(num_bytes, unit)
+
+
+class _InputFiles(object):
+    """Arrays of the properties of each input file"""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, descriptors):
+        ranges = get_ranges_array(descriptors)
+        self.num_files = len(ranges)
+        self.roi_start = ranges[:, :, 0] + ranges[:, :, 2]
+        self.roi_end = ranges[:, :, 1] - ranges[:, :, 3]
+        file_size = ranges[:, :, 1] - ranges[:, :, 0] + 1
+
+        self.dim_order = np.zeros(file_size.shape, dtype=np.int64)
+        self.bytes_per_voxel = np.zeros(self.num_files, dtype=np.int64)
+        self.linear = np.zeros(self.num_files, dtype=bool)
+        self.copy_keys = []
+        for index, descriptor in enumerate(descriptors):
+            self.dim_order[index] = descriptor.axis.dim_order
+            self.bytes_per_voxel[index] = _get_bytes_per_voxel(
+                descriptor.data_type)
+            self.linear[index] = not issubclass(
+                FormatFactory.get_factory(descriptor.file_format),
+                BlockImageFileReader)
+            self.copy_keys.append(_copy_key(descriptor,
+                                            self.bytes_per_voxel[index])
+                                  if self.linear[index] else None)
+
+        self.local_size = np.take_along_axis(file_size, self.dim_order,
+                                             axis=1)
+        self.file_bytes = np.prod(file_size, axis=1) * self.bytes_per_voxel
+        self.roi_bytes = np.prod(self.roi_end - self.roi_start + 1, axis=1) * \
+            self.bytes_per_voxel
+
+
+def _get_run_voxels(read_size, file_size):
+    """Return the number of voxels in each contiguous run of the file when
+    reading a region of this size, both in the file's axis ordering. A run
+    continues onto the next axis while the region covers the whole file
+    along the faster axes"""
+
+    run_voxels = np.array(read_size[:, 0])
+    whole = read_size[:, 0] == file_size[:, 0]
+    for axis in range(1, read_size.shape[1]):
+        run_voxels = np.where(whole, run_voxels * read_size[:, axis],
+                              run_voxels)
+        whole &= read_size[:, axis] == file_size[:, axis]
+    return np.maximum(run_voxels, 1)
+
+
+def _get_span_voxels(read_size, file_size):
+    """Return the number of voxels from the first to the last voxel of a
+    region of this size, both in the file's axis ordering"""
+
+    strides = np.cumprod(np.hstack([np.ones((len(file_size), 1),
+                                            dtype=np.int64),
+                                    file_size[:, :-1]]), axis=1)
+    return np.sum((read_size - 1) * strides, axis=1) + 1
+
+
+def _copy_key(descriptor, bytes_per_voxel):
+    """Files with the same key store raw voxels in the same way, so data can
+    be copied between them without conversion"""
+    return (descriptor.data_type, bool(descriptor.msb) or bytes_per_voxel == 1,
+            tuple(descriptor.axis.to_condensed_format()))
+
+
+def _get_bytes_per_voxel(data_type):
+    template = DataType.types[data_type.lower()]
+    return template.bytes_per_voxel * (3 if template.is_rgb else 1)
+
+
+def _ratio(numerator, denominator):
+    return float(numerator) / denominator if denominator else 0.0
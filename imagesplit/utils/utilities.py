@@ -6,8 +6,10 @@ Author: Tom Doel
 Copyright UCL 2017
 
 """
+import itertools
 from math import ceil
 import numpy as np
+import six
 
 
 def file_linear_byte_offset(image_size, bytes_per_voxel, start_coords):
@@ -26,6 +28,41 @@ def file_linear_byte_offset(image_size, bytes_per_voxel, start_coords):
     return offset
 
 
+def get_contiguous_runs(region_size, image_size_a, start_a, image_size_b,
+                        start_b):
+    """
+    Yields (coords_a, coords_b, num_voxels) for each run of voxels which is
+    contiguous in two linear files a and b, when copying a region of size
+    region_size starting at start_a in file a to start_b in file b. Both
+    files must have the same dimension ordering, with the first dimension
+    most rapidly changing.
+
+    Where the region covers the whole of the leading dimensions of both files,
+    those dimensions are merged so that larger runs are returned
+    """
+
+    num_dims = len(region_size)
+
+    # Find the number of leading dimensions which are completely covered in
+    # both files, since these can be merged into a single run
+    merged_dims = 0
+    while merged_dims < num_dims - 1 and \
+            region_size[merged_dims] == image_size_a[merged_dims] and \
+            region_size[merged_dims] == image_size_b[merged_dims]:
+        merged_dims += 1
+
+    num_voxels = int(np.prod(region_size[:merged_dims + 1]))
+
+    # Iterate over the remaining dimensions, last dimension slowest
+    ranges_to_iterate = [range(size) for size in
+                         region_size[:merged_dims:-1]]
+    for offsets in itertools.product(*ranges_to_iterate):
+        offsets = [0] * (merged_dims + 1) + list(reversed(offsets))
+        yield ([int(s + o) for s, o in zip(start_a, offsets)],
+               [int(s + o) for s, o in zip(start_b, offsets)],
+               num_voxels)
+
+
 def get_number_of_blocks(image_size, max_block_size):
     """Returns a list containing the number of blocks in each dimension
     required to split the image into blocks that are subject to a maximum
@@ -37,6 +74,27 @@ def get_number_of_blocks(image_size, max_block_size):
             zip(image_size, max_block_size)]
 
 
+def get_max_block_size_for_bytes(image_size, bytes_per_voxel, max_bytes,
+                                 axis_order, overlap_size):
+    """Returns the maximum block size in each dimension such that each block,
+    including its overlap, contains no more than max_bytes. Dimensions are
+    filled in the order given by axis_order, so listing the axes in the order
+    they are stored in the input file (fastest first) gives blocks which are
+    contiguous along the fastest axes """
+
+    max_voxels = max(1, int(max_bytes) // int(bytes_per_voxel))
+    max_block_size = list(image_size)
+    block_voxels = 1
+    for dim in axis_order:
+        available = max_voxels // block_voxels
+        if image_size[dim] > available:
+            max_block_size[dim] = max(1, available - 2 * overlap_size[dim])
+            block_voxels *= max_block_size[dim] + 2 * overlap_size[dim]
+        else:
+            block_voxels *= image_size[dim]
+    return max_block_size
+
+
 def get_block_coordinate_range(block_number, block_size, overlap_size,
                                image_size):
     """
@@ -95,18 +153,24 @@ def ranges_for_number_of_blocks(image_size, number_of_blocks, overlap_size):
     image_size to be split into the specified number of blocks in each
     dimension, with each block being roughly equal in size """
 
-    suggested_block_size = get_suggested_block_size(image_size,
-                                                    number_of_blocks)
-    block_ranges = []
-    for i in range(number_of_blocks[0]):
-        for j in range(number_of_blocks[1]):
-            for k in range(number_of_blocks[2]):
-                block_ranges.append(
-                    [get_block_coordinate_range(index, block, overlap, size)
-                     for index, block, overlap, size in
-                     zip([i, j, k], suggested_block_size, overlap_size,
-                         image_size)])
-    return block_ranges
+    return list(iter_block_ranges(image_size, number_of_blocks, overlap_size))
+
+
+def iter_block_ranges(image_size, number_of_blocks, overlap_size,
+                      block_size=None):
+    """Yields the ranges for each block in turn, as for
+    ranges_for_number_of_blocks(), for images with any number of dimensions.
+    The first dimension changes most slowly. If block_size is specified, it
+    is used instead of the suggested block size"""
+
+    suggested_block_size = block_size or get_suggested_block_size(
+        image_size, number_of_blocks)
+    for block_numbers in itertools.product(
+            *[range(num_blocks) for num_blocks in number_of_blocks]):
+        yield [get_block_coordinate_range(index, block, overlap, size)
+               for index, block, overlap, size in
+               zip(block_numbers, suggested_block_size, overlap_size,
+                   image_size)]
 
 
 def convert_to_array(scalar_or_list, parameter_name, num_dims):
@@ -127,16 +191,87 @@ def convert_to_array(scalar_or_list, parameter_name, num_dims):
 
 def rescale_image(data_type, image_line, rescale_limits):
     """Rescale image to the limits of this datatype"""
-    dt_min = np.iinfo(data_type).min
-    dt_max = np.iinfo(data_type).max
-    dt_range = dt_max - dt_min
-    im_range = float(rescale_limits.max) - float(rescale_limits.min)
-    scale = float(dt_range)/float(im_range)
-    image_line = np.clip(image_line,
-                         a_min=rescale_limits.min, a_max=rescale_limits.max)
-    image_line = dt_min + scale*(image_line.astype(float) - rescale_limits.min)
-    image_line = np.around(image_line).astype(data_type)
-    return image_line
+    return Rescaler(data_type, rescale_limits).rescale(np.asarray(image_line))
+
+
+class Rescaler(object):
+    """Rescale image values from the rescale limits to the range of an output
+    datatype. Integer outputs use the full range of the datatype, and
+    floating point outputs are rescaled to the range 0 to 1.
+
+    The mapping is computed once, so a single Rescaler should be used for all
+    the data written to a file. Inputs of 8 or 16 bit integers are rescaled
+    using a lookup table; other inputs are rescaled using in-place float64
+    arithmetic. Both give the same results"""
+
+    def __init__(self, data_type, rescale_limits):
+        self._data_type = np.dtype(data_type)
+        self._in_min = float(rescale_limits.min)
+        self._in_max = float(rescale_limits.max)
+
+        if self._data_type.kind == 'f':
+            self._out_min = 0.0
+            out_range = 1.0
+        else:
+            self._out_min = float(np.iinfo(self._data_type).min)
+            out_range = float(np.iinfo(self._data_type).max) - self._out_min
+        self._scale = out_range / (self._in_max - self._in_min)
+
+        self._lookup_tables = {}
+
+    def rescale(self, image):
+        """Return a rescaled copy of the image array in the output datatype"""
+
+        if image.dtype.kind in 'iu' and image.dtype.itemsize <= 2:
+            lookup_table, index_type = self._get_lookup_table(image.dtype)
+            return np.take(lookup_table, image.view(index_type))
+
+        return self._compute(image)
+
+    def _compute(self, image):
+        # Values are computed in float64, so that rounding matches the value
+        # min + scale * (value - limit min) exactly
+        work_image = image.astype(np.float64)
+        np.clip(work_image, self._in_min, self._in_max, out=work_image)
+        work_image -= self._in_min
+        work_image *= self._scale
+        work_image += self._out_min
+        if self._data_type.kind != 'f':
+            np.around(work_image, out=work_image)
+        return work_image.astype(self._data_type)
+
+    def _get_lookup_table(self, in_type):
+        # Tables are indexed by the bit pattern of each voxel value, viewed as
+        # an unsigned integer with the same byte order as the input
+        unsigned_type = np.dtype('u' + str(in_type.itemsize))
+        native_type = in_type.newbyteorder('=')
+        if native_type not in self._lookup_tables:
+            all_values = np.arange(2 ** (8 * in_type.itemsize),
+                                   dtype=unsigned_type)
+            self._lookup_tables[native_type] = \
+                self._compute(all_values.view(native_type))
+        return self._lookup_tables[native_type], \
+            unsigned_type.newbyteorder(in_type.byteorder)
+
+
+def convert_data_type(image, data_type, in_place=False):
+    """Return a C-contiguous copy of the image array converted to the
+    specified numpy datatype.
+
+    Where only the byte order differs, the bytes are swapped directly instead
+    of converting values. If in_place is True, the array may be swapped in
+    place, avoiding the allocation of a new array"""
+
+    data_type = np.dtype(data_type)
+    if image.dtype == data_type:
+        return np.ascontiguousarray(image)
+
+    if image.dtype.newbyteorder('S') == data_type:
+        if in_place and image.flags.c_contiguous and image.flags.writeable:
+            return image.byteswap(True).view(data_type)
+        return np.ascontiguousarray(image.byteswap().view(data_type))
+
+    return image.astype(data_type, order='C')
 
 
 def compute_bytes_per_voxel(element_type):
@@ -189,3 +324,25 @@ def get_numpy_datatype(element_type, byte_order_msb):
         'MET_DOUBLE': 'f8',
     }
     return prefix + switcher.get(element_type, 2)
+
+
+def parse_byte_size(size_string):
+    """Convert a size such as 4096, 64M or 1G to a number of bytes. The K, M,
+    G and T suffixes are powers of 1024"""
+    multipliers = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    size_string = size_string.strip().upper()
+    if size_string.endswith('B'):
+        size_string = size_string[:-1]
+    multiplier = 1
+    if size_string and size_string[-1] in multipliers:
+        multiplier = multipliers[size_string[-1]]
+        size_string = size_string[:-1]
+    try:
+        size = int(float(size_string) * multiplier)
+    except ValueError as exc:
+        six.raise_from(ValueError('Byte size must be a number optionally '
+                                  'followed by K, M, G or T, for example '
+                                  '64M'), exc)
+    if size < 1:
+        raise ValueError('Byte size must be positive')
+    return size
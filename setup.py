@@ -73,6 +73,7 @@ setup(
         'six>=1.10',
         'numpy>=1.11',
         'pillow',
+        'futures; python_version < "3"',
     ],
 
     entry_points={
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from imagesplit.applications.split_files import split_file
+from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.utils.async_engine import AsyncEngine
+
+
+class LatencyFileHandleFactory(FileHandleFactory):
+    """Creates file handles which wait before each read and write, as if the
+    files were on high-latency storage, and records how many operations are
+    in progress at once"""
+
+    def __init__(self, latency=0.0002):
+        super(LatencyFileHandleFactory, self).__init__()
+        self.latency = latency
+        self.in_progress = 0
+        self.max_in_progress = 0
+        self._lock = threading.Lock()
+
+    def create_file_handle(self, filename, mode):
+        return LatencyFileHandle(
+            super(LatencyFileHandleFactory, self).create_file_handle(
+                filename, mode), self)
+
+    def wait(self):
+        with self._lock:
+            self.in_progress += 1
+            self.max_in_progress = max(self.max_in_progress, self.in_progress)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_progress -= 1
+
+
+class LatencyFileHandle(object):
+    """File handle which waits before each read and write"""
+
+    def __init__(self, handle, factory):
+        self._handle = handle
+        self._factory = factory
+
+    def read(self, *args):
+        self._factory.wait()
+        return self._handle.read(*args)
+
+    def write(self, data):
+        self._factory.wait()
+        return self._handle.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+
+class TestAsyncEngine(unittest.TestCase):
+    """Tests for AsyncEngine"""
+
+    def test_run(self):
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'max_in_flight': 0}
+        results = []
+
+        def task(index):
+            with lock:
+                state['in_flight'] += 1
+                state['max_in_flight'] = max(state['max_in_flight'],
+                                             state['in_flight'])
+            time.sleep(0.01)
+            with lock:
+                state['in_flight'] -= 1
+                results.append(index)
+
+        AsyncEngine(max_in_flight=3).run(
+            (lambda index=index: task(index)) for index in range(10))
+        self.assertEqual(list(range(10)), sorted(results))
+        self.assertEqual(3, state['max_in_flight'])
+
+    def test_error(self):
+        started = []
+
+        def task(index):
+            started.append(index)
+            if index == 1:
+                raise IOError('Read failed')
+
+        with self.assertRaises(IOError):
+            AsyncEngine(max_in_flight=1).run(
+                (lambda index=index: task(index)) for index in range(5))
+        self.assertEqual([0, 1], started)
+
+        with self.assertRaises(ValueError):
+            AsyncEngine(max_in_flight=0)
+
+
+class TestAsyncSplit(unittest.TestCase):
+    """Split an image using the async engine"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        image = np.arange(20 * 17 * 13, dtype='<i2').reshape(13, 17, 20)
+        image.tofile(os.path.join(self.folder, 'image.raw'))
+        with open(os.path.join(self.folder, 'image.mhd'), 'w') as header:
+            header.write('ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+                         'BinaryDataByteOrderMSB = False\nDimSize = 20 17 13\n'
+                         'ElementSize = 1 1 1\nElementType = MET_SHORT\n'
+                         'ElementDataFile = image.raw\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _split(self, engine, output_type, file_handle_factory):
+        out_folder = os.path.join(self.folder, engine + output_type)
+        os.makedirs(out_folder)
+        out_base = os.path.join(out_folder, 'split')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=out_base, start_index=None,
+                   output_type=output_type, dim_order=[2, -1, 3],
+                   file_handle_factory=file_handle_factory,
+                   output_format=None, slice_output=False, rescale=None,
+                   out_compression=None, max_block_size_voxels=[7, 6, 5],
+                   overlap_size_voxels=1, engine=engine)
+        return out_base
+
+    def test_same_output_as_sync(self):
+        for output_type in ['short', 'float']:
+            sync_base = self._split('sync', output_type, FileHandleFactory())
+            factory = LatencyFileHandleFactory()
+            async_base = self._split('async', output_type, factory)
+
+            # Several file operations were waiting at the same time
+            self.assertGreater(factory.max_in_progress, 1)
+
+            for index in range(27):
+                suffix = '_{0:04d}.raw'.format(index)
+                with open(sync_base + suffix, 'rb') as sync_file:
+                    with open(async_base + suffix, 'rb') as async_file:
+                        self.assertEqual(sync_file.read(), async_file.read())
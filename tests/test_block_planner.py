@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy as np
+from parameterized import parameterized
+
+from imagesplit.utils.block_planner import plan_block_size, \
+    estimate_read_cost, SEEK_COST_BYTES, FILESYSTEM_BLOCK_BYTES
+from imagesplit.utils.utilities import get_number_of_blocks
+
+
+class TestBlockPlanner(unittest.TestCase):
+    """Tests for the block planner"""
+
+    @parameterized.expand([
+        [[1000, 1000, 1000], 8, [0, 1, 2], [1000, 1000, 128]],
+        [[1000, 1000, 1000], 8, [2, 1, 0], [128, 1000, 1000]],
+        [[1000, 1000, 1000], 8, [1, 2, 0], [128, 1000, 1000]],
+        [[100, 200, 300], 1, [0, 1, 2], [100, 200, 300]],
+    ])
+    def test_splits_slowest_axis(self, image_size, num_blocks, axis_order,
+                                 expected):
+        self.assertEqual(expected, plan_block_size(
+            image_size, num_blocks, axis_order, [0, 0, 0], 2))
+
+    @parameterized.expand([
+        [[1000, 1000, 1000], 12, 2],
+        [[1000, 1000, 1000], 64, 2],
+        [[400, 30, 7], 210, 1],
+        [[4000, 4000, 4000], 720720, 2],
+    ])
+    def test_number_of_blocks(self, image_size, num_blocks, overlap):
+        block_size = plan_block_size(image_size, num_blocks, [0, 1, 2],
+                                     [overlap] * 3, 2)
+        self.assertEqual(num_blocks, int(np.prod(
+            get_number_of_blocks(image_size, block_size))))
+
+    def test_aligns_to_input_files(self):
+        # Input series of 10 files of 100 slices
+        boundaries = [[], [], list(range(100, 1000, 100))]
+        self.assertEqual([1000, 1000, 50], plan_block_size(
+            [1000, 1000, 1000], 20, [0, 1, 2], [0, 0, 0], 2, boundaries))
+        self.assertEqual([1000, 1000, 200], plan_block_size(
+            [1000, 1000, 1000], 5, [0, 1, 2], [0, 0, 0], 2, boundaries))
+
+    def test_aligns_to_filesystem_blocks(self):
+        # The even split of 100 rows of 1024 bytes into 7 blocks has 15 rows
+        # per block, but 16 rows align each block to 4096 byte boundaries
+        self.assertEqual([1024, 16, 1], plan_block_size(
+            [1024, 100, 1], 7, [0, 1, 2], [0, 0, 0], 1))
+
+    def test_estimate_read_cost(self):
+        def cost(block_size):
+            return estimate_read_cost(
+                [1000, 1000, 1000], block_size, [0, 1, 2], [0, 0, 0], 2,
+                [[], [], []], SEEK_COST_BYTES, FILESYSTEM_BLOCK_BYTES)
+
+        # Eight slabs which are aligned to file system blocks are read with
+        # one seek each
+        self.assertEqual(2 * 10 ** 9 + 8 * SEEK_COST_BYTES,
+                         cost([1000, 1000, 128]))
+        self.assertLess(cost([1000, 1000, 128]), cost([1000, 1000, 125]))
+        self.assertLess(cost([1000, 1000, 125]), cost([500, 500, 500]))
+
+    def test_impossible(self):
+        with self.assertRaises(ValueError):
+            plan_block_size([4, 5, 6], 7, [0, 1, 2], [0, 0, 0], 2)
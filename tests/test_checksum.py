@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import numpy as np
+from mock import patch
+from parameterized import parameterized
+
+from imagesplit.applications import verify_files
+from imagesplit.applications.split_files import split_file
+from imagesplit.file.file_wrapper import FileHandleFactory, FileStreamer
+from imagesplit.utils.checksum import RunningChecksum, compute_checksum, \
+    format_checksum
+from imagesplit.utils.file_descriptor import load_descriptor
+
+
+class TestRunningChecksum(unittest.TestCase):
+    """Tests for RunningChecksum"""
+
+    def test_in_order(self):
+        data = np.arange(100, dtype='<i2')
+        checksum = RunningChecksum()
+        checksum.update(0, data[:30])
+        checksum.update(60, data[30:])
+        expected = format_checksum(zlib.crc32(data.tobytes()))
+        self.assertEqual(expected, checksum.get_checksum(200))
+        self.assertIsNone(checksum.get_checksum(400))
+
+        self.assertEqual(expected, compute_checksum(
+            lambda offset, num_bytes: data.tobytes()[offset:offset +
+                                                     num_bytes], 200,
+            chunk_bytes=7))
+
+    def test_out_of_order(self):
+        checksum = RunningChecksum()
+        checksum.update(4, b'5678')
+        checksum.update(0, b'1234')
+        self.assertIsNone(checksum.get_checksum(8))
+
+        checksum = RunningChecksum()
+        checksum.update(0, b'1234')
+        checksum.invalidate()
+        self.assertIsNone(checksum.get_checksum(4))
+
+
+class TestVerifyFiles(unittest.TestCase):
+    """Split images and verify them using the stored checksums"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        image = np.arange(20 * 17 * 13, dtype='<i2').reshape(13, 17, 20)
+        image.tofile(os.path.join(self.folder, 'image.raw'))
+        with open(os.path.join(self.folder, 'image.mhd'), 'w') as header:
+            header.write('ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+                         'BinaryDataByteOrderMSB = False\nDimSize = 20 17 13\n'
+                         'ElementSize = 1 1 1\nElementType = MET_SHORT\n'
+                         'ElementDataFile = image.raw\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _split(self, output_type=None, output_format=None, dim_order=None,
+               container=False, max_block_size_voxels=(7, 6, 5)):
+        out_base = os.path.join(self.folder, 'split')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=out_base, start_index=None,
+                   output_type=output_type, dim_order=dim_order,
+                   file_handle_factory=FileHandleFactory(),
+                   output_format=output_format, slice_output=False,
+                   rescale=None, out_compression=None,
+                   max_block_size_voxels=list(max_block_size_voxels),
+                   overlap_size_voxels=1,
+                   container=container)
+        return out_base + '_info.imagesplit'
+
+    @parameterized.expand([
+        [None, None, None, False],
+        ['float', None, [2, -1, 3], False],
+        [None, None, None, True],
+    ])
+    def test_verify(self, output_type, output_format, dim_order, container):
+        descriptor_filename = self._split(output_type, output_format,
+                                          dim_order, container)
+        split_files = load_descriptor(descriptor_filename)['split_files']
+        self.assertEqual(27, len(split_files))
+        self.assertEqual(27, len(set(entry['checksum']
+                                     for entry in split_files)))
+        self.assertEqual([], verify_files.verify_files(descriptor_filename,
+                                                       num_threads=4))
+
+    def test_raw_copy_not_read_back(self):
+        # Data copied without conversion are added to the checksum as they
+        # are copied, so the output files are not read again
+        with patch.object(FileStreamer, 'copy_from',
+                          autospec=True,
+                          side_effect=FileStreamer.copy_from) as copy_from, \
+                patch.object(FileStreamer, 'compute_checksum') as compute:
+            descriptor_filename = self._split()
+        self.assertTrue(copy_from.called)
+        self.assertFalse(compute.called)
+        self.assertEqual([], verify_files.verify_files(descriptor_filename))
+
+    def test_verify_tiff(self):
+        with patch.object(FileHandleFactory, 'create_file_handle',
+                          autospec=True,
+                          side_effect=FileHandleFactory.create_file_handle
+                          ) as create_file_handle:
+            descriptor_filename = self._split(
+                'uchar', 'tiff', max_block_size_voxels=[20, 17, 1])
+        self.assertEqual([], verify_files.verify_files(descriptor_filename))
+
+        # TIFF files are written using the file handle factory
+        self.assertIn((os.path.join(self.folder, 'split_0003.tiff'), 'wb'),
+                      [call[0][1:] for call in
+                       create_file_handle.call_args_list])
+
+        with open(os.path.join(self.folder, 'split_0003.tiff'), 'ab') as tiff:
+            tiff.write(b'x')
+        self.assertEqual([os.path.join(self.folder, 'split_0003.tiff')],
+                         [filename for filename, _ in
+                          verify_files.verify_files(descriptor_filename)])
+
+    def test_corrupt_and_missing(self):
+        descriptor_filename = self._split()
+        raw_5 = os.path.join(self.folder, 'split_0005.raw')
+        with open(raw_5, 'r+b') as raw_file:
+            raw_file.seek(10)
+            raw_file.write(b'x')
+        os.remove(os.path.join(self.folder, 'split_0007.raw'))
+
+        failures = verify_files.verify_files(descriptor_filename)
+        self.assertEqual([os.path.join(self.folder, 'split_0005.mhd'),
+                          os.path.join(self.folder, 'split_0007.mhd')],
+                         [filename for filename, _ in failures])
+        self.assertIn('does not match', failures[0][1])
+        self.assertIn('Cannot read file', failures[1][1])
+
+        with self.assertRaises(SystemExit):
+            verify_files.main([descriptor_filename])
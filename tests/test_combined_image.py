@@ -6,7 +6,9 @@ from parameterized import parameterized, param
 
 from tests.common_test_functions import FakeImageFileReader, create_dummy_image
 from imagesplit.image.combined_image import SubImage, CoordinateTransformer, \
-    CombinedImage, LocalSource, Axis
+    CombinedImage, LocalSource, Axis, RoiIndex, HaloCache, \
+    plan_halo_traversal
+from imagesplit.image.image_wrapper import ImageStorage
 from imagesplit.utils.file_descriptor import SubImageDescriptor
 
 
@@ -104,7 +106,73 @@ class TestCombinedImage(TestCase):
         self.assertEqual(limits.min, np.min(image.image.get_raw()))
         self.assertEqual(limits.max, np.max(image.image.get_raw()))
 
-
+    def test_read_into(self):
+        d1 = self._make_descriptor(1, [[0, 9, 0, 0], [0, 9, 0, 0], [0, 4, 0, 0]])
+        d2 = self._make_descriptor(2, [[0, 9, 0, 0], [0, 9, 0, 0], [5, 9, 0, 0]])
+        image = create_dummy_image([10, 10, 10], value_base=1)
+        ci = CombinedImage([d1, d2], FakeFileFactory(image=image))
+        transformer = global_coordinate_transformer([10, 10, 10])
+
+        # The buffer is reused and filled for each read
+        out = ImageStorage(np.full((3, 10, 10), -1))
+        read_image = ci.read_into([0, 0, 3], [10, 10, 3], transformer, out)
+        self.assertIs(out, read_image.image)
+        np.testing.assert_array_equal(
+            image.get_sub_image([0, 0, 3], [10, 10, 3]).image.get_raw(),
+            out.get_raw())
+
+        # Regions which are not covered by a subimage are zero-filled
+        read_image = ci.read_into([0, 0, 8], [10, 10, 3], transformer, out)
+        self.assertIs(out, read_image.image)
+        np.testing.assert_array_equal(
+            image.get_sub_image([0, 0, 8], [10, 10, 2]).image.get_raw(),
+            out.get_raw()[:2])
+        np.testing.assert_array_equal(0, out.get_raw()[2])
+
+        with self.assertRaises(ValueError):
+            ci.read_into([0, 0, 0], [10, 10, 2], transformer, out)
+
+        # Released buffers are returned by later reads
+        ci.release(out)
+        read_image = ci.read_into([0, 0, 0], [10, 10, 3], transformer)
+        self.assertIs(out.get_raw(), read_image.image.get_raw())
+        np.testing.assert_array_equal(
+            image.get_sub_image([0, 0, 0], [10, 10, 3]).image.get_raw(),
+            out.get_raw())
+
+    def test_halo_cache(self):
+        d1 = self._make_descriptor(1, [[0, 9, 0, 0], [0, 9, 0, 0], [0, 9, 0, 0]])
+        image = create_dummy_image([10, 10, 10], value_base=1)
+        file_factory = FakeFileFactory(image=image)
+        ci = CombinedImage([d1], file_factory)
+        transformer = global_coordinate_transformer([10, 10, 10])
+        halo_cache = HaloCache()
+        ci.set_halo_cache(halo_cache)
+
+        # Slices 3 and 4 are read for the first block and kept for the second
+        halo_cache.begin_block(0, [([0, 0, 3], [10, 10, 2], 1)])
+        ci.read_image([0, 0, 0], [10, 10, 5], transformer)
+        read_file = file_factory.read_files[0]
+        read_file.read_image = Mock(side_effect=read_file.read_image)
+
+        halo_cache.begin_block(1, [])
+        read_image = ci.read_image([0, 0, 3], [10, 10, 4], transformer)
+        np.testing.assert_array_equal(
+            image.get_sub_image([0, 0, 3], [10, 10, 4]).image.get_raw(),
+            read_image.image.get_raw())
+        read_file.read_image.assert_called_once_with((0, 0, 5), (10, 10, 2))
+
+        # A region which is fully cached is not read from the file
+        read_image = ci.read_image([2, 0, 4], [3, 10, 1], transformer)
+        np.testing.assert_array_equal(
+            image.get_sub_image([2, 0, 4], [3, 10, 1]).image.get_raw(),
+            read_image.image.get_raw())
+        self.assertEqual(1, read_file.read_image.call_count)
+
+        # Cached data are discarded after the last block which needs them
+        halo_cache.begin_block(2, [])
+        ci.read_image([0, 0, 4], [10, 10, 1], transformer)
+        self.assertEqual(2, read_file.read_image.call_count)
 
     def _make_descriptor(self, index, ranges):
         return SubImageDescriptor.from_dict({"filename": 'TestFileName',
@@ -114,6 +182,44 @@ class TestCombinedImage(TestCase):
             "voxel_size": [1, 1, 1]})
 
 
+class TestRoiIndex(TestCase):
+
+    def test_find_overlapping(self):
+        index = RoiIndex([[[0, 11, 0, 2], [0, 9, 0, 0]],
+                          [[8, 21, 2, 2], [0, 9, 0, 0]],
+                          [[18, 29, 2, 0], [0, 9, 0, 0]]])
+        self.assertEqual([0], index.find_overlapping([0, 0], [10, 10]))
+        self.assertEqual([0, 1], index.find_overlapping([9, 5], [2, 1]))
+        self.assertEqual([1, 2], index.find_overlapping([19, 0], [2, 10]))
+        self.assertEqual([], index.find_overlapping([0, 10], [30, 1]))
+        self.assertEqual([], RoiIndex([]).find_overlapping([0, 0], [1, 1]))
+
+
+class TestPlanHaloTraversal(TestCase):
+
+    def test_plan_halo_traversal(self):
+        # Two blocks along x and three along z, overlapping by one voxel
+        x_ranges = [[0, 5, 0, 1], [4, 9, 1, 0]]
+        z_ranges = [[0, 3, 0, 1], [2, 6, 1, 1], [5, 8, 1, 0]]
+        ranges = [[x, [0, 9, 0, 0], z] for x in x_ranges for z in z_ranges]
+        order, regions = plan_halo_traversal(ranges, [0, 1, 2])
+
+        # z changes fastest, in a serpentine order
+        self.assertEqual([0, 1, 2, 5, 4, 3], order)
+        self.assertEqual(sorted(regions[0]), sorted([
+            ([0, 0, 2], [6, 10, 2], 1),
+            ([4, 0, 0], [2, 10, 4], 5)]))
+        self.assertEqual(sorted(regions[2]), sorted([
+            ([4, 0, 5], [2, 10, 4], 3)]))
+        self.assertEqual(regions[5], [])
+
+        # Without overlap there is nothing to keep
+        order, regions = plan_halo_traversal(
+            [[[0, 4, 0, 0]], [[5, 9, 0, 0]]], [0])
+        self.assertEqual([0, 1], order)
+        self.assertEqual([[], []], regions)
+
+
 def global_coordinate_transformer(size):
     return CoordinateTransformer(np.zeros_like(size), size, Axis(np.arange(0, len(size)), np.zeros_like(size)))
 
@@ -205,7 +311,7 @@ class TestSubImage(TestCase):
         transformer = CoordinateTransformer(
             descriptor.ranges.origin_start, descriptor.ranges.image_size,
             descriptor.axis)
-        expected_start, expected_size = transformer.to_local(start, size)
+        expected_start, expected_size = transformer.to_local_region(start, size)
         test_image = si.read_image(start, size)
         np.testing.assert_array_equal(test_image.image, sub_image.image)
         np.testing.assert_array_equal(read_file.read_image.call_args[0][0], expected_start)
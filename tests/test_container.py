@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import numpy as np
+
+from imagesplit.applications.split_files import split_file
+from imagesplit.file.container import create_container, DATA_ALIGNMENT
+from imagesplit.file.file_factory import FileFactory
+from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.utils.file_descriptor import load_descriptor, \
+    SubImageDescriptor, generate_output_descriptors
+
+
+class TestContainer(unittest.TestCase):
+    """Tests for storing split files in a container"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.image = np.arange(20 * 17 * 13, dtype='<i2').reshape(13, 17, 20)
+        self.image.tofile(os.path.join(self.folder, 'image.raw'))
+        with open(os.path.join(self.folder, 'image.mhd'), 'w') as header:
+            header.write('ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+                         'BinaryDataByteOrderMSB = False\nDimSize = 20 17 13\n'
+                         'ElementSize = 1 1 1\nElementType = MET_SHORT\n'
+                         'ElementDataFile = image.raw\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _split(self, name, container, output_format=None):
+        out_folder = os.path.join(self.folder, name)
+        os.makedirs(out_folder)
+        out_base = os.path.join(out_folder, 'split')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=out_base, start_index=None,
+                   output_type=None, dim_order=None,
+                   file_handle_factory=FileHandleFactory(),
+                   output_format=output_format, slice_output=False,
+                   rescale=None, out_compression=None,
+                   max_block_size_voxels=[7, 6, 5], overlap_size_voxels=1,
+                   container=container)
+        return out_base
+
+    def test_same_output_as_files(self):
+        files_base = self._split('files', False)
+        container_base = self._split('container', True)
+        self.assertEqual(['split.tar', 'split_info.imagesplit'],
+                         sorted(os.listdir(os.path.dirname(container_base))))
+
+        with tarfile.open(container_base + '.tar') as container:
+            self.assertEqual(54, len(container.getnames()))
+            for index in range(27):
+                for extension in ['.mhd', '.raw']:
+                    name = 'split_{0:04d}'.format(index) + extension
+                    member = container.getmember(name)
+                    if extension == '.raw':
+                        self.assertEqual(0, member.offset_data %
+                                         DATA_ALIGNMENT)
+                    with open(files_base + name[5:], 'rb') as split:
+                        expected = split.read()
+                    actual = container.extractfile(member).read()
+                    if extension == '.mhd':
+                        # Headers are padded to align the raw data
+                        actual = actual.rstrip(b'\n') + b'\n'
+                    self.assertEqual(expected, actual)
+
+    def test_read_through_file_factory(self):
+        container_base = self._split('container', True)
+        descriptors = [SubImageDescriptor.from_dict(entry) for entry in
+                       load_descriptor(container_base +
+                                       '_info.imagesplit')['split_files']]
+        descriptor = descriptors[13]
+        self.assertEqual(container_base + '.tar', descriptor.container)
+
+        read_file = FileFactory(FileHandleFactory()).create_read_file(
+            descriptor)
+        ranges = descriptor.ranges.ranges
+        line = read_file.read_line([0, 0, 0], ranges[0][1] - ranges[0][0] + 1)
+        read_file.close()
+        np.testing.assert_array_equal(
+            self.image[ranges[2][0], ranges[1][0], ranges[0][0]:
+                       ranges[0][1] + 1], line)
+
+    def test_test_mode(self):
+        descriptors = generate_output_descriptors(
+            filename_out_base=os.path.join(self.folder, 'split'),
+            max_block_size_voxels=[10, 10, 5], overlap_size_voxels=0,
+            dim_order=[1, 2, 3], header={}, output_type="short", num_dims=3,
+            output_file_format="mhd", image_size=[20, 10, 10], msb=False,
+            compression=None, voxel_size=[1, 1, 1])
+        create_container(os.path.join(self.folder, 'split.tar'), descriptors,
+                         test=True)
+        self.assertFalse(os.path.exists(os.path.join(self.folder,
+                                                     'split.tar')))
+        offsets = [descriptor.offset for descriptor in descriptors]
+        self.assertEqual(sorted(offsets), offsets)
+        for offset in offsets:
+            self.assertEqual(0, offset % DATA_ALIGNMENT)
+
+    def test_only_mhd(self):
+        with self.assertRaises(ValueError):
+            self._split('tiff', True, 'tiff')
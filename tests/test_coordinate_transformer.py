@@ -1,3 +1,4 @@
+import weakref
 from unittest import TestCase
 
 from tests.common_test_functions import create_dummy_image_storage
@@ -79,3 +80,75 @@ class TestCoordinateTransformer(TestCase):
 
         global_image_2 = ct.image_to_global(local_image)
         np.testing.assert_array_equal(global_image_raw, global_image_2.get_raw())
+
+    @parameterized.expand([
+        param(origin=[0, 0, 0], size=[10, 10, 10], order=[0, 1, 2], flip=[0, 0, 0], g_start=[0, 0, 0], g_size=[10, 10, 10], l_start=[0, 0, 0], l_size=[10, 10, 10]),
+        param(origin=[6, 3, 1], size=[20, 25, 35], order=[0, 2, 1], flip=[0, 0, 0], g_start=[7, 9, 11], g_size=[5, 6, 7], l_start=[1, 10, 6], l_size=[5, 7, 6]),
+        param(origin=[0, 0, 0], size=[5, 6, 7], order=[0, 1, 2], flip=[1, 0, 0], g_start=[1, 2, 3], g_size=[2, 3, 4], l_start=[2, 2, 3], l_size=[2, 3, 4]),
+        param(origin=[0, 0, 0], size=[5, 6, 7], order=[0, 1, 2], flip=[1, 1, 0], g_start=[1, 2, 3], g_size=[2, 3, 4], l_start=[2, 1, 3], l_size=[2, 3, 4]),
+        param(origin=[6, 3, 1], size=[20, 25, 35], order=[2, 0, 1], flip=[1, 0, 0], g_start=[7, 9, 11], g_size=[5, 6, 7], l_start=[18, 1, 6], l_size=[7, 5, 6])
+    ])
+    def test_to_local_region(self, origin, size, order, flip, g_start, g_size, l_start, l_size):
+        ct = CoordinateTransformer(origin, size, Axis(order, flip))
+
+        o_l_start, o_l_size = ct.to_local_region(g_start, g_size)
+        np.testing.assert_array_equal(o_l_start, l_start)
+        np.testing.assert_array_equal(o_l_size, l_size)
+
+    @parameterized.expand([
+        param(order_1=[0, 1, 2], flip_1=[0, 0, 0], order_2=[0, 1, 2], flip_2=[0, 0, 0]),
+        param(order_1=[0, 1, 2], flip_1=[0, 0, 0], order_2=[2, 0, 1], flip_2=[1, 0, 0]),
+        param(order_1=[1, 0, 2], flip_1=[1, 0, 0], order_2=[0, 1, 2], flip_2=[0, 0, 0]),
+        param(order_1=[2, 0, 1], flip_1=[0, 1, 1], order_2=[1, 2, 0], flip_2=[1, 0, 1]),
+        param(order_1=[2, 1, 0], flip_1=[True, False, True], order_2=[2, 1, 0], flip_2=[True, False, True]),
+    ])
+    def test_image_to_other(self, order_1, flip_1, order_2, flip_2):
+        size = [3, 4, 5]
+        ct_1 = CoordinateTransformer([0, 0, 0], size, Axis(order_1, flip_1))
+        ct_2 = CoordinateTransformer([0, 0, 0], size, Axis(order_2, flip_2))
+        global_image = create_dummy_image_storage(size)
+        local_image_1 = ct_1.image_to_local(global_image)
+        local_image_2 = ct_1.image_to_other(local_image_1, ct_2)
+        np.testing.assert_array_equal(
+            ct_2.image_to_local(global_image).get_raw(),
+            local_image_2.get_raw())
+
+    @parameterized.expand([
+        param(origin_1=[0, 0, 0], order_1=[0, 1, 2], flip_1=[0, 0, 0], origin_2=[0, 0, 0], order_2=[0, 1, 2], flip_2=[0, 0, 0]),
+        param(origin_1=[1, 2, 3], order_1=[0, 1, 2], flip_1=[1, 0, 0], origin_2=[0, 0, 0], order_2=[2, 0, 1], flip_2=[0, 1, 0]),
+        param(origin_1=[2, 0, 1], order_1=[1, 2, 0], flip_1=[True, False, True], origin_2=[1, 1, 1], order_2=[2, 1, 0], flip_2=[False, True, True]),
+    ])
+    def test_region_transforms(self, origin_1, order_1, flip_1, origin_2, order_2, flip_2):
+        size = [6, 7, 8]
+        ct_1 = CoordinateTransformer(origin_1, size, Axis(order_1, flip_1))
+        ct_2 = CoordinateTransformer(origin_2, size, Axis(order_2, flip_2))
+        g_start = [3, 4, 5]
+        g_size = [2, 3, 1]
+
+        # Regions are transformed by converting each voxel in the region
+        voxels = np.stack(np.meshgrid(*[range(st, st + sz) for st, sz in zip(g_start, g_size)], indexing='ij'), -1).reshape(-1, 3)
+        local_1 = np.array([ct_1.to_local(v, [1, 1, 1])[0] for v in voxels])
+        local_2 = np.array([ct_2.to_local(v, [1, 1, 1])[0] for v in voxels])
+
+        l_start_1, l_size_1 = ct_1.to_local_region(g_start, g_size)
+        np.testing.assert_array_equal(local_1.min(0), l_start_1)
+
+        o_g_start, o_g_size = ct_1.to_global_region(l_start_1, l_size_1)
+        np.testing.assert_array_equal(g_start, o_g_start)
+        np.testing.assert_array_equal(g_size, o_g_size)
+
+        l_start_2, l_size_2 = ct_1.to_other_region(l_start_1, l_size_1, ct_2)
+        np.testing.assert_array_equal(local_2.min(0), l_start_2)
+        np.testing.assert_array_equal(ct_2.to_local_region(g_start, g_size)[1], l_size_2)
+
+        for voxel, voxel_1, voxel_2 in zip(voxels, local_1, local_2):
+            np.testing.assert_array_equal(voxel_2, ct_1.to_other(voxel_1, [1, 1, 1], ct_2)[0])
+
+    def test_other_transformers_not_retained(self):
+        size = [6, 7, 8]
+        ct_1 = CoordinateTransformer([0, 0, 0], size, Axis([0, 1, 2], [0, 0, 0]))
+        ct_2 = CoordinateTransformer([1, 2, 3], size, Axis([2, 0, 1], [0, 1, 0]))
+        ct_1.to_other([0, 0, 0], [1, 1, 1], ct_2)
+        reference = weakref.ref(ct_2)
+        del ct_2
+        self.assertIsNone(reference())
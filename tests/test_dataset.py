@@ -0,0 +1,80 @@
+import numpy as np
+from parameterized import parameterized
+from pyfakefs import fake_filesystem_unittest
+
+import imagesplit
+from imagesplit.applications.split_files import split_file
+from imagesplit.file.file_wrapper import FileHandleFactory, get_handle_pool
+
+
+class TestSplitDataset(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.image = np.arange(4 * 5 * 6, dtype='>i2').reshape(6, 5, 4)
+        self.fs.create_file('/in/image.mhd', contents=(
+            'ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+            'BinaryDataByteOrderMSB = True\nDimSize = 4 5 6\n'
+            'ElementSize = 1 1 1\nElementType = MET_SHORT\n'
+            'ElementDataFile = image.raw\n'))
+        self.fs.create_file('/in/image.raw', contents=self.image.tobytes())
+        self.fs.create_dir('/out')
+        split_file(input_file_base='/in/image.mhd',
+                   filename_out_base='/out/split', start_index=None,
+                   output_type=None, dim_order=[-2, 1, -3],
+                   file_handle_factory=FileHandleFactory(),
+                   output_format=None, slice_output=False, rescale=None,
+                   out_compression=None, max_block_size_voxels=[2, 3, 2],
+                   overlap_size_voxels=1)
+
+    def tearDown(self):
+        # Files in the fake file system must be closed before it is removed
+        get_handle_pool().close_all()
+
+    @parameterized.expand([
+        [np.s_[:]],
+        [np.s_[1:3, 2, ::-1]],
+        [np.s_[..., 3]],
+        [np.s_[-1, ::2, 1:5:3]],
+        [np.s_[3:0:-2, -2]],
+        [np.s_[2:2]],
+    ])
+    def test_getitem(self, key):
+        expected = np.transpose(self.image)[key]
+        with imagesplit.open('/out/split_info.imagesplit') as dataset:
+            self.assertEqual((4, 5, 6), dataset.shape)
+            self.assertEqual(np.dtype('>i2'), dataset.dtype)
+            np.testing.assert_array_equal(expected, dataset[key])
+
+    @parameterized.expand([
+        [np.s_[:]],
+        [np.s_[1:3, 2, ::-1]],
+        [np.s_[-1, ::2, 1:5:3]],
+    ])
+    def test_tiff(self, key):
+        split_file(input_file_base='/in/image.mhd',
+                   filename_out_base='/out/tiff', start_index=None,
+                   output_type=None, dim_order=None,
+                   file_handle_factory=FileHandleFactory(),
+                   output_format='tiff', slice_output='a', rescale=None,
+                   out_compression=None, max_block_size_voxels=None,
+                   overlap_size_voxels=None)
+        expected = np.transpose(self.image)[key]
+        with imagesplit.open('/out/tiff_info.imagesplit') as dataset:
+            values = dataset[key]
+            self.assertEqual(dataset.dtype, values.dtype)
+            np.testing.assert_array_equal(expected, values)
+
+    def test_without_source(self):
+        self.fs.remove_object('/in/image.mhd')
+        self.fs.remove_object('/in/image.raw')
+        with imagesplit.open('/out/split_info.imagesplit') as dataset:
+            self.assertEqual((4, 5, 6), dataset.shape)
+            np.testing.assert_array_equal(np.transpose(self.image),
+                                          dataset[:])
+
+    def test_index_errors(self):
+        with imagesplit.open('/out/split_info.imagesplit') as dataset:
+            with self.assertRaises(IndexError):
+                _ = dataset[4]
+            with self.assertRaises(IndexError):
+                _ = dataset[0, 0, 0, 0]
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from mock import patch
+from parameterized import parameterized
+
+from imagesplit.applications import extract_files
+from imagesplit.applications.split_files import split_file
+from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.file.metaio_reader import load_mhd_header
+from imagesplit.file.tiff_file_reader import TiffFileReader
+from imagesplit.utils.file_descriptor import load_descriptor
+
+
+class TestExtractFiles(unittest.TestCase):
+    """Extract regions from split images"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.image = np.arange(20 * 17 * 13, dtype='<i2').reshape(13, 17, 20)
+        self.image.tofile(os.path.join(self.folder, 'image.raw'))
+        with open(os.path.join(self.folder, 'image.mhd'), 'w') as header:
+            header.write('ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+                         'BinaryDataByteOrderMSB = False\nDimSize = 20 17 13\n'
+                         'ElementSize = 1 1 1\nElementType = MET_SHORT\n'
+                         'ElementDataFile = image.raw\n')
+        self.split_base = os.path.join(self.folder, 'split')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=self.split_base, start_index=None,
+                   output_type=None, dim_order=[2, -1, 3],
+                   file_handle_factory=FileHandleFactory(),
+                   output_format=None, slice_output=False, rescale=None,
+                   out_compression=None, max_block_size_voxels=[7, 6, 5],
+                   overlap_size_voxels=1)
+        self.out_filename = os.path.join(self.folder, 'roi.mhd')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _read_output(self, size):
+        return np.fromfile(os.path.join(self.folder, 'roi.raw'),
+                           dtype='<i2').reshape(list(reversed(size)))
+
+    @parameterized.expand([
+        [[0, 0, 0], [20, 17, 13]],
+        [[2, 3, 4], [5, 6, 7]],
+        [[19, 16, 12], [1, 1, 1]],
+        [[6, 0, 0], [2, 17, 13]],
+    ])
+    def test_extract(self, start, size):
+        extract_files.extract_roi(self.split_base + '_info.imagesplit',
+                                  self.out_filename, start, size,
+                                  dim_order=[1, 2, 3], max_bytes=100)
+        end = np.add(start, size)
+        np.testing.assert_array_equal(
+            self.image[start[2]:end[2], start[1]:end[1], start[0]:end[0]],
+            self._read_output(size))
+        header = load_mhd_header(self.out_filename)
+        self.assertEqual(' '.join(str(s) for s in start), header['Origin'])
+        self.assertEqual(size, header['DimSize'])
+
+    def test_only_overlapping_files(self):
+        # Remove every split file which does not overlap the region
+        start, size = [2, 3, 4], [3, 2, 2]
+        for entry in load_descriptor(
+                self.split_base + '_info.imagesplit')['split_files']:
+            first = [r[0] + r[2] for r in entry['ranges']]
+            last = [r[1] - r[3] for r in entry['ranges']]
+            if np.any(np.greater(first, np.add(start, size) - 1)) or \
+                    np.any(np.less(last, start)):
+                os.remove(entry['filename'])
+
+        extract_files.main(['--start', '2,3,4', '--size', '3,2,2',
+                            self.split_base + '_info.imagesplit', '-o',
+                            self.out_filename, '-a', '1', '2', '3'])
+        np.testing.assert_array_equal(self.image[4:6, 3:5, 2:5],
+                                      self._read_output(size))
+
+    def test_extract_tiff(self):
+        tiff_base = os.path.join(self.folder, 'tiff')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=tiff_base, start_index=None,
+                   output_type=None, dim_order=None,
+                   file_handle_factory=FileHandleFactory(),
+                   output_format='tiff', slice_output=False, rescale=None,
+                   out_compression=None, max_block_size_voxels=[7, 6, 1],
+                   overlap_size_voxels=0)
+
+        # Record the decoded TIFF files held in memory as each one is loaded
+        readers = []
+        max_loaded = [0]
+        load = TiffFileReader.load
+
+        def counting_load(reader):
+            image = load(reader)
+            readers.append(reader)
+            max_loaded[0] = max(max_loaded[0], sum(
+                1 for loaded in readers if loaded.cached_image is not None))
+            return image
+
+        with patch.object(TiffFileReader, 'load', counting_load):
+            extract_files.main([tiff_base + '_info.imagesplit', '-o',
+                                self.out_filename, '--start', '2,3,4',
+                                '--size', '5,6,7', '--max-bytes', '100',
+                                '-j', '1'])
+        np.testing.assert_array_equal(self.image[4:11, 3:9, 2:7],
+                                      self._read_output([5, 6, 7]))
+
+        # Each slice of the region is stored in 2 files, which are released
+        # once the slice has been written
+        self.assertEqual(14, len(readers))
+        self.assertLessEqual(max_loaded[0], 4)
+
+    def test_parse_coordinates(self):
+        self.assertEqual([100, 200, 50],
+                         extract_files.parse_coordinates('100,200,50'))
+        with self.assertRaises(ValueError):
+            extract_files.parse_coordinates('100,2.5,50')
+
+    @parameterized.expand([
+        [[0, 0], [1, 1]],
+        [[0, 0, 0], [21, 1, 1]],
+        [[-1, 0, 0], [1, 1, 1]],
+        [[0, 0, 0], [1, 0, 1]],
+    ])
+    def test_invalid_region(self, start, size):
+        with self.assertRaises(ValueError):
+            extract_files.extract_roi(self.split_base + '_info.imagesplit',
+                                      self.out_filename, start, size)
+
+    @parameterized.expand([
+        [['--start', '1,2,3', '--size', '1,2']],
+        [['--start', '1,2,x', '--size', '1,2,3']],
+        [['--start', '1,2,3']],
+    ])
+    def test_invalid_arguments(self, roi_arguments):
+        with self.assertRaises(SystemExit):
+            extract_files.main([self.split_base + '_info.imagesplit', '-o',
+                                self.out_filename] + roi_arguments)
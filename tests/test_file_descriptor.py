@@ -1,6 +1,15 @@
+import os
 from unittest import TestCase
 
-from imagesplit.utils.file_descriptor import SubImageDescriptor
+from parameterized import parameterized
+from pyfakefs import fake_filesystem_unittest
+
+from imagesplit.utils.file_descriptor import SubImageDescriptor, \
+    select_shard, write_descriptor_file, merge_descriptor_files, \
+    load_descriptor, get_descriptor_filename, DescriptorTable, \
+    encode_split_files, generate_input_descriptors, \
+    generate_output_descriptors, get_nested_subfolders, LAYOUT_NESTED
+from imagesplit.utils.json_reader import read_json
 
 
 class TestSubImageDescriptor(TestCase):
@@ -11,9 +20,9 @@ class TestSubImageDescriptor(TestCase):
         self.assertDictEqual(d_orig, d2)
 
     @staticmethod
-    def make_dict():
+    def make_dict(index=1):
         """Returns a dictionary object representing a subimage descriptor"""
-        return {"index": 1,
+        return {"index": index,
                 "suffix": "suf",
                 "filename": "my-filename",
                 "data_type": "short",
@@ -24,3 +33,205 @@ class TestSubImageDescriptor(TestCase):
                 "msb": False,
                 "voxel_size": [1.0, 1.0, 1.0],
                 "ranges": [[0, 11, 0, 2], [0, 11, 0, 2], [0, 11, 0, 2]]}
+
+
+class TestDescriptorTable(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.fs.create_dir('/out')
+        self.dicts = []
+        for index in [3, 0, 2, 1]:
+            entry = TestSubImageDescriptor.make_dict(index)
+            entry["suffix"] = "_" + str(index)
+            entry["filename"] = "/out/split_" + str(index) + ".mhd"
+            entry["ranges"] = [[0, 9, 0, 0], [0, 9, 0, 0],
+                               [10 * index, 10 * index + 9, 0, 0]]
+            self.dicts.append(entry)
+        self.sorted_dicts = sorted(self.dicts, key=lambda k: k['index'])
+
+    def test_table(self):
+        for split_files in [self.dicts, encode_split_files(self.dicts)]:
+            table = DescriptorTable(split_files)
+            self.assertEqual(4, len(table))
+            self.assertEqual(self.sorted_dicts, table.to_dicts())
+            self.assertEqual(
+                [SubImageDescriptor.from_dict(d) for d in self.sorted_dicts],
+                list(table))
+            self.assertEqual(table[-1], table[3])
+            self.assertEqual([table[1], table[3]], table[1::2])
+            self.assertEqual([d["ranges"] for d in self.sorted_dicts],
+                             table.get_ranges().tolist())
+            self.assertEqual(["short"], table.get_values("data_type"))
+
+    def test_filename_override(self):
+        table = DescriptorTable(encode_split_files(self.dicts), "/in/mask.tif")
+        self.assertEqual("/in/mask_2.tif", table[2].filename)
+
+    def test_filename_override_nested(self):
+        for entry in self.dicts:
+            entry["filename"] = "/out/000" + str(entry["index"] // 2) + \
+                "/split" + entry["suffix"] + ".mhd"
+        table = DescriptorTable(encode_split_files(self.dicts), "/in/mask.tif")
+        self.assertEqual("/in/0001/mask_2.tif", table[2].filename)
+        self.assertEqual("/in/0000/mask_1.tif", table[1].filename)
+
+    def test_compact_encoding(self):
+        compact = encode_split_files(self.dicts)
+        self.assertEqual(4, compact["count"])
+        self.assertEqual("short", compact["common"]["data_type"])
+        self.assertEqual({"filename", "index", "ranges", "suffix"},
+                         set(compact["columns"]))
+
+    def test_load_versions(self):
+        source = [SubImageDescriptor.from_dict(
+            TestSubImageDescriptor.make_dict(0))]
+        outputs = [SubImageDescriptor.from_dict(d) for d in self.sorted_dicts]
+
+        # The list format is written unless the compact format is requested
+        write_descriptor_file(source, outputs, "/out/split")
+        data = read_json("/out/split_info.imagesplit")
+        self.assertEqual("1.0", data["version"])
+        self.assertEqual(self.sorted_dicts, data["split_files"])
+
+        write_descriptor_file(source, outputs, "/out/compact", compact=True)
+        data = read_json("/out/compact_info.imagesplit")
+        self.assertEqual("1.1", data["version"])
+        self.assertEqual(self.sorted_dicts,
+                         load_descriptor("/out/compact_info.imagesplit")[
+                             "split_files"])
+
+    def test_missing_keys(self):
+        self.dicts[0]["checksum"] = "crc32:01234567"
+        self.dicts[2]["checksum"] = "crc32:89abcdef"
+        del self.dicts[1]["template"]
+        compact = encode_split_files(self.dicts)
+        self.assertEqual({"checksum": [1, 3], "template": [1]},
+                         compact["missing"])
+        table = DescriptorTable(compact)
+        self.assertEqual(self.sorted_dicts, table.to_dicts())
+        self.assertEqual([None, None, "crc32:89abcdef", "crc32:01234567"],
+                         table.get_values("checksum"))
+
+        del self.dicts[0]["ranges"]
+        with self.assertRaises(ValueError):
+            encode_split_files(self.dicts)
+
+
+class TestNestedLayout(TestCase):
+    @parameterized.expand([
+        [[0, 0, 0], [1, 1, 1], []],
+        [[2, 0, 5], [3, 1, 8], ["0002"]],
+        [[2, 3, 5], [3, 4, 8], ["0002", "0003"]],
+        [[0, 0, 2345], [1, 1, 4000], ["0002"]],
+        [[1, 0, 2345], [2, 1, 4000], ["0001", "0002"]],
+    ])
+    def test_get_nested_subfolders(self, block_number, number_of_blocks,
+                                   expected):
+        self.assertEqual(expected, get_nested_subfolders(block_number,
+                                                         number_of_blocks))
+
+    def test_generate_output_descriptors(self):
+        descriptors = generate_output_descriptors(
+            filename_out_base=os.path.join("out", "split"),
+            max_block_size_voxels=[10, 10, 5], overlap_size_voxels=0,
+            dim_order=[1, 2, 3], header={}, output_type="short",
+            num_dims=3, output_file_format="mhd", image_size=[20, 10, 10],
+            msb=False, compression=None, voxel_size=[1, 1, 1],
+            layout=LAYOUT_NESTED)
+        self.assertEqual(
+            [os.path.join("out", "0000", "split_0000.mhd"),
+             os.path.join("out", "0000", "split_0001.mhd"),
+             os.path.join("out", "0001", "split_0002.mhd"),
+             os.path.join("out", "0001", "split_0003.mhd")],
+            [descriptor.filename for descriptor in descriptors])
+        self.assertEqual(["_0000", "_0001", "_0002", "_0003"],
+                         [descriptor.suffix for descriptor in descriptors])
+
+
+class TestInputSeries(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        for index in [1, 2, 3, 5]:
+            self._create_file('/in/slice_00' + str(index) + '.mhd', index)
+        self._create_file('/in/slice_0004.mhd', 4)
+        self._create_file('/in/other_004.mhd', 4)
+        self.fs.create_dir('/in/slice_004.mhd')
+
+    def _create_file(self, filename, depth):
+        self.fs.create_file(filename, contents=(
+            'ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+            'BinaryDataByteOrderMSB = False\nDimSize = 4 5 ' + str(depth) +
+            '\nElementSize = 1 1 1\nElementType = MET_SHORT\n'
+            'ElementDataFile = slice.raw\n'))
+
+    def test_series(self):
+        _, descriptors, global_descriptor = generate_input_descriptors(
+            '/in/slice_.mhd', 1)
+        self.assertEqual(['/in/slice_001.mhd', '/in/slice_002.mhd',
+                          '/in/slice_003.mhd'],
+                         [d.filename for d in descriptors])
+        self.assertEqual([1, 2, 3], [d.index for d in descriptors])
+        self.assertEqual([[0, 0], [1, 2], [3, 5]],
+                         [d.ranges.ranges[2][0:2] for d in descriptors])
+        self.assertEqual([4, 5, 6], global_descriptor.size)
+
+    def test_single_file(self):
+        _, descriptors, _ = generate_input_descriptors('/in/slice_0004.mhd',
+                                                       None)
+        self.assertEqual(['/in/slice_0004.mhd'],
+                         [d.filename for d in descriptors])
+        self.assertRaises(ValueError, generate_input_descriptors,
+                          '/in/slice_.mhd', None)
+        self.assertRaises(ValueError, generate_input_descriptors,
+                          '/in/slice_.mhd', 6)
+
+
+class TestShards(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.fs.create_dir('/out')
+
+    def test_select_shard(self):
+        descriptors = list(range(10))
+        self.assertEqual(select_shard(descriptors, 1, 1), descriptors)
+        self.assertEqual(select_shard(descriptors, 1, 3), [0, 3, 6, 9])
+        self.assertEqual(select_shard(descriptors, 3, 3), [2, 5, 8])
+        self.assertEqual(select_shard(descriptors, 4, 4), [3, 7])
+        self.assertEqual(select_shard(descriptors, 5, 20), [4])
+        self.assertEqual(select_shard(descriptors, 15, 20), [])
+        self.assertEqual(
+            sorted(sum([select_shard(descriptors, i, 4)
+                        for i in range(1, 5)], [])), descriptors)
+        self.assertRaises(ValueError, select_shard, descriptors, 0, 3)
+        self.assertRaises(ValueError, select_shard, descriptors, 4, 3)
+
+    def test_merge_descriptor_files(self):
+        source = [SubImageDescriptor.from_dict(
+            TestSubImageDescriptor.make_dict(0))]
+        outputs = [SubImageDescriptor.from_dict(
+            TestSubImageDescriptor.make_dict(i)) for i in range(7)]
+        partials = []
+        for shard_index in [2, 3, 1]:
+            shard = (shard_index, 3)
+            write_descriptor_file(source, select_shard(outputs,
+                                                       shard_index, 3),
+                                  "/out/split", shard=shard)
+            partials.append(get_descriptor_filename("/out/split", shard))
+
+        # All shards must be present
+        self.assertRaises(ValueError, merge_descriptor_files, partials[0:2])
+        self.assertRaises(ValueError, merge_descriptor_files,
+                          partials + [partials[0]])
+
+        filename = merge_descriptor_files(partials)
+        self.assertEqual(filename, "/out/split_info.imagesplit")
+        merged = load_descriptor(filename)
+        self.assertNotIn("shard", merged)
+        self.assertEqual([d["index"] for d in merged["split_files"]],
+                         list(range(7)))
+        self.assertEqual(merged["source_files"], [source[0].to_dict()])
+
+        filename = merge_descriptor_files(partials, "/out/other.imagesplit")
+        self.assertEqual(filename, "/out/other.imagesplit")
+        self.assertEqual(load_descriptor(filename)["split_files"],
+                         merged["split_files"])
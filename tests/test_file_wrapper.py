@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 import math
 import os
+import shutil
 import struct
+import tempfile
+import threading
 import unittest
 
 import numpy
 import numpy as np
+from mock import patch
 from parameterized import parameterized
 from pyfakefs import fake_filesystem_unittest
 
+from imagesplit.applications.split_files import split_file
 from imagesplit.file import file_wrapper
-from imagesplit.file.file_wrapper import FileStreamer
+from imagesplit.file.file_wrapper import FileStreamer, DirectFileHandle, \
+    FileHandleFactory, CachePolicy, CACHE_DEFAULT, CACHE_STREAM, \
+    FileHandlePool, get_handle_pool
 from imagesplit.image.combined_image import Limits
+from imagesplit.utils.utilities import file_linear_byte_offset
 
 
 class FakeFileHandleFactory(object):
@@ -81,7 +89,8 @@ class TestFileWrapper(fake_filesystem_unittest.TestCase):
         self.setUpPyfakefs()
 
     def tearDown(self):
-        pass
+        # Files in the fake file system must be closed before it is removed
+        get_handle_pool().close_all()
 
     # noinspection PyUnusedLocal
     @parameterized.expand([
@@ -97,7 +106,8 @@ class TestFileWrapper(fake_filesystem_unittest.TestCase):
         fake_file_handle_factory = FakeFileHandleFactory(fake_file)
         wrapper = file_wrapper.FileWrapper("abc", fake_file_handle_factory, 'rb')
         self.assertEqual(fake_file.closed, True)
-        self.assertEqual(wrapper.get_handle(), fake_file)
+        with wrapper.use_handle() as handle:
+            self.assertEqual(handle, fake_file)
         self.assertEqual(fake_file.filename, "abc")
         self.assertEqual(fake_file.mode, "rb")
         self.assertEqual(fake_file.closed, False)
@@ -149,7 +159,8 @@ class TestStreamer(fake_filesystem_unittest.TestCase):
         self.setUpPyfakefs()
 
     def tearDown(self):
-        pass
+        # Files in the fake file system must be closed before it is removed
+        get_handle_pool().close_all()
 
     @parameterized.expand([
         [[2, 3, 8], 4, True, [1, 2, 3], 2],
@@ -252,12 +263,87 @@ class TestStreamer(fake_filesystem_unittest.TestCase):
                     (float(rescale_limits.max) - float(rescale_limits.min))
 
             expected_rescaled = np.around(offset +
-                scale*(expected_clipped.astype(np.float)
+                scale*(expected_clipped.astype(float)
                        - float(rescale_limits.min))).astype(expected.dtype)
         else:
             expected_rescaled = expected
         self.assertTrue(np.array_equal(expected_rescaled, read_file_contents))
 
+    @parameterized.expand([
+        [[2, 3, 8], 4, True, [0, 0, 3], 3, False],
+        [[101, 222, 4], 2, False, [0, 0, 1], 2, True],
+        [[16, 17, 256], 8, True, [0, 0, 0], 256, True],
+    ])
+    def test_write_lines(self, image_size, bytes_per_voxel, is_signed,
+                         start_coords, num_slices, swap_byte_order):
+        np_type = np.dtype(TestStreamer.get_np_type(bytes_per_voxel,
+                                                    is_signed))
+        file_type = np_type.newbyteorder('S') if swap_byte_order else np_type
+        num_elements = image_size[0] * image_size[1] * image_size[2]
+        base_data = TestStreamer.generate_array(
+            num_elements, bytes_per_voxel, is_signed)
+        self.fs.create_file('/test/lines.bin',
+                            contents=base_data.astype(file_type).tobytes())
+        slice_size = image_size[0] * image_size[1]
+        to_write = TestStreamer.generate_array(
+            slice_size * num_slices, bytes_per_voxel, is_signed)
+        to_write = to_write.reshape(num_slices, image_size[1], image_size[0])
+        expected = base_data.copy()
+        start = start_coords[2] * slice_size
+        expected[start:start + to_write.size] = to_write.flatten()
+
+        file_streamer = FileStreamer(
+            file_wrapper.FileWrapper('/test/lines.bin',
+                                     file_wrapper.FileHandleFactory(), 'r+b'),
+            image_size, bytes_per_voxel, file_type, [1, 2, 3])
+        file_streamer.write_lines(start_coords, to_write, None)
+        file_streamer.close()
+
+        with open('/test/lines.bin', 'rb') as f:
+            read_file_contents = np.frombuffer(f.read(), dtype=file_type)
+        np.testing.assert_array_equal(expected, read_file_contents)
+
+    @parameterized.expand([
+        [[2, 3, 8], 4, True, [1, 2, 3], [0, 1, 2], 2],
+        [[101, 222, 4], 2, False, [1, 1, 1], [3, 0, 2], 100],
+        [[16, 17, 256], 1, False, [0, 0, 0], [0, 0, 0], 16 * 17 * 256],
+    ])
+    def test_copy_from(self, image_size, bytes_per_voxel, is_signed,
+                       source_coords, start_coords, num_voxels):
+        np_type = TestStreamer.get_np_type(bytes_per_voxel, is_signed)
+        num_elements = image_size[0] * image_size[1] * image_size[2]
+        source_data = TestStreamer.generate_array(
+            num_elements, bytes_per_voxel, is_signed)
+        dest_data = TestStreamer.generate_array(
+            num_elements, bytes_per_voxel, is_signed)
+        TestStreamer.write_to_fake_file('/test/source.bin', source_data,
+                                        bytes_per_voxel, is_signed)
+        TestStreamer.write_to_fake_file('/test/dest.bin', dest_data,
+                                        bytes_per_voxel, is_signed)
+
+        file_handle_factory = file_wrapper.FileHandleFactory()
+        source_streamer = FileStreamer(
+            file_wrapper.FileWrapper('/test/source.bin', file_handle_factory,
+                                     'rb'),
+            image_size, bytes_per_voxel, np_type, [1, 2, 3])
+        dest_streamer = FileStreamer(
+            file_wrapper.FileWrapper('/test/dest.bin', file_handle_factory,
+                                     'r+b'),
+            image_size, bytes_per_voxel, np_type, [1, 2, 3])
+        dest_streamer.copy_from(source_streamer, source_coords, start_coords,
+                                num_voxels)
+        source_streamer.close()
+        dest_streamer.close()
+
+        source_start = file_linear_byte_offset(image_size, 1, source_coords)
+        dest_start = file_linear_byte_offset(image_size, 1, start_coords)
+        expected = dest_data.copy()
+        expected[dest_start:dest_start + num_voxels] = \
+            source_data[source_start:source_start + num_voxels]
+        read_file_contents = TestStreamer.read_from_fake_file(
+            '/test/dest.bin', bytes_per_voxel, is_signed)
+        self.assertTrue(np.array_equal(expected, read_file_contents))
+
     @staticmethod
     def read_from_fake_file(file_name, bytes_per_voxel, is_signed):
         fmt = TestStreamer.get_fmt_string(bytes_per_voxel, is_signed)
@@ -337,3 +423,334 @@ class TestStreamer(fake_filesystem_unittest.TestCase):
             num_elements = len(array_to_write)
             to_write_bytes = struct.pack(fmt * num_elements, *array_to_write)
             f.write(to_write_bytes)
+
+
+@unittest.skipUnless(hasattr(os, 'preadv'), 'Direct I/O is not supported')
+class TestDirectFileHandle(unittest.TestCase):
+    """Direct I/O is tested using real files, since it is carried out by the
+    operating system"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'test.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _open(self, mode):
+        return DirectFileHandle(self.filename, mode, block_size=4096,
+                                buffer_size=8192)
+
+    def _contents(self):
+        with open(self.filename, 'rb') as test_file:
+            return test_file.read()
+
+    @parameterized.expand([
+        [0, 10],
+        [5, 4091],
+        [4090, 20],
+        [100, 20000],
+        [19990, 100],
+    ])
+    def test_read(self, offset, num_bytes):
+        data = os.urandom(20000)
+        with open(self.filename, 'wb') as test_file:
+            test_file.write(data)
+        with self._open('rb') as handle:
+            handle.seek(offset)
+            self.assertEqual(data[offset:offset + num_bytes],
+                             handle.read(num_bytes))
+            self.assertEqual(min(offset + num_bytes, 20000), handle.tell())
+
+    @parameterized.expand([
+        [0, 10],
+        [5, 4091],
+        [4090, 20],
+        [100, 20000],
+        [19990, 100],
+        [25000, 10],
+    ])
+    def test_overwrite(self, offset, num_bytes):
+        # Bytes either side of the written range must be preserved, including
+        # those in the same file system block
+        expected = bytearray(os.urandom(20000))
+        with open(self.filename, 'wb') as test_file:
+            test_file.write(expected)
+        data = os.urandom(num_bytes)
+        with self._open('r+b') as handle:
+            handle.seek(offset)
+            handle.write(data)
+        expected.extend(bytes(max(0, offset - len(expected))))
+        expected[offset:offset + num_bytes] = data
+        self.assertEqual(bytes(expected), self._contents())
+
+    def test_write_lines(self):
+        # Consecutive unaligned writes, as made by FileStreamer
+        image = np.arange(3 * 7 * 301, dtype='<i2').reshape(3, 7, 301)
+        with self._open('wb') as handle:
+            for index, line in enumerate(image.reshape(21, 301)):
+                handle.seek(index * 602)
+                handle.write(line)
+            handle.seek(1000)
+            self.assertEqual(image.tobytes()[1000:1100], handle.read(100))
+        self.assertEqual(image.tobytes(), self._contents())
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            self._open('a')
+
+
+@unittest.skipUnless(hasattr(os, 'preadv'), 'Direct I/O is not supported')
+class TestDirectIoSplit(unittest.TestCase):
+    """Split an image using direct I/O"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        image = np.arange(20 * 17 * 13, dtype='<i2').reshape(13, 17, 20)
+        image.tofile(os.path.join(self.folder, 'image.raw'))
+        with open(os.path.join(self.folder, 'image.mhd'), 'w') as header:
+            header.write('ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+                         'BinaryDataByteOrderMSB = False\nDimSize = 20 17 13\n'
+                         'ElementSize = 1 1 1\nElementType = MET_SHORT\n'
+                         'ElementDataFile = image.raw\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _split(self, name, output_type, direct_io):
+        out_folder = os.path.join(self.folder, name + output_type)
+        os.makedirs(out_folder)
+        out_base = os.path.join(out_folder, 'split')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=out_base, start_index=None,
+                   output_type=output_type, dim_order=[2, -1, 3],
+                   file_handle_factory=FileHandleFactory(direct_io=direct_io),
+                   output_format=None, slice_output=False, rescale=None,
+                   out_compression=None, max_block_size_voxels=[7, 6, 5],
+                   overlap_size_voxels=1)
+        return out_base
+
+    def test_same_output_as_buffered(self):
+        for output_type in ['short', 'float']:
+            buffered_base = self._split('buffered', output_type, False)
+            direct_base = self._split('direct', output_type, True)
+            for index in range(27):
+                suffix = '_{0:04d}.raw'.format(index)
+                with open(buffered_base + suffix, 'rb') as buffered_file:
+                    with open(direct_base + suffix, 'rb') as direct_file:
+                        self.assertEqual(buffered_file.read(),
+                                         direct_file.read())
+
+
+@unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'fadvise is not supported')
+class TestCachePolicy(unittest.TestCase):
+    """Check the hints given to the operating system by CachePolicy"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'test.bin')
+        with open(self.filename, 'wb') as test_file:
+            test_file.write(bytes(10000))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _wrapper(self, mode, policy):
+        return file_wrapper.FileWrapper(
+            self.filename, FileHandleFactory(cache_policy=policy), mode)
+
+    def test_from_name(self):
+        self.assertIsNone(CachePolicy.from_name(CACHE_DEFAULT))
+        self.assertIsInstance(CachePolicy.from_name(CACHE_STREAM),
+                              CachePolicy)
+        with self.assertRaises(ValueError):
+            CachePolicy.from_name('unknown')
+
+    def test_read_hints(self):
+        wrapper = self._wrapper('rb', CachePolicy(readahead_bytes=1000))
+        with patch('os.posix_fadvise') as fadvise:
+            for offset in range(0, 2000, 100):
+                self.assertEqual(bytes(100), wrapper.read(offset, 100))
+            wrapper.read(5000, 100)
+            wrapper.close()
+        hints = [call[0][1:] for call in fadvise.call_args_list]
+
+        # Prefetching continues from the end of the previous prefetch, and
+        # restarts after a seek
+        self.assertEqual([(0, 0, os.POSIX_FADV_SEQUENTIAL),
+                          (100, 1000, os.POSIX_FADV_WILLNEED),
+                          (1100, 600, os.POSIX_FADV_WILLNEED),
+                          (1700, 600, os.POSIX_FADV_WILLNEED),
+                          (2300, 600, os.POSIX_FADV_WILLNEED),
+                          (5100, 1000, os.POSIX_FADV_WILLNEED)], hints)
+
+    def test_write_hints(self):
+        wrapper = self._wrapper('r+b', CachePolicy(drop_behind_bytes=1000))
+        with patch('os.posix_fadvise') as fadvise:
+            for offset in range(0, 2500, 500):
+                wrapper.write(offset, np.zeros(250, dtype=np.int16))
+            wrapper.close()
+        hints = [call[0][1:] for call in fadvise.call_args_list]
+
+        # Each chunk is dropped when written and again at the next chunk,
+        # and the whole file is dropped when closed
+        self.assertEqual([(0, 1000, os.POSIX_FADV_DONTNEED),
+                          (0, 1000, os.POSIX_FADV_DONTNEED),
+                          (1000, 1000, os.POSIX_FADV_DONTNEED),
+                          (0, 0, os.POSIX_FADV_DONTNEED)], hints)
+
+    def test_no_policy(self):
+        wrapper = self._wrapper('rb', None)
+        with patch('os.posix_fadvise') as fadvise:
+            wrapper.read(0, 100)
+            wrapper.close()
+        self.assertFalse(fadvise.called)
+
+
+class TestFileHandlePool(unittest.TestCase):
+    """Tests for FileHandlePool"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _wrappers(self, pool, mode, num_files):
+        return [file_wrapper.FileWrapper(
+            os.path.join(self.folder, str(index) + '.bin'),
+            FileHandleFactory(), mode, handle_pool=pool)
+                for index in range(num_files)]
+
+    def test_least_recently_used_closed(self):
+        pool = FileHandlePool(max_open=2)
+        wrappers = self._wrappers(pool, 'wb', 3)
+        for offset in range(3):
+            for index, wrapper in enumerate(wrappers):
+                wrapper.write(offset, bytearray([index + offset]))
+            self.assertLessEqual(pool.get_stats()['open'], 2)
+        for wrapper in wrappers:
+            wrapper.close()
+
+        # Files opened for writing are not truncated when reopened
+        for index in range(3):
+            with open(os.path.join(self.folder, str(index) + '.bin'),
+                      'rb') as test_file:
+                self.assertEqual(bytearray([index, index + 1, index + 2]),
+                                 bytearray(test_file.read()))
+
+        stats = pool.get_stats()
+        self.assertEqual(0, stats['open'])
+        self.assertEqual(9, stats['misses'])
+        self.assertEqual(7, stats['evictions'])
+
+    def test_hits(self):
+        pool = FileHandlePool(max_open=2)
+        wrappers = self._wrappers(pool, 'wb', 2)
+        for offset in range(5):
+            for wrapper in wrappers:
+                wrapper.write(offset, b'x')
+        stats = pool.get_stats()
+        self.assertEqual(8, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(0.8, stats['hit_rate'])
+
+    def test_handle_in_use_not_closed(self):
+        pool = FileHandlePool(max_open=1)
+        wrappers = self._wrappers(pool, 'wb', 3)
+        with wrappers[0].use_handle() as handle:
+            wrappers[1].write(0, b'x')
+            wrappers[2].write(0, b'x')
+            self.assertFalse(handle.closed)
+        wrappers[1].write(0, b'x')
+        self.assertTrue(handle.closed)
+
+    def test_open_without_lock(self):
+        pool = FileHandlePool(max_open=2)
+        slow, fast = self._wrappers(pool, 'wb', 2)
+        opening = threading.Event()
+        finish_open = threading.Event()
+        open_handle = slow.open_handle
+
+        def slow_open():
+            opening.set()
+            finish_open.wait()
+            return open_handle()
+
+        # While one thread is opening a file, others can open other files,
+        # and threads using the same file wait for it to be opened
+        handles = []
+
+        def use_slow():
+            with slow.use_handle() as handle:
+                handles.append(handle)
+
+        with patch.object(slow, 'open_handle', side_effect=slow_open):
+            threads = [threading.Thread(target=use_slow) for _ in range(2)]
+            threads[0].start()
+            opening.wait()
+            threads[1].start()
+            fast_thread = threading.Thread(target=fast.write, args=(0, b'y'))
+            fast_thread.start()
+            fast_thread.join(5)
+            fast_finished = not fast_thread.is_alive()
+            finish_open.set()
+            fast_thread.join()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(fast_finished)
+            self.assertEqual(1, slow.open_handle.call_count)
+        self.assertEqual(2, len(handles))
+        self.assertIs(handles[0], handles[1])
+        slow.close()
+        fast.close()
+
+    def test_close_all(self):
+        pool = FileHandlePool(max_open=3)
+        wrappers = self._wrappers(pool, 'wb', 3)
+        for wrapper in wrappers[1:]:
+            wrapper.write(0, b'x')
+        with wrappers[0].use_handle() as handle:
+            pool.close_all()
+            self.assertFalse(handle.closed)
+            self.assertEqual(1, pool.get_stats()['open'])
+        pool.close_all()
+        self.assertTrue(handle.closed)
+        self.assertEqual(0, pool.get_stats()['open'])
+
+    def test_summary(self):
+        pool = FileHandlePool(max_open=2)
+        wrapper = self._wrappers(pool, 'wb', 1)[0]
+        for offset in range(4):
+            wrapper.write(offset, b'x')
+        self.assertEqual('File handles: 4 requests, hit rate 75.0%, 1 opened, '
+                         '0 closed to keep within 2 open files',
+                         pool.get_summary())
+
+
+class TestCreateFolder(unittest.TestCase):
+    """Tests for creating output folders"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_folder_checked_once(self):
+        factory = FileHandleFactory()
+        folder = os.path.join(self.folder, 'a', 'b')
+        with patch('os.makedirs', wraps=os.makedirs) as makedirs:
+            for index in range(3):
+                factory.create_file_handle(os.path.join(
+                    folder, str(index) + '.raw'), 'wb').close()
+        self.assertEqual(1, sum(1 for call in makedirs.call_args_list
+                                if call[0][0] == folder))
+
+    def test_removed_folder_recreated(self):
+        factory = FileHandleFactory()
+        folder = os.path.join(self.folder, 'a')
+        factory.create_file_handle(os.path.join(folder, '0.raw'), 'wb').close()
+        shutil.rmtree(folder)
+        factory.create_file_handle(os.path.join(folder, '1.raw'), 'wb').close()
+        self.assertTrue(os.path.isfile(os.path.join(folder, '1.raw')))
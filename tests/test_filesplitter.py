@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from imagesplit.utils.utilities import get_number_of_blocks, get_block_coordinate_range, \
-    get_suggested_block_size, ranges_for_max_block_size
+    get_suggested_block_size, ranges_for_max_block_size, iter_block_ranges, \
+    get_max_block_size_for_bytes
+from imagesplit.applications.split_files import parse_byte_size
 
 import unittest
 
@@ -64,3 +66,48 @@ class TestFileSplitter(unittest.TestCase):
              [[500, 998, 0, 0], [500, 999, 0, 0], [0, 333, 0, 0]],
              [[500, 998, 0, 0], [500, 999, 0, 0], [334, 667, 0, 0]],
              [[500, 998, 0, 0], [500, 999, 0, 0], [668, 1000, 0, 0]]])
+
+    def test_iter_block_ranges(self):
+        ranges = iter_block_ranges([5, 4, 3, 10], [1, 2, 1, 2], [0, 1, 0, 0])
+        self.assertEqual(next(ranges),
+                         [[0, 4, 0, 0], [0, 2, 0, 1], [0, 2, 0, 0], [0, 4, 0, 0]])
+        self.assertEqual(list(ranges),
+                         [[[0, 4, 0, 0], [0, 2, 0, 1], [0, 2, 0, 0], [5, 9, 0, 0]],
+                          [[0, 4, 0, 0], [1, 3, 1, 0], [0, 2, 0, 0], [0, 4, 0, 0]],
+                          [[0, 4, 0, 0], [1, 3, 1, 0], [0, 2, 0, 0], [5, 9, 0, 0]]])
+        self.assertEqual(list(iter_block_ranges([6, 7], [3, 1], [0, 0])),
+                         [[[0, 1, 0, 0], [0, 6, 0, 0]],
+                          [[2, 3, 0, 0], [0, 6, 0, 0]],
+                          [[4, 5, 0, 0], [0, 6, 0, 0]]])
+
+    def test_get_max_block_size_for_bytes(self):
+        # Whole planes fit, so split only along the slowest axis
+        self.assertEqual(get_max_block_size_for_bytes(
+            [100, 200, 300], 2, 100 * 200 * 2 * 10, [0, 1, 2], [0, 0, 0]),
+            [100, 200, 10])
+        # Input file stored with axis 2 fastest, then axis 0
+        self.assertEqual(get_max_block_size_for_bytes(
+            [100, 200, 300], 1, 300 * 50, [2, 0, 1], [0, 0, 0]),
+            [50, 1, 300])
+        # Overlap is included in the byte count
+        self.assertEqual(get_max_block_size_for_bytes(
+            [100, 200, 300], 1, 100 * 200 * 10, [0, 1, 2], [2, 2, 2]),
+            [100, 200, 6])
+        # Whole image fits
+        self.assertEqual(get_max_block_size_for_bytes(
+            [10, 20, 30], 4, 10 ** 6, [0, 1, 2], [0, 0, 0]),
+            [10, 20, 30])
+        # Never less than one voxel
+        self.assertEqual(get_max_block_size_for_bytes(
+            [10, 20, 30], 8, 4, [0, 1, 2], [0, 0, 0]),
+            [1, 1, 1])
+
+    def test_parse_byte_size(self):
+        self.assertEqual(parse_byte_size("4096"), 4096)
+        self.assertEqual(parse_byte_size("64M"), 64 * 2 ** 20)
+        self.assertEqual(parse_byte_size("256mb"), 256 * 2 ** 20)
+        self.assertEqual(parse_byte_size("1.5G"), 3 * 2 ** 29)
+        with self.assertRaises(ValueError):
+            parse_byte_size("many")
+        with self.assertRaises(ValueError):
+            parse_byte_size("0")
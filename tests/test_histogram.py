@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from parameterized import parameterized
+
+from imagesplit.applications.split_files import split_file
+from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.image.histogram import Histogram, get_histogram_cache_key, \
+    load_cached_histogram, save_cached_histogram, HISTOGRAM_CACHE_SUFFIX
+
+
+class TestHistogram(unittest.TestCase):
+    """Tests for Histogram"""
+
+    @parameterized.expand([
+        ['>i2', -1000, 3000],
+        ['u1', 0, 255],
+        ['<u2', 0, 65535],
+    ])
+    def test_exact_integer_percentiles(self, data_type, low, high):
+        data = np.random.randint(low, high + 1, size=20000).astype(data_type)
+        histogram = Histogram()
+        for block in np.array_split(data, 7):
+            histogram.add(block)
+
+        sorted_data = np.sort(data)
+        for percent in [0, 0.5, 1, 50, 99, 99.5, 100]:
+            rank = int((len(data) - 1) * percent / 100.0)
+            self.assertEqual(sorted_data[rank], histogram.percentile(percent))
+
+    @parameterized.expand([
+        [np.random.randint(-10**8, 10**8, size=20000), 65536],
+        [np.random.normal(0, 1, size=20000), 65536],
+        [np.random.normal(1e6, 1e3, size=20000).astype(np.float32), 65536],
+        [np.random.normal(0, 1, size=20000), 64],
+    ])
+    def test_bounded_percentiles(self, data, num_bins):
+        histogram = Histogram(num_bins)
+        for block in np.array_split(data, 13):
+            histogram.add(block)
+
+        self.assertEqual(num_bins, len(histogram.get_counts()))
+        self.assertEqual(len(data), histogram.get_count())
+        bin_width = 2.0 ** histogram.get_exponent()
+        sorted_data = np.sort(data)
+        for percent in [0, 1, 50, 99, 100]:
+            rank = int((len(data) - 1) * percent / 100.0)
+            self.assertLessEqual(
+                abs(sorted_data[rank] - histogram.percentile(percent)),
+                bin_width)
+
+    @parameterized.expand([
+        [np.random.randint(-1000, 3000, size=20000).astype(np.int16)],
+        [np.random.normal(0, 1, size=20000)],
+        [np.concatenate([np.random.normal(0, 1, size=10000),
+                         np.random.normal(1e5, 1, size=10000)])],
+    ])
+    def test_merge(self, data):
+        single = Histogram(1024)
+        single.add(data)
+
+        merged = Histogram(1024)
+        for block in np.array_split(data, 4):
+            part = Histogram(1024)
+            part.add(block)
+            merged.merge(part)
+
+        self.assertEqual(single.get_count(), merged.get_count())
+        bin_width = 2.0 ** max(single.get_exponent(), merged.get_exponent())
+        for percent in [0, 1, 50, 99, 100]:
+            self.assertLessEqual(abs(single.percentile(percent) -
+                                     merged.percentile(percent)), bin_width)
+
+    def test_ignores_non_finite(self):
+        histogram = Histogram()
+        histogram.add(np.array([np.nan, 1.0, np.inf, 2.0, -np.inf]))
+        self.assertEqual(2, histogram.get_count())
+
+    def test_empty(self):
+        histogram = Histogram()
+        with self.assertRaises(ValueError):
+            histogram.percentile(50)
+
+    def test_to_dict(self):
+        histogram = Histogram(1024)
+        histogram.add(np.random.normal(0, 100, size=5000))
+        loaded = Histogram.from_dict(histogram.to_dict())
+        self.assertEqual(histogram.get_exponent(), loaded.get_exponent())
+        self.assertEqual(histogram.get_first_bin(), loaded.get_first_bin())
+        np.testing.assert_array_equal(histogram.get_counts(),
+                                      loaded.get_counts())
+        for percent in [0, 5, 50, 95, 100]:
+            self.assertEqual(histogram.percentile(percent),
+                             loaded.percentile(percent))
+
+    def test_cache(self):
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'image.raw')
+            with open(filename, 'wb') as data_file:
+                data_file.write(b'1234')
+            key = get_histogram_cache_key([filename], [[0, 0], [2, 2]])
+            self.assertIsNone(load_cached_histogram(filename, key))
+
+            histogram = Histogram()
+            histogram.add(np.array([1, 2, 3, 4]))
+            save_cached_histogram(filename, key, histogram)
+            loaded = load_cached_histogram(filename, key)
+            self.assertEqual(4, loaded.get_count())
+            self.assertEqual(3, loaded.percentile(100 * 2 / 3.0))
+
+            # A different region or a modified file does not use the cache
+            self.assertIsNone(load_cached_histogram(
+                filename, get_histogram_cache_key([filename],
+                                                  [[0, 0], [1, 2]])))
+            with open(filename, 'ab') as data_file:
+                data_file.write(b'5678')
+            self.assertIsNone(load_cached_histogram(
+                filename, get_histogram_cache_key([filename],
+                                                  [[0, 0], [2, 2]])))
+        finally:
+            shutil.rmtree(folder)
+
+    @parameterized.expand([
+        [False],
+        [True],
+    ])
+    def test_cache_opt_in(self, cache_histogram):
+        folder = tempfile.mkdtemp()
+        try:
+            np.arange(6 * 5 * 4, dtype='<i2').tofile(
+                os.path.join(folder, 'image.raw'))
+            with open(os.path.join(folder, 'image.mhd'), 'w') as header:
+                header.write('ObjectType = Image\nNDims = 3\n'
+                             'BinaryData = True\n'
+                             'BinaryDataByteOrderMSB = False\n'
+                             'DimSize = 6 5 4\nElementSize = 1 1 1\n'
+                             'ElementType = MET_SHORT\n'
+                             'ElementDataFile = image.raw\n')
+            split_file(input_file_base=os.path.join(folder, 'image.mhd'),
+                       filename_out_base=os.path.join(folder, 'split'),
+                       start_index=None, output_type='uchar', dim_order=None,
+                       file_handle_factory=FileHandleFactory(),
+                       output_format=None, slice_output=False, rescale=None,
+                       out_compression=None, max_block_size_voxels=[3, 5, 4],
+                       overlap_size_voxels=0, rescale_percentile=[1, 99],
+                       cache_histogram=cache_histogram)
+            self.assertEqual(cache_histogram, os.path.exists(os.path.join(
+                folder, 'image.mhd' + HISTOGRAM_CACHE_SUFFIX)))
+        finally:
+            shutil.rmtree(folder)
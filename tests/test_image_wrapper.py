@@ -7,7 +7,8 @@ import numpy as np
 from parameterized import parameterized, param
 
 from tests.common_test_functions import create_dummy_image
-from imagesplit.image.image_wrapper import ImageWrapper, ImageStorage
+from imagesplit.image.image_wrapper import ImageWrapper, ImageStorage, \
+    BufferPool
 
 
 class TestImageWrapper(TestCase):
@@ -65,3 +66,38 @@ class TestImageWrapper(TestCase):
             except ValueError:
                 pass
 
+
+    @parameterized.expand([
+        param(order=[0, 1, 2], do_flip=[False, False, False]),
+        param(order=[2, 0, 1], do_flip=[True, False, False]),
+        param(order=[1, 2, 0], do_flip=[False, True, True]),
+        param(order=[2, 1, 0], do_flip=[True, True, True]),
+    ])
+    def test_transform(self, order, do_flip):
+        image = ImageStorage(np.arange(2 * 3 * 4).reshape(4, 3, 2))
+        expected = image.transpose(order).flip(do_flip)
+        transformed = image.transform(order, do_flip)
+        self.assertTrue(np.array_equal(expected.get_raw(),
+                                       transformed.get_raw()))
+        self.assertTrue(np.shares_memory(image.get_raw(),
+                                         transformed.get_raw()))
+
+
+class TestBufferPool(TestCase):
+
+    def test_reuse(self):
+        pool = BufferPool(max_buffers=1)
+        image = pool.get([4, 3, 2], np.int16)
+        self.assertEqual([4, 3, 2], image.get_size())
+        self.assertEqual(np.int16, image.get_type())
+
+        pool.release(image)
+        self.assertIsNot(image.get_raw(), pool.get([4, 3, 2], np.uint16).get_raw())
+        self.assertIs(image.get_raw(), pool.get([4, 3, 2], np.int16).get_raw())
+        self.assertIsNot(image.get_raw(), pool.get([4, 3, 2], np.int16).get_raw())
+
+        # Views and buffers beyond the maximum are not kept
+        pool.release(image.flip([True, False, False]))
+        pool.release(image)
+        pool.release(pool.get([4, 3, 2], np.int16))
+        self.assertIs(image.get_raw(), pool.get([4, 3, 2], np.int16).get_raw())
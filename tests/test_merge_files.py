@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from mock import patch
+from parameterized import parameterized
+
+from imagesplit.applications import merge_files
+from imagesplit.applications.split_files import split_file
+from imagesplit.file.file_wrapper import FileHandleFactory
+from imagesplit.file.tiff_file_reader import TiffFileReader
+
+
+class TestMergeFiles(unittest.TestCase):
+    """Split images and merge them back together"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.image = np.arange(20 * 17 * 13, dtype='<i2').reshape(13, 17, 20)
+        self.image.tofile(os.path.join(self.folder, 'image.raw'))
+        with open(os.path.join(self.folder, 'image.mhd'), 'w') as header:
+            header.write('ObjectType = Image\nNDims = 3\nBinaryData = True\n'
+                         'BinaryDataByteOrderMSB = False\nDimSize = 20 17 13\n'
+                         'ElementSize = 1 1 1\nElementType = MET_SHORT\n'
+                         'ElementDataFile = image.raw\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _split(self, name, dim_order=None, container=False,
+               max_block_size_voxels=(7, 6, 5)):
+        out_base = os.path.join(self.folder, name)
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=out_base, start_index=None,
+                   output_type=None, dim_order=dim_order,
+                   file_handle_factory=FileHandleFactory(),
+                   output_format=None, slice_output=False, rescale=None,
+                   out_compression=None,
+                   max_block_size_voxels=list(max_block_size_voxels),
+                   overlap_size_voxels=2, container=container)
+        return out_base
+
+    @parameterized.expand([
+        [None, False, merge_files.DEFAULT_MERGE_BYTES, None],
+        [[2, -1, 3], False, 1000, 4],
+        [None, True, 1, 1],
+    ])
+    def test_merge(self, dim_order, container, max_bytes, num_threads):
+        split_base = self._split('split', dim_order, container)
+        merged = merge_files.merge_files(
+            split_base + '_info.imagesplit',
+            os.path.join(self.folder, 'merged.mhd'), dim_order=[1, 2, 3],
+            max_bytes=max_bytes, num_threads=num_threads)
+        self.assertEqual(os.path.join(self.folder, 'merged.mhd'), merged)
+        np.testing.assert_array_equal(
+            self.image, np.fromfile(os.path.join(self.folder, 'merged.raw'),
+                                    dtype='<i2').reshape(13, 17, 20))
+
+    @parameterized.expand([
+        [None],
+        ['tiff_deflate'],
+    ])
+    def test_merge_tiff(self, compression):
+        out_base = os.path.join(self.folder, 'split')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=out_base, start_index=None,
+                   output_type=None, dim_order=None,
+                   file_handle_factory=FileHandleFactory(),
+                   output_format='tiff', slice_output=False, rescale=None,
+                   out_compression=compression,
+                   max_block_size_voxels=[7, 6, 1], overlap_size_voxels=0)
+        merge_files.merge_files(out_base + '_info.imagesplit',
+                                os.path.join(self.folder, 'merged.mhd'),
+                                max_bytes=1000, num_threads=4)
+        np.testing.assert_array_equal(
+            self.image, np.fromfile(os.path.join(self.folder, 'merged.raw'),
+                                    dtype='<i2').reshape(13, 17, 20))
+
+    def test_merge_tiff_releases_files(self):
+        out_base = os.path.join(self.folder, 'split')
+        split_file(input_file_base=os.path.join(self.folder, 'image.mhd'),
+                   filename_out_base=out_base, start_index=None,
+                   output_type=None, dim_order=None,
+                   file_handle_factory=FileHandleFactory(),
+                   output_format='tiff', slice_output=False, rescale=None,
+                   out_compression=None, max_block_size_voxels=[7, 6, 1],
+                   overlap_size_voxels=0)
+
+        # Count the decoded TIFF files held in memory as each one is loaded
+        readers = []
+        max_loaded = [0]
+        lock = threading.Lock()
+        load = TiffFileReader.load
+
+        def counting_load(reader):
+            image = load(reader)
+            with lock:
+                readers.append(reader)
+                max_loaded[0] = max(max_loaded[0], len(set(
+                    id(loaded) for loaded in readers
+                    if loaded.cached_image is not None)))
+            return image
+
+        with patch.object(TiffFileReader, 'load', counting_load):
+            merge_files.merge_files(out_base + '_info.imagesplit',
+                                    os.path.join(self.folder, 'merged.mhd'),
+                                    max_bytes=1000, num_threads=4)
+        np.testing.assert_array_equal(
+            self.image, np.fromfile(os.path.join(self.folder, 'merged.raw'),
+                                    dtype='<i2').reshape(13, 17, 20))
+
+        # Each slice is stored in 9 files, and at most the slice being
+        # written and the next slice are held
+        self.assertEqual(117, len(set(id(reader) for reader in readers)))
+        self.assertLessEqual(max_loaded[0], 18)
+        self.assertFalse(any(reader.cached_image is not None
+                             for reader in readers))
+
+    def test_split_ordering(self):
+        # By default the output has the axis ordering of the split files
+        split_base = self._split('split', [2, -1, 3])
+        whole_base = self._split('whole', [2, -1, 3], max_block_size_voxels=[
+            20, 17, 13])
+        merge_files.main([split_base + '_info.imagesplit', '-o',
+                          os.path.join(self.folder, 'merged.mhd'),
+                          '--max-bytes', '2K', '-j', '2'])
+        with open(whole_base + '.raw', 'rb') as whole_file:
+            with open(os.path.join(self.folder, 'merged.raw'),
+                      'rb') as merged_file:
+                self.assertEqual(whole_file.read(), merged_file.read())
+
+    def test_output_type(self):
+        split_base = self._split('split')
+        merge_files.merge_files(split_base + '_info.imagesplit',
+                                os.path.join(self.folder, 'merged.mhd'),
+                                output_type='float')
+        np.testing.assert_array_equal(
+            self.image, np.fromfile(os.path.join(self.folder, 'merged.raw'),
+                                    dtype='<f4').reshape(13, 17, 20))
+
+    def test_moved_files(self):
+        split_base = self._split('split')
+        moved_folder = os.path.join(self.folder, 'moved')
+        os.makedirs(moved_folder)
+        for index in range(27):
+            for extension in ['.mhd', '.raw']:
+                name = 'split_{0:04d}'.format(index) + extension
+                os.rename(os.path.join(self.folder, name),
+                          os.path.join(moved_folder, name))
+        merge_files.merge_files(split_base + '_info.imagesplit',
+                                os.path.join(self.folder, 'merged.mhd'),
+                                filename_override=os.path.join(
+                                    moved_folder, 'split.mhd'))
+        np.testing.assert_array_equal(
+            self.image, np.fromfile(os.path.join(self.folder, 'merged.raw'),
+                                    dtype='<i2').reshape(13, 17, 20))
+
+    def test_only_mhd(self):
+        split_base = self._split('split')
+        with self.assertRaises(ValueError):
+            merge_files.merge_files(split_base + '_info.imagesplit',
+                                    os.path.join(self.folder, 'merged.tiff'))
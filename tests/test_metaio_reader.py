@@ -4,7 +4,8 @@ from unittest import TestCase
 from parameterized import parameterized, param
 
 from imagesplit.file.metaio_reader import mhd_cosines_to_permutation, \
-    permutation_to_cosine, condensed_to_cosine
+    permutation_to_cosine, condensed_to_cosine, transform_to_permutation, \
+    get_condensed_dim_order
 from imagesplit.image.combined_image import Axis
 from imagesplit.utils.utilities import compute_bytes_per_voxel
 
@@ -47,3 +48,24 @@ class TestMetaIoReader(unittest.TestCase):
 
                     cosines_computed_2 = condensed_to_cosine(Axis(perm_computed, flip_computed).to_condensed_format())
                     self.assertEqual(cosines_computed_2, c1 + c2 + c3)
+
+    @parameterized.expand([
+        param(condensed=[1, 2, 3, 4]),
+        param(condensed=[2, -1, 4, 3]),
+        param(condensed=[-4, 3, -2, -1]),
+        param(condensed=[2, 1]),
+        param(condensed=[3, -1, 2]),
+    ])
+    def test_transform_to_permutation(self, condensed):
+        axis = Axis.from_condensed_format(condensed)
+        cosines = condensed_to_cosine(condensed)
+        self.assertEqual(len(condensed) ** 2, len(cosines))
+        perm, flip = transform_to_permutation(cosines, len(condensed))
+        self.assertEqual(axis.dim_order, perm)
+        self.assertEqual(axis.dim_flip, flip)
+        self.assertEqual(condensed, get_condensed_dim_order(
+            {"NDims": len(condensed), "TransformMatrix": cosines}))
+
+    def test_default_dim_order(self):
+        self.assertEqual([1, 2, 3, 4], get_condensed_dim_order({"NDims": 4}))
+        self.assertEqual([1, 2, 3], get_condensed_dim_order({"NDims": 3}))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import six
+from mock import patch
+from parameterized import parameterized
+
+from imagesplit.applications.write_files import write_files
+from imagesplit.file.file_wrapper import COPY_CHUNK_BYTES
+from imagesplit.utils.file_descriptor import generate_output_descriptors
+from imagesplit.utils.split_plan import estimate_split_plan, format_bytes
+
+
+def _descriptors(image_size, block_size, overlap=0, dim_order=(1, 2, 3),
+                 data_type="short", file_format="mhd"):
+    return generate_output_descriptors(
+        filename_out_base="split", max_block_size_voxels=list(block_size),
+        overlap_size_voxels=overlap, dim_order=list(dim_order), header={},
+        output_type=data_type, num_dims=3, output_file_format=file_format,
+        image_size=list(image_size), msb=False, compression=None,
+        voxel_size=[1, 1, 1])
+
+
+class TestSplitPlan(unittest.TestCase):
+    """Tests for estimating the cost of a split"""
+
+    def test_slabs(self):
+        # Slabs which need no conversion are copied in one run each
+        descriptors_in = _descriptors([1000, 1000, 1000], [1000, 1000, 1000])
+        plan = estimate_split_plan(
+            descriptors_in, _descriptors([1000, 1000, 1000], [1000, 1000, 125]))
+        self.assertEqual(8, plan.num_outputs)
+        self.assertEqual(1, plan.num_inputs)
+        self.assertEqual(2 * 10 ** 9, plan.input_bytes)
+        self.assertEqual(2 * 10 ** 9, plan.read_bytes)
+        self.assertEqual(2 * 10 ** 9, plan.write_bytes)
+        self.assertEqual(8, plan.num_reads)
+        self.assertAlmostEqual(1.0, plan.get_access_amplification(), 4)
+        self.assertEqual(COPY_CHUNK_BYTES, plan.peak_memory_bytes)
+
+    def test_conversion(self):
+        # Converted slabs are written one slice at a time
+        descriptors_in = _descriptors([1000, 1000, 1000], [1000, 1000, 1000])
+        plan = estimate_split_plan(
+            descriptors_in, _descriptors([1000, 1000, 1000], [1000, 1000, 125],
+                                         data_type="float"),
+            concurrency=4)
+        self.assertEqual(4 * 10 ** 9, plan.write_bytes)
+        self.assertEqual(1000, plan.num_reads)
+        self.assertAlmostEqual(1.0, plan.get_access_amplification(), 2)
+        self.assertEqual(4 * 1000 * 1000 * (2 + 4), plan.peak_memory_bytes)
+
+    def test_rescale(self):
+        # Rescaling between explicit limits converts the values, even when
+        # the data type is unchanged, but needs no extra read
+        descriptors_in = _descriptors([1000, 1000, 1000], [1000, 1000, 1000])
+        plan = estimate_split_plan(
+            descriptors_in, _descriptors([1000, 1000, 1000], [1000, 1000, 125]),
+            concurrency=4, rescale=True)
+        self.assertEqual(1000, plan.num_reads)
+        self.assertEqual(0, plan.rescale_read_bytes)
+        self.assertEqual(4 * 1000 * 1000 * (2 + 2), plan.peak_memory_bytes)
+
+    def test_overlap(self):
+        descriptors_in = _descriptors([1000, 1000, 1000], [1000, 1000, 1000])
+        plan = estimate_split_plan(
+            descriptors_in, _descriptors([1000, 1000, 1000], [1000, 1000, 500],
+                                         overlap=10, data_type="float"),
+            halo_cache_bytes=2 ** 28)
+        self.assertAlmostEqual(1.02, plan.get_overlap_amplification(), 4)
+        self.assertEqual(1000 * 1000 * 6 + 4 * 10 ** 7, plan.peak_memory_bytes)
+
+    def test_axis_reordering(self):
+        # Writing slices across the slowest input axis reads one voxel at a
+        # time, so whole file system blocks are read for each voxel
+        descriptors_in = _descriptors([1000, 1000, 1000], [1000, 1000, 1000])
+        reordered = estimate_split_plan(
+            descriptors_in, _descriptors([1000, 1000, 1000], [1000, 1000, 125],
+                                         dim_order=[3, 2, 1]))
+        self.assertEqual(10 ** 9, reordered.num_reads)
+        self.assertGreater(reordered.get_access_amplification(), 1000)
+
+    def test_rescale_and_tiff(self):
+        descriptors_in = _descriptors([1000, 1000, 100], [1000, 1000, 100])
+        plan = estimate_split_plan(
+            descriptors_in, _descriptors([1000, 1000, 100], [1000, 1000, 1],
+                                         data_type="uchar",
+                                         file_format="tiff"),
+            rescale_pass=True)
+        self.assertEqual(100, plan.num_outputs)
+        self.assertEqual(2 * 10 ** 8, plan.rescale_read_bytes)
+        self.assertEqual(100, plan.num_reads)
+        self.assertEqual(1000 * 1000 * (2 + 2), plan.peak_memory_bytes)
+        self.assertIn("Rescale limits", plan.get_summary())
+
+    @parameterized.expand([
+        [0, "0 B"],
+        [1023, "1023 B"],
+        [1536, "1.5 KB"],
+        [3 * 2 ** 30, "3.0 GB"],
+        [2 ** 50, "1024.0 TB"],
+    ])
+    def test_format_bytes(self, num_bytes, expected):
+        self.assertEqual(expected, format_bytes(num_bytes))
+
+    @parameterized.expand([
+        ["limits", True],
+        [[0, 1000], False],
+    ])
+    def test_test_mode(self, rescale, rescale_pass):
+        descriptors_in = _descriptors([100, 100, 100], [100, 100, 100])
+        descriptors_out = _descriptors([100, 100, 100], [50, 50, 50])
+        with patch('sys.stdout', new_callable=six.StringIO) as output:
+            # No files are opened, so the file factory is not used
+            write_files(descriptors_in, descriptors_out, None, rescale,
+                        test=True)
+        self.assertIn("Output files:          8", output.getvalue())
+        self.assertIn("Estimated peak memory: 9.8 KB", output.getvalue())
+        self.assertEqual(rescale_pass, "Rescale limits" in output.getvalue())
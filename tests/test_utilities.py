@@ -6,7 +6,8 @@ from parameterized import parameterized
 import numpy as np
 
 from imagesplit.image.combined_image import Limits
-from imagesplit.utils.utilities import file_linear_byte_offset, rescale_image
+from imagesplit.utils.utilities import file_linear_byte_offset, \
+    rescale_image, get_contiguous_runs, convert_data_type, Rescaler
 
 
 class TestUtilities(unittest.TestCase):
@@ -45,3 +46,94 @@ class TestUtilities(unittest.TestCase):
     def test_rescale(self, data_type, image_line, rescale_limits, expected):
         result = rescale_image(data_type, image_line, rescale_limits)
         self.assertTrue(np.array_equal(expected, result))
+
+    @parameterized.expand([
+        [np.float32, [-1, 0, 50, 100, 101], Limits(0, 100), [0, 0, 0.5, 1, 1]],
+        [np.float64, [-1, 0, 50, 100, 101], Limits(0, 100), [0, 0, 0.5, 1, 1]],
+        [np.uint32, [-1, 0, 1, 2], Limits(0, 1), [0, 0, 4294967295, 4294967295]],
+    ])
+    def test_rescale_types(self, data_type, image_line, rescale_limits,
+                           expected):
+        result = rescale_image(data_type, image_line, rescale_limits)
+        self.assertEqual(np.dtype(data_type), result.dtype)
+        np.testing.assert_array_equal(expected, result)
+
+    @parameterized.expand([
+        ['u1', '>u1'],
+        ['>i2', '<i2'],
+        ['<i2', 'u1'],
+        ['>u2', '>i2'],
+        ['i1', '<f4'],
+        ['<i4', 'u1'],
+        ['>f4', '>u2'],
+    ])
+    def test_rescaler_matches_rescale(self, in_type, out_type):
+        rescale_limits = Limits(-100, 120)
+        info = np.iinfo(in_type) if np.dtype(in_type).kind != 'f' \
+            else np.iinfo(np.int16)
+        image = np.linspace(info.min, info.max, 1000).astype(in_type)
+        rescaler = Rescaler(out_type, rescale_limits)
+        result = rescaler.rescale(image)
+
+        if np.dtype(out_type).kind == 'f':
+            out_min, out_max = 0, 1
+        else:
+            out_min, out_max = np.iinfo(out_type).min, np.iinfo(out_type).max
+        expected = out_min + (float(out_max) - out_min) / 220.0 * \
+            (np.clip(image.astype(np.float64), -100, 120) + 100)
+        self.assertEqual(np.dtype(out_type), result.dtype)
+        np.testing.assert_allclose(expected, result, rtol=1e-6, atol=0.5)
+
+    @parameterized.expand([
+        ['<i2'],
+        ['<f4'],
+        ['<f8'],
+    ])
+    def test_rescaler_rounding(self, in_type):
+        image = np.arange(0, 2100).astype(in_type)
+        result = Rescaler('<u2', Limits(0, 1000)).rescale(image)
+        expected = np.around(65535 / 1000.0 * np.clip(
+            image, 0, 1000).astype(float)).astype('<u2')
+        np.testing.assert_array_equal(expected, result)
+
+    @parameterized.expand([
+        [[4, 5, 6], [4, 5, 6], [0, 0, 0], [4, 5, 6], [0, 0, 0],
+         [([0, 0, 0], [0, 0, 0], 120)]],
+        [[4, 5, 2], [4, 5, 6], [0, 0, 3], [4, 5, 2], [0, 0, 0],
+         [([0, 0, 3], [0, 0, 0], 40)]],
+        [[4, 2, 2], [4, 5, 6], [0, 1, 3], [4, 2, 2], [0, 0, 0],
+         [([0, 1, 3], [0, 0, 0], 8), ([0, 1, 4], [0, 0, 1], 8)]],
+        [[2, 2, 1], [4, 5, 6], [1, 2, 3], [3, 3, 3], [1, 0, 2],
+         [([1, 2, 3], [1, 0, 2], 2), ([1, 3, 3], [1, 1, 2], 2)]],
+    ])
+    def test_get_contiguous_runs(self, region_size, image_size_a, start_a,
+                                 image_size_b, start_b, expected):
+        runs = list(get_contiguous_runs(region_size, image_size_a, start_a,
+                                        image_size_b, start_b))
+        self.assertEqual(expected, runs)
+
+    @parameterized.expand([
+        ['>i2', '<i2', False],
+        ['>i2', '<i2', True],
+        ['<u4', '>u4', True],
+        ['>f8', '<f8', True],
+        ['>i2', '>i2', True],
+        ['>i2', '<i4', True],
+        ['<u1', '>u1', True],
+    ])
+    def test_convert_data_type(self, in_type, out_type, in_place):
+        image = np.arange(24, dtype=in_type).reshape(2, 3, 4)
+        expected = np.arange(24).reshape(2, 3, 4)
+        result = convert_data_type(image, out_type, in_place=in_place)
+        self.assertEqual(np.dtype(out_type), result.dtype)
+        self.assertTrue(result.flags.c_contiguous)
+        np.testing.assert_array_equal(expected, result)
+        if not in_place:
+            np.testing.assert_array_equal(expected, image)
+
+    def test_convert_data_type_non_contiguous(self):
+        image = np.arange(24, dtype='>i2').reshape(2, 3, 4).transpose()
+        result = convert_data_type(image, '<i2', in_place=True)
+        self.assertTrue(result.flags.c_contiguous)
+        np.testing.assert_array_equal(np.arange(24).reshape(2, 3, 4).transpose(),
+                                      result)